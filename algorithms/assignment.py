@@ -0,0 +1,280 @@
+# ev_charging_project/algorithms/assignment.py
+"""
+批量分配求解器 (用户 → 充电桩排队位)
+
+把每个充电桩按剩余排队容量展开为若干 "排队位" (slot)，在 用户×排队位 的代价矩阵上
+求最小费用匹配 (scipy.optimize.linear_sum_assignment)。候选关系是稀疏的 (每个用户
+只考虑少量候选桩)，因此先按 用户-充电桩 二部图的连通分量拆分，再逐个分量求解。
+
+超出时间预算、分量过大或缺少 scipy 时，对剩余用户退回按优先顺序的贪心分配。
+
+solve_auction 是不依赖 scipy 的多轮 "出价/接受" 分配 (deferred acceptance):
+每轮所有未分配用户同时向各自得分最高、尚未拒绝过自己的候选桩出价，充电桩按用户优先顺序 (行号) 保留
+不超过容量的出价者，其余被拒绝的用户下一轮改投次优候选。每轮只有按充电桩分组的向量运算，
+轮数不超过候选桩数；得分与排队位无关时结果与按优先顺序的贪心完全一致。
+超出时间预算或 max_auction_rounds 时提前停止 (stats["stopped_early"])，还没出完价的用户由调用方
+用 unassigned_with_capacity 找出并记入 deferred_users，留到下一步处理。
+"""
+
+import logging
+import time
+
+import numpy as np
+
+try:
+    from scipy.optimize import linear_sum_assignment
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+    HAS_SCIPY = True
+except ImportError:
+    HAS_SCIPY = False
+
+logger = logging.getLogger(__name__)
+
+ASSIGNMENT_MODES = ("greedy", "min_cost", "auction")
+DEFAULT_TIME_BUDGET_MS = 500
+DEFAULT_MAX_DENSE_CELLS = 4_000_000
+
+
+def solve_assignment(user_candidates, charger_capacity, slot_score_fn, params=None):
+    """
+    求解 用户 → 充电桩 的批量分配。
+
+    Args:
+        user_candidates (list[np.ndarray]): 每个用户 (行号) 可选的充电桩列号，行顺序即贪心回退时的优先顺序
+        charger_capacity (np.ndarray): 每个充电桩本步还可接收的用户数
+        slot_score_fn (callable): slot_score_fn(rows, col, slot) -> 分数数组 (越大越好)，
+            表示 rows 中的用户排在充电桩 col 的第 slot 个空位时的得分；不可行返回 -inf/NaN
+        params (dict): time_budget_ms, max_dense_cells
+
+    Returns:
+        tuple: ({row: col}, 统计信息 dict)
+    """
+    params = params if params is not None else {}
+    time_budget_s = params.get('time_budget_ms', DEFAULT_TIME_BUDGET_MS) / 1000.0
+    max_dense_cells = params.get('max_dense_cells', DEFAULT_MAX_DENSE_CELLS)
+    start = time.perf_counter()
+
+    capacity = np.maximum(np.asarray(charger_capacity, dtype=int), 0)
+    stats = {"solver": "min_cost", "components": 0, "optimal_users": 0, "greedy_users": 0, "solve_time_ms": 0.0}
+    assignment = {}
+
+    rows_with_candidates = [r for r, cands in enumerate(user_candidates) if len(cands) > 0]
+    if not rows_with_candidates:
+        return assignment, stats
+
+    if not HAS_SCIPY:
+        logger.warning("scipy not available, falling back to greedy assignment.")
+        stats["solver"] = "greedy"
+        used = np.zeros(len(capacity), dtype=int)
+        assignment = _greedy_assign(rows_with_candidates, user_candidates, capacity, used, slot_score_fn)
+        stats["greedy_users"] = len(rows_with_candidates)
+        stats["solve_time_ms"] = (time.perf_counter() - start) * 1000
+        return assignment, stats
+
+    components = _split_components(user_candidates, len(capacity))
+    stats["components"] = len(components)
+    used = np.zeros(len(capacity), dtype=int)
+    greedy_rows = []
+
+    for comp_rows, comp_cols in components:
+        if time.perf_counter() - start > time_budget_s:
+            greedy_rows.extend(comp_rows)
+            continue
+        comp_assignment = _solve_component(comp_rows, comp_cols, user_candidates, capacity, slot_score_fn, max_dense_cells)
+        if comp_assignment is None:
+            greedy_rows.extend(comp_rows)
+            continue
+        for row, col in comp_assignment.items():
+            assignment[row] = col
+            used[col] += 1
+        stats["optimal_users"] += len(comp_rows)
+
+    if greedy_rows:
+        # 保持调用方给出的优先顺序
+        greedy_rows.sort()
+        assignment.update(_greedy_assign(greedy_rows, user_candidates, capacity, used, slot_score_fn))
+        stats["greedy_users"] = len(greedy_rows)
+        logger.info(f"Assignment: {len(greedy_rows)} users solved greedily (time budget or component size limit).")
+
+    stats["solve_time_ms"] = round((time.perf_counter() - start) * 1000, 2)
+    return assignment, stats
+
+
+def solve_auction(user_candidates, charger_capacity, slot_score_fn, params=None):
+    """
+    多轮出价/接受分配，参数与返回值同 solve_assignment (params 另有 max_auction_rounds)。
+    出价时的得分按充电桩当前已接受人数对应的排队位计算；超出 time_budget_ms 时返回已接受的分配，
+    并置 stats["stopped_early"] = True。
+    """
+    params = params if params is not None else {}
+    time_budget_s = params.get('time_budget_ms', DEFAULT_TIME_BUDGET_MS) / 1000.0
+    max_rounds = params.get('max_auction_rounds')
+    start = time.perf_counter()
+
+    capacity = np.maximum(np.asarray(charger_capacity, dtype=int), 0)
+    stats = {"solver": "auction", "rounds": 0, "proposals": 0, "stopped_early": False, "solve_time_ms": 0.0}
+    num_users = len(user_candidates)
+    if num_users == 0:
+        return {}, stats
+
+    # 候选边按行连续存放: edge_row 非递减
+    lengths = np.array([len(c) for c in user_candidates], dtype=int)
+    edge_row = np.repeat(np.arange(num_users), lengths)
+    edge_col = np.concatenate([np.asarray(c, dtype=int) for c in user_candidates]) if lengths.sum() else np.zeros(0, dtype=int)
+    open_edge = capacity[edge_col] > 0 if len(edge_col) else np.zeros(0, dtype=bool)
+    held_col = np.full(num_users, -1, dtype=int)      # 每个用户当前被哪个充电桩接受
+    held_count = np.zeros(len(capacity), dtype=int)
+
+    while True:
+        active_edges = np.flatnonzero(open_edge & (held_col[edge_row] < 0))
+        if len(active_edges) == 0:
+            break
+        if max_rounds is not None and stats["rounds"] >= max_rounds:
+            stats["stopped_early"] = True
+            break
+        if time.perf_counter() - start > time_budget_s:
+            logger.info(f"Auction: time budget exhausted after {stats['rounds']} rounds.")
+            stats["stopped_early"] = True
+            break
+        stats["rounds"] += 1
+
+        # 1. 每条可用边按充电桩分组打分 (排队位 = 该桩已接受人数；已满的桩按最后一个排队位计，优先级更高的用户仍可挤入)
+        edge_scores = np.full(len(active_edges), -np.inf)
+        cols = edge_col[active_edges]
+        order = np.argsort(cols, kind='stable')
+        bounds = np.flatnonzero(np.diff(cols[order])) + 1
+        for group in np.split(order, bounds):
+            col = cols[group[0]]
+            edge_scores[group] = slot_score_fn(edge_row[active_edges[group]], col, min(held_count[col], capacity[col] - 1))
+        edge_scores = np.where(np.isnan(edge_scores), -np.inf, edge_scores)
+        infeasible = ~np.isfinite(edge_scores)
+        open_edge[active_edges[infeasible]] = False
+        active_edges, edge_scores = active_edges[~infeasible], edge_scores[~infeasible]
+        if len(active_edges) == 0:
+            break
+
+        # 2. 每个用户向得分最高的边出价 (同分取候选列表中靠前的)
+        rows = edge_row[active_edges]
+        best = np.lexsort((active_edges, -edge_scores, rows))
+        first = np.ones(len(best), dtype=bool)
+        first[1:] = rows[best][1:] != rows[best][:-1]
+        bid_edges = active_edges[best[first]]
+        bid_rows, bid_cols = edge_row[bid_edges], edge_col[bid_edges]
+        stats["proposals"] += len(bid_edges)
+
+        # 3. 充电桩在已接受者和新出价者中按优先顺序保留前 capacity 个
+        held_rows = np.flatnonzero(held_col >= 0)
+        all_rows = np.concatenate([held_rows, bid_rows])
+        all_cols = np.concatenate([held_col[held_rows], bid_cols])
+        order = np.lexsort((all_rows, all_cols))
+        all_rows, all_cols = all_rows[order], all_cols[order]
+        group_start = np.flatnonzero(np.r_[True, all_cols[1:] != all_cols[:-1]])
+        rank = np.arange(len(all_cols)) - np.repeat(group_start, np.diff(np.r_[group_start, len(all_cols)]))
+        accepted = rank < capacity[all_cols]
+
+        held_col[:] = -1
+        held_col[all_rows[accepted]] = all_cols[accepted]
+        held_count = np.bincount(all_cols[accepted], minlength=len(capacity))
+        # 被拒绝 (含被挤出) 的用户不再向该充电桩出价
+        rejected = np.zeros(num_users, dtype=bool)
+        rejected[all_rows[~accepted]] = True
+        rejected_cols = np.full(num_users, -1, dtype=int)
+        rejected_cols[all_rows[~accepted]] = all_cols[~accepted]
+        open_edge[rejected[edge_row] & (edge_col == rejected_cols[edge_row])] = False
+        # 已满的充电桩只会被优先级更高的用户挤入，排在其最后一个接受者之后的用户不必再出价
+        worst_held = np.full(len(capacity), -1, dtype=int)
+        np.maximum.at(worst_held, all_cols[accepted], all_rows[accepted])
+        full = held_count >= capacity
+        open_edge &= ~(full[edge_col] & (edge_row > worst_held[edge_col]))
+
+    assignment = {int(row): int(held_col[row]) for row in np.flatnonzero(held_col >= 0)}
+    stats["solve_time_ms"] = round((time.perf_counter() - start) * 1000, 2)
+    return assignment, stats
+
+
+def unassigned_with_capacity(user_candidates, charger_capacity, assignment):
+    """未分配、但候选桩在分配后仍有空余排队位的用户行号 (求解器提前停止时没来得及处理的用户)"""
+    capacity = np.maximum(np.asarray(charger_capacity, dtype=int), 0)
+    remaining = capacity - np.bincount(np.fromiter(assignment.values(), dtype=int), minlength=len(capacity))
+    return [
+        row for row, cands in enumerate(user_candidates)
+        if row not in assignment and len(cands) > 0 and np.any(remaining[np.asarray(cands, dtype=int)] > 0)
+    ]
+
+
+def _greedy_assign(rows, user_candidates, capacity, used, slot_score_fn):
+    assignment = {}
+    for row in rows:
+        best_col, best_score = None, -np.inf
+        for col in user_candidates[row]:
+            if used[col] >= capacity[col]:
+                continue
+            score = float(slot_score_fn(np.array([row]), col, used[col])[0])
+            if score > best_score:
+                best_col, best_score = col, score
+        if best_col is not None:
+            assignment[row] = best_col
+            used[best_col] += 1
+    return assignment
+
+
+def _split_components(user_candidates, num_chargers):
+    """按 用户-充电桩 二部图的连通分量拆分，返回 [(rows, cols), ...]"""
+    num_users = len(user_candidates)
+    edge_rows = np.concatenate([np.full(len(c), r, dtype=int) for r, c in enumerate(user_candidates)])
+    edge_cols = np.concatenate([np.asarray(c, dtype=int) for c in user_candidates]) + num_users
+    size = num_users + num_chargers
+    graph = coo_matrix((np.ones(len(edge_rows)), (edge_rows, edge_cols)), shape=(size, size))
+    _, labels = connected_components(graph, directed=False)
+
+    components = {}
+    for row in range(num_users):
+        if len(user_candidates[row]) > 0:
+            components.setdefault(labels[row], ([], set()))[0].append(row)
+    for row, cands in enumerate(user_candidates):
+        if len(cands) > 0:
+            components[labels[row]][1].update(int(c) for c in cands)
+    return [(rows, sorted(cols)) for rows, cols in components.values()]
+
+
+def _solve_component(rows, cols, user_candidates, capacity, slot_score_fn, max_dense_cells):
+    """在一个连通分量上构造 用户×排队位 代价矩阵并求最小费用匹配；分量过大时返回 None"""
+    rows_arr = np.asarray(rows, dtype=int)
+    row_pos = {row: i for i, row in enumerate(rows)}
+    # 每个充电桩最多展开到 "剩余容量" 与 "候选该桩的用户数" 的较小值
+    demand = {}
+    for row in rows:
+        for col in user_candidates[row]:
+            demand[int(col)] = demand.get(int(col), 0) + 1
+    slot_cols = []
+    for col in cols:
+        slot_cols.extend((col, slot) for slot in range(min(int(capacity[col]), demand.get(col, 0))))
+    if not slot_cols:
+        return {}
+    if len(rows) * len(slot_cols) > max_dense_cells:
+        return None
+
+    scores = np.full((len(rows), len(slot_cols)), -np.inf)
+    candidate_mask = {}
+    for row in rows:
+        for col in user_candidates[row]:
+            candidate_mask.setdefault(int(col), []).append(row_pos[row])
+    for j, (col, slot) in enumerate(slot_cols):
+        member_idx = np.asarray(candidate_mask[col], dtype=int)
+        scores[member_idx, j] = slot_score_fn(rows_arr[member_idx], col, slot)
+
+    feasible = np.isfinite(scores)
+    if not feasible.any():
+        return {}
+    # 不可行的位置用足够大的代价，使求解器优先最大化可行匹配数，事后剔除
+    finite_scores = scores[feasible]
+    big_m = (np.abs(finite_scores).max() + 1.0) * (min(scores.shape) + 1)
+    cost = np.where(feasible, -scores, big_m)
+    matched_rows, matched_slots = linear_sum_assignment(cost)
+
+    result = {}
+    for i, j in zip(matched_rows, matched_slots):
+        if feasible[i, j]:
+            result[rows[i]] = slot_cols[j][0]
+    return result
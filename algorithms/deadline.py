@@ -0,0 +1,58 @@
+# ev_charging_project/algorithms/deadline.py
+"""
+单步决策时间预算 (anytime 调度)
+
+调度器在每步开始时创建一个 Deadline 并通过 context["deadline"] 交给算法。算法按优先级顺序处理候选用户，
+预算耗尽时停止并返回已有的分配，未处理的用户放入 metadata["deferred_users"]；
+environment 会把这些用户带到下一步 (state["deferred_users"])，并在下一步优先处理。
+"""
+
+import time
+
+
+class Deadline:
+    """
+    单步决策的截止时间；budget_ms 为 None 或 <= 0 时不限时。
+    min_batch: 即使预算已耗尽，每步也至少处理这么多个用户，保证被推迟的用户能逐步消化。
+    """
+
+    def __init__(self, budget_ms=None, min_batch=0):
+        self.budget_ms = budget_ms if budget_ms is not None and budget_ms > 0 else None
+        self.min_batch = max(0, min_batch or 0)
+        self.start = time.perf_counter()
+        self.expires_at = self.start + self.budget_ms / 1000.0 if self.budget_ms is not None else None
+        self.exhausted = False
+
+    @property
+    def limited(self):
+        return self.expires_at is not None
+
+    def expired(self):
+        """预算是否已用完 (一旦用完保持为 True)"""
+        if self.exhausted:
+            return True
+        if self.expires_at is not None and time.perf_counter() >= self.expires_at:
+            self.exhausted = True
+        return self.exhausted
+
+    def should_stop(self, processed):
+        """已处理 processed 个用户后是否应停止"""
+        return processed >= self.min_batch and self.expired()
+
+    def remaining_ms(self):
+        """剩余毫秒数，不限时返回 None"""
+        if self.expires_at is None:
+            return None
+        return max(0.0, (self.expires_at - time.perf_counter()) * 1000)
+
+    def elapsed_ms(self):
+        return (time.perf_counter() - self.start) * 1000
+
+
+def anytime_order(users, deferred_ids=()):
+    """anytime 调度的用户处理顺序: 上一步被推迟的用户 > 明确需要充电决策的用户 > SOC 低的用户 (稳定排序)"""
+    return sorted(users, key=lambda u: (
+        u.get("user_id") not in deferred_ids,
+        not u.get("needs_charge_decision", False),
+        u.get("soc", 100),
+    ))
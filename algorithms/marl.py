@@ -2,114 +2,75 @@
 # (内容来自原 marl_components.py, 并移除末尾重复类)
 
 import numpy as np
-import random
 import pickle
 import os
-from collections import defaultdict
+import ast
+import json
 import logging
 from datetime import datetime
 import math
+import time
 # 导入重构后的工具函数
-from simulation.utils import calculate_distance # 确保导入路径正确
+from simulation.utils import calculate_distance, positions_to_array # 确保导入路径正确
 
-logger = logging.getLogger("MARL")
+try:
+    from scipy.spatial import cKDTree
+    HAS_SCIPY = True
+except ImportError:
+    HAS_SCIPY = False
 
-class MARLAgent:
-    """Represents a single agent (e.g., a charging station) using Q-learning."""
-    def __init__(self, agent_id, action_space_size, learning_rate=0.1, discount_factor=0.9, exploration_rate=0.1):
-        self.agent_id = agent_id
-        self.action_space_size = action_space_size
-        self.lr = learning_rate
-        self.gamma = discount_factor
-        self.epsilon = exploration_rate
-        self.q_table = defaultdict(lambda: np.zeros(self.action_space_size))
+logger = logging.getLogger("MARL")
 
-    def choose_action(self, state, current_action_map):
-        """Choose action using epsilon-greedy strategy based on the current valid actions."""
-        state_str = self._state_to_string(state)
+# 智能体离散状态的特征顺序 (StateEncoder 按此顺序做混合进制编码)
+AGENT_STATE_FEATURES = ("status", "queue", "hour_discrete", "grid_load_cat", "renew_cat", "nearby_demand_cat")
 
-        # Ensure Q-table entry exists and has the correct size
-        if len(self.q_table[state_str]) != self.action_space_size:
-            logger.warning(f"Q-table size mismatch for agent {self.agent_id} state {state_str}. Expected {self.action_space_size}, got {len(self.q_table[state_str])}. Resetting.")
-            self.q_table[state_str] = np.zeros(self.action_space_size)
 
-        valid_action_indices = list(current_action_map.keys())
-        if not valid_action_indices:
-            logger.warning(f"Agent {self.agent_id} has no valid actions in state {state_str}.")
-            return current_action_map.get(0, 'idle'), 0 # Default to idle
+class ReplayBuffer:
+    """基于 numpy 环形数组的经验回放缓冲区，每条经验为 (agent, state, action, reward, next_state)，状态为 StateEncoder 编号"""
 
-        if random.uniform(0, 1) < self.epsilon:
-            # Explore
-            action_index = random.choice(valid_action_indices)
-        else:
-            # Exploit
-            q_values = self.q_table[state_str]
-            valid_q_values = {idx: q_values[idx] for idx in valid_action_indices}
-            if not valid_q_values:
-                 action_index = random.choice(valid_action_indices)
-            else:
-                max_q = max(valid_q_values.values())
-                best_action_indices = [idx for idx, q in valid_q_values.items() if q == max_q]
-                action_index = random.choice(best_action_indices)
+    def __init__(self, capacity, seed=None):
+        self.capacity = max(1, int(capacity))
+        self.agent_idx = np.zeros(self.capacity, dtype=np.int32)
+        self.states = np.zeros(self.capacity, dtype=np.int32)
+        self.actions = np.zeros(self.capacity, dtype=np.int16)
+        self.rewards = np.zeros(self.capacity, dtype=np.float32)
+        self.next_states = np.zeros(self.capacity, dtype=np.int32)
+        self.position = 0
+        self.size = 0
+        self.rng = np.random.default_rng(seed)
 
-        chosen_action = current_action_map.get(action_index, 'idle') # Safely get action
-        return chosen_action, action_index
+    def __len__(self):
+        return self.size
 
-    def update_q_table(self, state, action_index, reward, next_state):
-        """Update Q-value for the state-action pair."""
-        if not (0 <= action_index < self.action_space_size):
-            logger.error(f"Invalid action_index {action_index} for agent {self.agent_id} (size {self.action_space_size}). State: {state}")
+    def add_batch(self, agent_idx, states, actions, rewards, next_states):
+        """批量写入一步中所有智能体的经验，满了之后覆盖最旧的数据"""
+        n = len(agent_idx)
+        if n == 0:
             return
-
-        state_str = self._state_to_string(state)
-        next_state_str = self._state_to_string(next_state)
-
-        # Ensure next state entry exists
-        if len(self.q_table[next_state_str]) != self.action_space_size:
-             self.q_table[next_state_str] = np.zeros(self.action_space_size)
-
-        old_value = self.q_table[state_str][action_index]
-        next_max = np.max(self.q_table[next_state_str])
-
-        # Q-learning formula
-        new_value = old_value + self.lr * (reward + self.gamma * next_max - old_value)
-        self.q_table[state_str][action_index] = new_value
-
-    def _state_to_string(self, state):
-        """Convert state dictionary to a hashable string."""
-        if not isinstance(state, dict): return str(state)
-        items = sorted(state.items())
-        return str(items)
-
-    def load_q_table(self, file_path):
-        """Load Q-table from a file."""
-        if os.path.exists(file_path):
-            try:
-                with open(file_path, 'rb') as f:
-                    loaded_q_dict = pickle.load(f)
-                    self.q_table = defaultdict(lambda: np.zeros(self.action_space_size))
-                    for state_key, q_values in loaded_q_dict.items():
-                        if len(q_values) == self.action_space_size:
-                            self.q_table[state_key] = np.array(q_values)
-                        else:
-                            logger.warning(f"Size mismatch loading Q-table for agent {self.agent_id}, state {state_key}. Skipping state.")
-                logger.info(f"Q-table loaded for agent {self.agent_id} from {file_path}")
-            except Exception as e:
-                logger.error(f"Error loading Q-table for agent {self.agent_id} from {file_path}: {e}", exc_info=True)
-        else:
-            logger.warning(f"Q-table file not found for agent {self.agent_id} at {file_path}.")
-
-    def save_q_table(self, file_path):
-        """Save Q-table to a file."""
-        try:
-            os.makedirs(os.path.dirname(file_path), exist_ok=True)
-            with open(file_path, 'wb') as f:
-                # Convert defaultdict to regular dict for saving
-                q_dict_to_save = dict(self.q_table)
-                pickle.dump(q_dict_to_save, f)
-            logger.info(f"Q-table saved for agent {self.agent_id} to {file_path}")
-        except Exception as e:
-             logger.error(f"Error saving Q-table for agent {self.agent_id} to {file_path}: {e}", exc_info=True)
+        if n > self.capacity:
+            agent_idx, states, actions, rewards, next_states = (
+                agent_idx[-self.capacity:], states[-self.capacity:], actions[-self.capacity:],
+                rewards[-self.capacity:], next_states[-self.capacity:])
+            n = self.capacity
+        slots = (self.position + np.arange(n)) % self.capacity
+        self.agent_idx[slots] = agent_idx
+        self.states[slots] = states
+        self.actions[slots] = actions
+        self.rewards[slots] = rewards
+        self.next_states[slots] = next_states
+        self.position = (self.position + n) % self.capacity
+        self.size = min(self.size + n, self.capacity)
+
+    def sample(self, batch_size):
+        """均匀随机采样，返回各字段数组组成的 dict"""
+        idx = self.rng.integers(0, self.size, size=min(batch_size, self.size))
+        return {
+            "agent_idx": self.agent_idx[idx],
+            "states": self.states[idx],
+            "actions": self.actions[idx],
+            "rewards": self.rewards[idx],
+            "next_states": self.next_states[idx],
+        }
 
 
 # --- Helper Functions for MARL (Remain associated with MARL logic) ---
@@ -119,128 +80,375 @@ def get_agent_state(charger_id, global_state, agent_state_params):
     if not global_state or 'chargers' not in global_state:
         logger.warning(f"Cannot get agent state for {charger_id}. Invalid global_state.")
         return {}
+    if not any(isinstance(c, dict) and c.get('charger_id') == charger_id for c in global_state.get('chargers', [])):
+        return {}
+    # 单个充电桩也走批量实现，保证与 build_agent_states 的特征完全一致
+    vector = build_agent_states(global_state, [charger_id], agent_state_params)[0]
+    return {name: int(value) for name, value in zip(AGENT_STATE_FEATURES, vector)}
+
+def build_agent_states(global_state, charger_ids, agent_state_params):
+    """
+    get_agent_state 的批量版本: 一次计算所有充电桩智能体的离散状态。
 
-    charger = next((c for c in global_state.get('chargers', []) if c['charger_id'] == charger_id), None)
-    if not charger: return {}
+    Returns:
+        np.ndarray: (len(charger_ids), len(AGENT_STATE_FEATURES)) 整数特征，找不到的充电桩为全 0
+    """
+    states = np.zeros((len(charger_ids), len(AGENT_STATE_FEATURES)), dtype=np.int64)
+    if not global_state or 'chargers' not in global_state or not charger_ids:
+        return states
+
+    chargers_by_id = {c.get('charger_id'): c for c in global_state.get('chargers', []) if isinstance(c, dict)}
+    found = np.array([cid in chargers_by_id for cid in charger_ids], dtype=bool)
+    chargers = [chargers_by_id.get(cid, {}) for cid in charger_ids]
 
-    # State Features from config or defaults
     status_map = agent_state_params.get('status_map', {'available': 0, 'occupied': 1, 'failure': 2})
-    charger_status = status_map.get(charger.get('status', 'available'), 0)
-    
-    max_queue_repr = agent_state_params.get('max_queue_state_representation', 3)
-    queue_length = min(len(charger.get('queue', [])), max_queue_repr)
-    
-    hour_discretization = agent_state_params.get('hour_discretization_factor', 4)
+    states[:, 0] = [status_map.get(c.get('status', 'available'), 0) for c in chargers]
+    states[:, 1] = np.minimum([len(c.get('queue', [])) for c in chargers], agent_state_params.get('max_queue_state_representation', 3))
+
     hour_of_day = 0
     try:
         timestamp_str = global_state.get('timestamp')
         if timestamp_str: hour_of_day = datetime.fromisoformat(timestamp_str).hour
-    except: pass 
-    discrete_hour = hour_of_day // hour_discretization
+    except (TypeError, ValueError): pass
+    states[:, 2] = hour_of_day // agent_state_params.get('hour_discretization_factor', 4)
 
+    # 电网特征对所有智能体相同
     grid_status = global_state.get('grid_status', {})
     grid_load_percentage = grid_status.get('grid_load_percentage', 50)
     renewable_ratio = grid_status.get('renewable_ratio', 0)
+    grid_load_cats = agent_state_params.get('grid_load_categories', [80, 60])
+    renewable_cats = agent_state_params.get('renewable_categories', [50, 20])
+    states[:, 3] = 2 if grid_load_percentage > grid_load_cats[0] else 1 if grid_load_percentage > grid_load_cats[1] else 0
+    states[:, 4] = 2 if renewable_ratio > renewable_cats[0] else 1 if renewable_ratio > renewable_cats[1] else 0
+
+    # Nearby Demand: 半径内 (经纬度平方距离) 需要充电且未在充电/排队的用户数
+    demand_soc_threshold = agent_state_params.get('nearby_demand_soc_threshold', 40)
+    demand_users = [
+        u for u in global_state.get('users', [])
+        if isinstance(u, dict) and u.get('soc', 100) < demand_soc_threshold and u.get('status') not in ['charging', 'waiting']
+    ]
+    counts = _nearby_demand_counts(
+        positions_to_array(chargers), positions_to_array(demand_users, 'current_position'),
+        agent_state_params.get('nearby_demand_radius_sq_degrees', 0.05**2))
+    states[:, 5] = np.minimum(counts, agent_state_params.get('max_nearby_demand_state_representation', 2))
+
+    states[~found] = 0
+    return states
+
+
+def _nearby_demand_counts(charger_pos, user_pos, radius_sq, chunk_size=1024):
+    """每个充电桩半径内 (严格小于) 的用户数; 有 scipy 时用 KD 树，否则按充电桩分块做 numpy 广播"""
+    counts = np.zeros(len(charger_pos), dtype=np.int64)
+    user_pos = user_pos[~np.isnan(user_pos).any(axis=1)]
+    valid_chargers = np.flatnonzero(~np.isnan(charger_pos).any(axis=1))
+    if len(user_pos) == 0 or len(valid_chargers) == 0 or radius_sq <= 0:
+        return counts
+
+    if HAS_SCIPY:
+        # query_ball_point 包含边界，取略小于半径的值以保持 "dist_sq < radius_sq" 的语义
+        radius = np.nextafter(math.sqrt(radius_sq), 0)
+        counts[valid_chargers] = cKDTree(user_pos).query_ball_point(charger_pos[valid_chargers], r=radius, return_length=True)
+        return counts
+
+    for start in range(0, len(valid_chargers), chunk_size):
+        rows = valid_chargers[start:start + chunk_size]
+        diff = charger_pos[rows, None, :] - user_pos[None, :, :]
+        counts[rows] = ((diff ** 2).sum(axis=2) < radius_sq).sum(axis=1)
+    return counts
+
+def build_action_maps(state, marl_config, charger_ids=None):
+    """
+    批量构建 MARL 动作映射: 一次算出所有寻求充电的用户，对每个充电桩取范围内优先级最高的
+    action_space_size-1 个用户 (有 scipy 时用 KD 树取半径内的用户，否则分块计算平方距离矩阵)。
+
+    Args:
+        state (dict): 当前环境状态
+        marl_config (dict): config['scheduler']['marl_config']
+        charger_ids (list): 只为这些充电桩构建；缺省为所有空闲 (非 occupied/failure) 的充电桩
+
+    Returns:
+        tuple: ({charger_id: {"map": {0: 'idle', 1: user_id, ...}, "size": action_space_size}}, 寻求充电的用户数)
+    """
+    candidate_params = marl_config.get('candidate_selection_params', {})
+    action_space_size = marl_config.get("action_space_size", 6)
+    max_potential_users = action_space_size - 1
+    max_distance_sq = marl_config.get("marl_candidate_max_dist_sq", 0.15**2)
+    w_soc = marl_config.get("marl_priority_w_soc", 0.5)
+    w_dist = marl_config.get("marl_priority_w_dist", 0.4)
+    w_urgency = marl_config.get("marl_priority_w_urgency", 0.1)
+    base_soc_trigger = candidate_params.get('base_soc_threshold', 40)
+    profile_soc_adjustments = candidate_params.get('profile_soc_adjustments', {})
+
+    chargers = [c for c in state.get('chargers', []) if isinstance(c, dict) and c.get('charger_id')]
+    if charger_ids is not None:
+        wanted = set(charger_ids)
+        chargers = [c for c in chargers if c['charger_id'] in wanted]
+    else:
+        chargers = [c for c in chargers if c.get('status') not in ['occupied', 'failure']]
+    action_maps = {c['charger_id']: {"map": {0: 'idle'}, "size": action_space_size} for c in chargers}
+    # 故障充电桩只有 idle 动作
+    chargers = [c for c in chargers if c.get('status') != 'failure']
+
+    # --- 筛选主动寻求充电的用户 (向量化) ---
+    users = [u for u in state.get('users', []) if isinstance(u, dict) and u.get('user_id')]
+    socs = np.array([u.get('soc', 100) for u in users], dtype=float)
+    thresholds = np.maximum(5, base_soc_trigger + np.array(
+        [profile_soc_adjustments.get(u.get('user_profile', 'flexible'), 0) for u in users], dtype=float))
+    statuses = np.array([u.get('status', 'unknown') for u in users], dtype=object)
+    needs_flags = np.array([bool(u.get('needs_charge_decision', False)) for u in users], dtype=bool)
+    no_target = np.array([u.get('target_charger') is None for u in users], dtype=bool)
+    # 1. 用户明确标记需要决策；2. 用户空闲或随机旅行，且电量低于阈值
+    seeking = (needs_flags & ~np.isin(statuses, ['charging', 'waiting'])) | \
+              (np.isin(statuses, ['idle', 'traveling']) & no_target & (socs < thresholds))
+    seeking_idx = np.flatnonzero(seeking)
+    if not chargers or len(seeking_idx) == 0 or max_potential_users <= 0:
+        return action_maps, len(seeking_idx)
+
+    user_ids = [users[i]['user_id'] for i in seeking_idx]
+    user_pos = positions_to_array([users[i] for i in seeking_idx], 'current_position')
+    seek_socs, seek_thresholds = socs[seeking_idx], thresholds[seeking_idx]
+    urgency = np.where(seek_thresholds > 0, np.maximum(0, seek_thresholds - seek_socs) / seek_thresholds, 0.0)
+    base_priority = w_soc * (1.0 - seek_socs / 100.0) + w_urgency * urgency
+    charger_pos = positions_to_array(chargers)
+    max_distance = math.sqrt(max_distance_sq) if max_distance_sq > 0 else 0.0
+    k = min(max_potential_users, len(user_ids))
+
+    ranked = None
+    if HAS_SCIPY and max_distance > 0:
+        ranked = _ranked_users_kdtree(charger_pos, user_pos, base_priority, w_dist, max_distance_sq, k)
+    if ranked is None:
+        ranked = _ranked_users_dense(charger_pos, user_pos, base_priority, w_dist, max_distance_sq, k)
+    for charger, (user_cols, user_priorities) in zip(chargers, ranked):
+        action_map = action_maps[charger['charger_id']]["map"]
+        for rank, (col, user_priority) in enumerate(zip(user_cols, user_priorities)):
+            if not np.isfinite(user_priority):
+                break
+            action_map[rank + 1] = user_ids[col]
+
+    return action_maps, len(seeking_idx)
+
+
+def _candidate_priority(dist_sq, base_priority, w_dist, max_distance_sq):
+    """候选优先级 = 用户基础优先级 + 距离分；不在 marl_candidate_max_dist_sq 范围内为 -inf"""
+    max_distance = math.sqrt(max_distance_sq) if max_distance_sq > 0 else 0.0
+    with np.errstate(invalid='ignore'):
+        in_range = dist_sq < max_distance_sq
+        normalized_distance = np.minimum(1.0, np.sqrt(dist_sq) / max_distance) if max_distance > 0 else 0.0
+    return np.where(in_range, base_priority + w_dist * (1.0 - normalized_distance), -np.inf)
+
+
+def _ranked_users_kdtree(charger_pos, user_pos, base_priority, w_dist, max_distance_sq, k, max_pair_fraction=0.05):
+    """
+    每个充电桩范围内优先级最高的 k 个用户 (同分按用户原有顺序)，返回逐个充电桩的 [(用户列号, 优先级)]。
+    范围外的用户优先级为 -inf，所以只需用两棵 KD 树取出半径内的 (充电桩, 用户) 对再排序，不必构造
+    (充电桩 × 用户) 矩阵。优先级还含用户自身的 SOC/紧急度，不能只取最近的 k 个用户。
+    半径覆盖了大部分用户 (范围内的对数超过 max_pair_fraction) 时稀疏表示没有收益，返回 None 交给分块矩阵计算。
+    """
+    valid_users = np.flatnonzero(~np.isnan(user_pos).any(axis=1))
+    valid_chargers = np.flatnonzero(~np.isnan(charger_pos).any(axis=1))
+    if len(valid_users) == 0 or len(valid_chargers) == 0:
+        return [(np.zeros(0, dtype=int), np.zeros(0))] * len(charger_pos)
+    charger_tree, user_tree = cKDTree(charger_pos[valid_chargers]), cKDTree(user_pos[valid_users])
+    # 树查询包含边界，严格小于的判断交给 _candidate_priority
+    radius = math.sqrt(max_distance_sq)
+    if charger_tree.count_neighbors(user_tree, radius) > max_pair_fraction * len(valid_chargers) * len(valid_users):
+        return None
+    pairs = charger_tree.sparse_distance_matrix(user_tree, radius, output_type='ndarray')
+    rows, cols = valid_chargers[pairs['i']], valid_users[pairs['j']]
+    dist_sq = ((charger_pos[rows] - user_pos[cols]) ** 2).sum(axis=1)
+    priority = _candidate_priority(dist_sq, base_priority[cols], w_dist, max_distance_sq)
+    order = np.lexsort((cols, -priority, rows))
+    rows, cols, priority = rows[order], cols[order], priority[order]
+    bounds = np.searchsorted(rows, np.arange(len(charger_pos) + 1))
+    return [
+        (cols[bounds[row]:min(bounds[row] + k, bounds[row + 1])], priority[bounds[row]:min(bounds[row] + k, bounds[row + 1])])
+        for row in range(len(charger_pos))
+    ]
+
+
+def _ranked_users_dense(charger_pos, user_pos, base_priority, w_dist, max_distance_sq, k, chunk_size_cells=2_000_000):
+    """_ranked_users_kdtree 的 numpy 版本 (无 scipy 时): 按充电桩分块计算 (充电桩 × 用户) 平方距离矩阵"""
+    num_users = len(user_pos)
+    chunk_size = max(1, chunk_size_cells // max(1, num_users))
+    for start in range(0, len(charger_pos), chunk_size):
+        rows = slice(start, start + chunk_size)
+        diff = charger_pos[rows, None, :] - user_pos[None, :, :]
+        priority = _candidate_priority((diff ** 2).sum(axis=2), base_priority[None, :], w_dist, max_distance_sq)
+
+        # 每行取优先级最高的 k 个 (同分按用户原有顺序)
+        if k < num_users:
+            top = np.argpartition(-priority, k - 1, axis=1)[:, :k]
+        else:
+            top = np.broadcast_to(np.arange(num_users), (priority.shape[0], num_users))
+        top_priority = np.take_along_axis(priority, top, axis=1)
+        order = np.lexsort((top, -top_priority))
+        yield from zip(np.take_along_axis(top, order, axis=1), np.take_along_axis(top_priority, order, axis=1))
+
+
+def convert_actions_to_decisions(agent_actions, state, charger_action_maps):
+    """
+    将 MARL 智能体选择的动作 {charger_id: action_index}
+    转换为充电分配决策 {user_id: charger_id}。
+    """
+    decisions = {}
+    conflicts = 0
+    assigned_users = set() # 跟踪已分配用户，防止重复
+    existing_user_ids = {u.get('user_id') for u in state.get('users', []) if isinstance(u, dict)}
+
+    if not isinstance(agent_actions, dict):
+         logger.error(f"_convert_marl_actions_to_decisions received invalid agent_actions type: {type(agent_actions)}")
+         return {}
+
+    logger.debug(f"Converting MARL actions: {agent_actions}")
+
+    # 遍历每个充电站智能体选择的动作
+    for charger_id, action_index in agent_actions.items():
+        # Action 0 总是表示'idle'(不分配)
+        if action_index == 0:
+            # logger.debug(f"Charger {charger_id} chose 'idle' (action 0)")
+            continue
+
+        # --- 使用预生成的动作映射 ---
+        map_data = charger_action_maps.get(charger_id)
+        if not map_data:
+            logger.warning(f"No pre-generated action map found for charger {charger_id}. Cannot convert action {action_index}. Skipping.")
+            continue
+        action_map = map_data.get("map")
+        if not action_map:
+            logger.warning(f"Invalid action map data for charger {charger_id}. Skipping.")
+            continue
+
+        # 在提供的映射中查找对应于所选 action_index 的 user_id
+        user_id_to_assign = action_map.get(action_index)
+
+        if user_id_to_assign and user_id_to_assign != 'idle':
+            # 检查这个用户是否已经被另一个充电站分配
+            if user_id_to_assign not in assigned_users:
+                # 验证用户是否仍然存在于状态中 (可选但更健壮)
+                if user_id_to_assign in existing_user_ids:
+                    decisions[user_id_to_assign] = charger_id
+                    assigned_users.add(user_id_to_assign)
+                    logger.debug(f"MARL decision: Assign user {user_id_to_assign} to charger {charger_id} (from action index {action_index})")
+                else:
+                     logger.warning(f"MARL action {action_index} mapped to user {user_id_to_assign} but user not found in current state. Skipping.")
+            else:
+                # 冲突: 用户已被分配。记录日志。
+                # 多个充电桩的动作映射共享候选用户，冲突很常见，只在汇总日志中计数
+                conflicts += 1
+                logger.debug(f"MARL conflict: User {user_id_to_assign} was already assigned. Charger {charger_id} also selected this user (action index {action_index}). Ignoring second assignment.")
+        else:
+            # 所选动作索引可能不对应任何用户
+            logger.debug(f"Charger {charger_id} chose action index {action_index}, but no valid user found in its action map: {action_map}")
+
+    # --- 可选的应急分配逻辑 ---
+    # (如果需要，可以从原 app.py 复制粘贴应急分配逻辑到这里)
+    # if not decisions and active_count > 20: ...
+
+    if not decisions:
+        logger.warning("MARL action conversion resulted in zero assignments.")
+    else:
+        logger.info(f"Converted MARL actions to {len(decisions)} assignments ({conflicts} conflicting selections ignored).")
+    return decisions
 
-    grid_load_cats = agent_state_params.get('grid_load_categories', [80, 60]) # [high, medium]
-    grid_load_cat = 0
-    if grid_load_percentage > grid_load_cats[0]: grid_load_cat = 2
-    elif grid_load_percentage > grid_load_cats[1]: grid_load_cat = 1
-
-    renewable_cats = agent_state_params.get('renewable_categories', [50, 20]) # [high, medium]
-    renew_cat = 0
-    if renewable_ratio > renewable_cats[0]: renew_cat = 2
-    elif renewable_ratio > renewable_cats[1]: renew_cat = 1
-
-    # Nearby Demand
-    users_needing_charge = 0
-    charger_pos = charger.get('position', {'lat': 0, 'lng': 0})
-    nearby_radius_sq_deg = agent_state_params.get('nearby_demand_radius_sq_degrees', 0.05**2)
-    
-    # Assuming a simple SOC threshold for "needing charge" for this state feature
-    # This is distinct from the scheduler's user filtering for action map generation
-    demand_soc_threshold = agent_state_params.get('nearby_demand_soc_threshold', 40) 
-
-    for user in global_state.get('users', []):
-        if user.get('soc', 100) < demand_soc_threshold and user.get('status') not in ['charging', 'waiting']:
-             user_pos = user.get('current_position', {'lat': -999, 'lng': -999})
-             if isinstance(user_pos.get('lat'), (float, int)) and isinstance(charger_pos.get('lat'), (float, int)): # Basic check
-                 dist_sq = (user_pos['lat'] - charger_pos['lat'])**2 + (user_pos['lng'] - charger_pos['lng'])**2
-                 if dist_sq < nearby_radius_sq_deg:
-                     users_needing_charge += 1
-    
-    max_demand_repr = agent_state_params.get('max_nearby_demand_state_representation', 2)
-    nearby_demand_cat = min(users_needing_charge, max_demand_repr)
-
-    state = {
-        "status": charger_status,
-        "queue": queue_length,
-        "hour_discrete": discrete_hour,
-        "grid_load_cat": grid_load_cat,
-        "renew_cat": renew_cat,
-        "nearby_demand_cat": nearby_demand_cat
-    }
-    return state
-
-# Note: The `create_dynamic_action_map` function used by MARL is now defined
-# within the `ChargingScheduler` class in `simulation/scheduler.py` because
-# it might need access to the scheduler's config or state more easily.
-# If you prefer it here, you'll need to pass `config` to it.
-
-def calculate_agent_reward(charger_id, action_taken, global_state, previous_state, agent_reward_params):
-    """Calculates the reward for a charger agent using config parameters."""
-    reward = 0.0
-    if not global_state or not previous_state or \
-       'chargers' not in global_state or 'chargers' not in previous_state:
-        return 0.0
-
-    charger = next((c for c in global_state.get('chargers', []) if c.get('charger_id') == charger_id), None)
-    prev_charger = next((c for c in previous_state.get('chargers', []) if c.get('charger_id') == charger_id), None)
-    if not charger or not prev_charger: return 0.0
+
+def agent_state_vector(agent_state):
+    """把 get_agent_state 返回的 dict 转为按 AGENT_STATE_FEATURES 排列的整数元组"""
+    return tuple(int(agent_state.get(name, 0)) for name in AGENT_STATE_FEATURES)
+
+
+def snapshot_charger_status(state, charger_ids):
+    """复制充电桩的 status/current_user。environment 在 step 中原地修改充电桩 dict，计算奖励前需先保存"""
+    chargers_by_id = {c.get('charger_id'): c for c in state.get('chargers', []) if isinstance(c, dict)}
+    status = np.array([chargers_by_id.get(cid, {}).get('status', 'unknown') for cid in charger_ids], dtype=object)
+    current_user = np.array([chargers_by_id.get(cid, {}).get('current_user') for cid in charger_ids], dtype=object)
+    return {"status": status, "current_user": current_user}
+
+
+def calculate_agent_rewards(action_names, previous_snapshot, current_snapshot, global_state, agent_reward_params):
+    """
+    一次计算一步中所有智能体的奖励 (分配成功、峰谷时段、可再生能源、空闲和故障惩罚)。
+
+    Args:
+        action_names (np.ndarray): 各智能体执行的动作 ('idle' 或 user_id)
+        previous_snapshot / current_snapshot (dict): snapshot_charger_status 的结果 (step 前 / step 后)
+        global_state (dict): step 后的环境状态 (读取电网状态和时间)
+        agent_reward_params (dict): 奖励参数
+
+    Returns:
+        np.ndarray: 各智能体的奖励
+    """
+    action_names = np.asarray(action_names, dtype=object)
+    prev_status = previous_snapshot["status"]
+    status = current_snapshot["status"]
+    rewards = np.zeros(len(action_names), dtype=float)
+    if len(action_names) == 0:
+        return rewards
 
     grid_status = global_state.get('grid_status', {})
-    current_price = grid_status.get('current_price', 0.8) # Base electricity price
+    current_price = grid_status.get('current_price', 0.8)
     hour = 0
     try:
         if global_state.get('timestamp'): hour = datetime.fromisoformat(global_state['timestamp']).hour
-    except: pass
+    except (TypeError, ValueError): pass
+
+    is_idle = action_names == 'idle'
+    occupied = status == 'occupied'
 
     # 1. Successful Assignment Reward
-    assignment_base_factor = agent_reward_params.get('assignment_success_base_factor', 0.7)
-    if action_taken != 'idle' and charger.get('status') == 'occupied' and \
-       charger.get('current_user') == action_taken and prev_charger.get('status') == 'available':
-        reward += current_price * assignment_base_factor
-
-    # 2. Grid Friendliness Reward/Penalty
-    if charger.get('status') == 'occupied':
-        peak_hours = grid_status.get('peak_hours', []) # Assume these come from grid_status or main config
-        valley_hours = grid_status.get('valley_hours', [])
-        renewable_ratio = grid_status.get('renewable_ratio', 0)
-        
-        if hour in peak_hours: reward += agent_reward_params.get('peak_hour_penalty', -0.6)
-        elif hour in valley_hours: reward += agent_reward_params.get('valley_hour_reward', 0.4)
-        
-        high_renew_thresh = agent_reward_params.get('high_renewable_threshold', 60)
-        if renewable_ratio > high_renew_thresh: # Percentage
-            reward += agent_reward_params.get('high_renewable_reward', 0.25)
+    assigned = ~is_idle & occupied & (current_snapshot["current_user"] == action_names) & (prev_status == 'available')
+    rewards += np.where(assigned, current_price * agent_reward_params.get('assignment_success_base_factor', 0.7), 0.0)
+
+    # 2. Grid Friendliness Reward/Penalty (只与时间/电网有关，对所有占用中的充电桩相同)
+    occupied_bonus = 0.0
+    if hour in grid_status.get('peak_hours', []): occupied_bonus += agent_reward_params.get('peak_hour_penalty', -0.6)
+    elif hour in grid_status.get('valley_hours', []): occupied_bonus += agent_reward_params.get('valley_hour_reward', 0.4)
+    if grid_status.get('renewable_ratio', 0) > agent_reward_params.get('high_renewable_threshold', 60):
+        occupied_bonus += agent_reward_params.get('high_renewable_reward', 0.25)
+    rewards += np.where(occupied, occupied_bonus, 0.0)
 
     # 3. Idle Penalty
-    idle_penalty_load_thresh = agent_reward_params.get('idle_penalty_grid_load_threshold', 70)
-    if action_taken == 'idle' and prev_charger.get('status') == 'available': # Corrected: was `action_taken != 'idle'`
-         grid_load_percentage = grid_status.get('grid_load_percentage', 50)
-         if grid_load_percentage < idle_penalty_load_thresh:
-            reward += agent_reward_params.get('idle_penalty', -0.15)
+    if grid_status.get('grid_load_percentage', 50) < agent_reward_params.get('idle_penalty_grid_load_threshold', 70):
+        rewards += np.where(is_idle & (prev_status == 'available'), agent_reward_params.get('idle_penalty', -0.15), 0.0)
 
     # 4. Failure Penalty
-    if charger.get('status') == 'failure' and prev_charger.get('status') != 'failure':
-        reward += agent_reward_params.get('failure_penalty', -3.0)
-
-    # 5. Queue Management Reward (Optional)
-    # Small reward for keeping queue short?
-    # queue_length = len(charger.get("queue", []))
-    # if queue_length < 2: reward += 0.05
-
-    return float(reward)
+    rewards += np.where((status == 'failure') & (prev_status != 'failure'), agent_reward_params.get('failure_penalty', -3.0), 0.0)
+    return rewards
+
+
+class StateEncoder:
+    """
+    把 get_agent_state 的离散特征按混合进制编码为整数 0 .. num_states-1，作为稠密 Q 表的行号。
+    各特征的基数由 agent_state_params 决定，第一个特征 (status) 为最高位。
+    """
+
+    def __init__(self, agent_state_params=None):
+        params = agent_state_params if agent_state_params is not None else {}
+        status_map = params.get('status_map', {'available': 0, 'occupied': 1, 'failure': 2})
+        hour_factor = max(1, params.get('hour_discretization_factor', 4))
+        self.radices = np.array([
+            max(status_map.values(), default=0) + 1,
+            params.get('max_queue_state_representation', 3) + 1,
+            -(-24 // hour_factor),
+            3,  # grid_load_cat
+            3,  # renew_cat
+            params.get('max_nearby_demand_state_representation', 2) + 1,
+        ], dtype=np.int64)
+        self.multipliers = np.append(np.cumprod(self.radices[:0:-1])[::-1], 1)
+        self.num_states = int(np.prod(self.radices))
+
+    def encode(self, state_vectors):
+        """(n, len(AGENT_STATE_FEATURES)) 整数特征 -> (n,) 状态编号，越界的特征值截断到合法范围"""
+        vectors = np.asarray(state_vectors, dtype=np.int64).reshape(-1, len(self.radices))
+        return np.clip(vectors, 0, self.radices - 1) @ self.multipliers
+
+    def decode(self, codes):
+        """状态编号 -> (n, len(AGENT_STATE_FEATURES)) 整数特征"""
+        return (np.asarray(codes, dtype=np.int64)[:, None] // self.multipliers) % self.radices
+
+    def encode_state_key(self, state_key):
+        """旧版 Q 表的字符串键 (str(sorted(state.items()))) -> 状态编号"""
+        state = dict(ast.literal_eval(state_key))
+        return int(self.encode([agent_state_vector(state)])[0])
 
 
 # --- MARLSystem Class ---
@@ -253,216 +461,291 @@ class MARLSystem:
         self.gamma = discount_factor
         self.epsilon = exploration_rate
         self.q_table_path = q_table_path
-        # Use MARLAgent instances
-        self.agents = {f"CHARGER_{i+1:04d}": MARLAgent(f"CHARGER_{i+1:04d}", action_space_size, learning_rate, discount_factor, exploration_rate)
-                       for i in range(num_chargers)}
-        logger.info(f"MARLSystem initialized with {len(self.agents)} agents.")
+
+        # 所有智能体共享一个稠密 Q 表: (智能体 × 状态编号 × 动作)，float32
+        # 智能体按环境中实际的 charger_id 依次登记 (环境使用 "charger_N"，不能预先假定 ID 格式)
+        self.state_encoder = StateEncoder(self.marl_config.get('agent_state_params', {}))
+        self.agent_ids = []
+        self.agent_index = {}
+        self.q_values = np.zeros((max(1, num_chargers), self.state_encoder.num_states, action_space_size), dtype=np.float32)
+
+        # 经验回放与批量 Q 更新
+        training_params = self.marl_config.get('training_params', {})
+        self.rng = np.random.default_rng(training_params.get('seed'))
+        self.replay_buffer = ReplayBuffer(training_params.get('replay_capacity', 50000), seed=training_params.get('seed'))
+        self.batch_size = training_params.get('batch_size', 256)
+        self.updates_per_step = training_params.get('updates_per_step', 4)
+        self.min_replay_size = training_params.get('min_replay_size', 256)
+        self.training_stats = {"transitions": 0, "q_updates": 0, "train_time_s": 0.0}
+        self._pending_step = None
+
+        logger.info(f"MARLSystem initialized: Q array {self.q_values.shape} ({self.q_values.nbytes / 1e6:.1f} MB).")
         self.load_q_tables() # Load Q-tables for all agents
 
-    def choose_actions(self, state):
-        """Get actions from all agents."""
-        all_actions = {}
-        chargers = state.get('chargers', [])
+    def register_agents(self, charger_ids):
+        """登记新出现的充电桩并返回它们的智能体下标；超出预分配容量时扩展 Q 表"""
+        for charger_id in charger_ids:
+            if charger_id not in self.agent_index:
+                self.agent_index[charger_id] = len(self.agent_ids)
+                self.agent_ids.append(charger_id)
+        if len(self.agent_ids) > self.q_values.shape[0]:
+            extra = np.zeros((len(self.agent_ids) - self.q_values.shape[0],) + self.q_values.shape[1:], dtype=np.float32)
+            self.q_values = np.concatenate([self.q_values, extra])
+            logger.info(f"MARL Q array grown to {self.q_values.shape[0]} agents.")
+        return np.array([self.agent_index[cid] for cid in charger_ids], dtype=np.int64)
+
+    def encode_states(self, state, charger_ids):
+        """计算各充电桩智能体的状态编号"""
+        return self.state_encoder.encode(build_agent_states(state, charger_ids, self.marl_config.get('agent_state_params', {})))
+
+    def choose_actions(self, state, action_maps=None):
+        """
+        Get actions from all agents (一次向量化的 epsilon-greedy)。
+
+        Args:
+            state (dict): 当前环境状态
+            action_maps (dict): {charger_id: {action_index: 'idle' 或 user_id}}，缺省时只有 idle 动作
+
+        Returns:
+            dict: {charger_id: action_index}
+        """
+        chargers = [c for c in state.get('chargers', []) if isinstance(c, dict) and c.get('charger_id')]
         logger.info(f"MARL choose_actions called for {len(chargers)} chargers")
-
-        active_agents = 0
-        idle_agents = 0
-
-        # Need to pre-calculate action maps if agents need them (depends on MARLAgent.choose_action signature)
-        # Assuming MARLAgent needs the action map passed to it.
-        # We need the SCHEDULER's config here to get the action map generation parameters.
-        # This is a bit awkward. A better design might pass the config into choose_actions.
-        # WORKAROUND: Assume scheduler config is accessible somehow or use defaults.
-        # OR: The action map logic should be internal to MARLAgent or MARLSystem.
-        # Let's assume the action map is generated *outside* and passed if needed.
-        # For now, let's assume MARLAgent can get its valid actions internally based on state.
-        # If not, the `ChargingScheduler._create_dynamic_action_map` needs to be called here.
-
-        for charger in chargers:
-             charger_id = charger.get('charger_id')
-             agent = self.agents.get(charger_id)
-             if not agent:
-                  logger.warning(f"No MARL agent found for charger {charger_id}. Skipping.")
-                  continue
-
-             if charger.get('status') in ['occupied', 'failure']:
-                 # Agent is busy or failed, default action might be 'idle' (index 0)
-                 all_actions[charger_id] = 0 # Let's represent 'no action needed' as 0
-                 idle_agents += 1
-                 continue
-            
-             agent_state_params = self.marl_config.get('agent_state_params', {})
-             agent_state = get_agent_state(charger_id, state, agent_state_params)
-
-             # --- How to get valid actions? ---
-             # The action map is generated by ChargingScheduler._create_dynamic_action_map
-             # and should be passed to this function or used before calling this.
-             # For now, assuming choose_action in MARLAgent will use a map passed to it.
-             # The current MARLAgent.choose_action takes `current_action_map`.
-             # This map needs to be provided here.
-             # This part is complex as the map generation is in ChargingScheduler.
-             # For this refactoring, we focus on get_agent_state and calculate_agent_reward using config.
-             # The choose_actions method's direct config use is minimal here, beyond calling get_agent_state.
-             # We'll use a placeholder for current_action_map as it's outside current direct refactor scope of this function.
-             _current_action_map_placeholder = {0: 'idle'} # This needs to be properly passed from scheduler
-             
-             # OPTION 1: Assume MARLAgent.choose_action handles it (needs state only)
-             # action, action_index = agent.choose_action(agent_state, ?) # Problem: Needs action map
-
-             # OPTION 2: Generate action map here (Requires config/scheduler logic)
-             # This implies MARLSystem needs access to the scheduler's config or the function itself.
-             # Let's simulate calling the function (assuming it exists globally or is passed)
-             try:
-                 # We need the config here! Assuming it's accessible globally or passed.
-                 # If this MARLSystem instance doesn't have config, this will fail.
-                 # It's better if ChargingScheduler calls this map creation.
-                 # See updated logic in simulation/scheduler.py where map creation happens *before* choose_actions.
-                 # Here, we'll just pass an empty map for structure.
-                 _temp_map = {0:'idle'} # Placeholder - Actual map generated in scheduler
-                 _chosen_action_name, action_index = agent.choose_action(agent_state, _temp_map)
-                 all_actions[charger_id] = action_index
-                 active_agents += 1
-             except Exception as e:
-                 logger.error(f"Error choosing action for agent {charger_id}: {e}", exc_info=True)
-                 all_actions[charger_id] = 0 # Default to idle on error
-                 idle_agents += 1
-
-
-        logger.info(f"MARL actions chosen: {active_agents} active agents, {idle_agents} idle/failed.")
+        if not chargers:
+            self._pending_step = None
+            return {}
+        action_maps = action_maps if action_maps is not None else {}
+
+        charger_ids = [c['charger_id'] for c in chargers]
+        agent_idx = self.register_agents(charger_ids)
+        state_codes = self.encode_states(state, charger_ids)
+        # Agent is busy or failed -> 'no action needed' is represented as 0
+        busy = np.array([c.get('status') in ['occupied', 'failure'] for c in chargers], dtype=bool)
+
+        valid = np.zeros((len(chargers), self.action_space_size), dtype=bool)
+        valid[:, 0] = True
+        for i, charger_id in enumerate(charger_ids):
+            if busy[i]:
+                continue
+            indices = [idx for idx in action_maps.get(charger_id, {}) if 0 <= idx < self.action_space_size]
+            valid[i, indices] = True
+
+        # Exploit: 合法动作中 Q 最大者，并列时随机选一个；Explore: 合法动作中均匀随机
+        q = self.q_values[agent_idx, state_codes]
+        masked_q = np.where(valid, q, -np.inf)
+        best = valid & (masked_q == masked_q.max(axis=1, keepdims=True))
+        tie_break = self.rng.random(valid.shape)
+        greedy_actions = np.argmax(np.where(best, tie_break, -1.0), axis=1)
+        random_actions = np.argmax(np.where(valid, tie_break, -1.0), axis=1)
+        explore = self.rng.random(len(chargers)) < self.epsilon
+        action_indices = np.where(busy, 0, np.where(explore, random_actions, greedy_actions))
+
+        action_names = np.array([
+            action_maps.get(cid, {}).get(int(idx), 'idle') if idx else 'idle'
+            for cid, idx in zip(charger_ids, action_indices)
+        ], dtype=object)
+
+        # 记录本步的 (state, action)，在 observe_outcome 中与 step 后的状态组成经验
+        self._pending_step = {
+            "charger_ids": charger_ids,
+            "agent_idx": agent_idx,
+            "states": state_codes,
+            "actions": action_indices,
+            "action_names": action_names,
+            "snapshot": snapshot_charger_status(state, charger_ids),
+        }
+
+        logger.info(f"MARL actions chosen: {int((~busy).sum())} active agents, {int(busy.sum())} idle/failed.")
         # Returns a dict of {charger_id: action_index}
-        return all_actions
-
+        return {cid: int(idx) for cid, idx in zip(charger_ids, action_indices)}
+
+    def observe_outcome(self, next_state):
+        """
+        用 step 后的状态补全上一次 choose_actions 的经验: 向量化计算奖励、写入回放缓冲区，
+        然后做 updates_per_step 次批量 Q 更新。
+
+        Returns:
+            dict: 本步经验数、平均奖励和 Q 更新次数
+        """
+        pending = self._pending_step
+        self._pending_step = None
+        if pending is None or not pending["charger_ids"]:
+            return {"transitions": 0, "mean_reward": 0.0, "q_updates": 0}
+
+        start = time.perf_counter()
+        agent_reward_params = self.marl_config.get('agent_reward_params', {})
+        charger_ids = pending["charger_ids"]
+        next_codes = self.encode_states(next_state, charger_ids)
+        rewards = calculate_agent_rewards(
+            pending["action_names"], pending["snapshot"], snapshot_charger_status(next_state, charger_ids),
+            next_state, agent_reward_params)
+        self.replay_buffer.add_batch(pending["agent_idx"], pending["states"], pending["actions"], rewards, next_codes)
+        q_updates = self.learn_from_replay()
+
+        self.training_stats["transitions"] += len(charger_ids)
+        self.training_stats["train_time_s"] += time.perf_counter() - start
+        return {"transitions": len(charger_ids), "mean_reward": float(rewards.mean()), "q_updates": q_updates}
+
+    def learn_from_replay(self, num_batches=None):
+        """从回放缓冲区采样并做批量 Q 更新 (目标值用更新前的 Q 表计算)，返回更新的经验条数"""
+        if len(self.replay_buffer) < self.min_replay_size:
+            return 0
+        num_batches = self.updates_per_step if num_batches is None else num_batches
+        q_updates = 0
+        for _ in range(num_batches):
+            batch = self.replay_buffer.sample(self.batch_size)
+            agents, states, actions = batch["agent_idx"], batch["states"], batch["actions"]
+            targets = batch["rewards"] + self.gamma * self.q_values[agents, batch["next_states"]].max(axis=1)
+            td_errors = targets - self.q_values[agents, states, actions]
+            # 同一 (智能体, 状态, 动作) 在一个批次中出现多次时增量累加
+            np.add.at(self.q_values, (agents, states, actions), (self.lr * td_errors).astype(np.float32))
+            q_updates += len(agents)
+        self.training_stats["q_updates"] += q_updates
+        return q_updates
+
+    def training_throughput(self):
+        """训练吞吐统计 (transitions/sec 按经验构造 + Q 更新的耗时计算)"""
+        stats = dict(self.training_stats)
+        stats["transitions_per_sec"] = stats["transitions"] / stats["train_time_s"] if stats["train_time_s"] > 0 else 0.0
+        stats["replay_size"] = len(self.replay_buffer)
+        return stats
 
     def update_q_tables(self, state, actions, rewards, next_state):
-        """Update Q-tables for all agents based on experience."""
-        # This 'rewards' might be the global reward dict. We need agent-specific rewards.
-        if not state or not actions or not next_state:
-            logger.warning("MARL update_q_tables received empty data. Skipping.")
+        """
+        Update Q-tables for all agents based on experience.
+
+        经验的 (state, action) 部分来自上一次 choose_actions (state 中的充电桩会被 environment.step
+        原地修改，不能事后重算)，这里只需要 step 后的 next_state；actions/rewards 参数保留以兼容旧接口。
+        """
+        if self._pending_step is None:
+            logger.warning("MARL update_q_tables called without a preceding choose_actions. Skipping.")
             return
-
-        logger.debug(f"Updating MARL Q-tables for {len(actions)} actions.")
-        update_count = 0
-
-        # Calculate agent-specific rewards *before* updating
-        agent_rewards = {}
-        previous_state_for_reward = state # Assuming 'state' is the state *before* actions were taken
-        current_state_for_reward = next_state # Assuming 'next_state' is the state *after* actions were taken
-
-        for charger_id, action_index in actions.items():
-             # Find the action name (e.g., 'idle' or user_id) if needed by reward function
-             # This requires the action_map from the time the action was chosen.
-             # This highlights the complexity - state/action/reward alignment is crucial.
-             # Let's assume `calculate_agent_reward` works with action_index or the decision.
-             # The `actions` dict here likely contains the *decision* (user_id or None/idle)
-             # rather than the raw action_index chosen by the agent.
-             # We need clarity on what `actions` represents here.
-             # Assuming `actions` is the *decision* dict {user_id: charger_id} returned by scheduler
-
-             # Let's REVERSE the mapping to get {charger_id: user_id_or_idle}
-             charger_actions_taken = defaultdict(lambda: 'idle') # Default to idle
-             for user_id, assigned_charger_id in actions.items():
-                  charger_actions_taken[assigned_charger_id] = user_id
-
-             # Now calculate reward for each charger based on what it *did*
-             for charger_id_reward_calc, action_name in charger_actions_taken.items():
-                  agent_rewards[charger_id_reward_calc] = calculate_agent_reward(
-                       charger_id_reward_calc,
-                       action_name, # Pass 'idle' or the user_id assigned
-                       current_state_for_reward, # State AFTER action
-                       previous_state_for_reward # State BEFORE action
-                  )
-
-        # Now update agents using the calculated specific rewards
-        # We need the original {charger_id: action_index} mapping here!
-        # This structure is problematic. `actions` should ideally be the raw {charger_id: action_index}.
-        # Let's assume `actions` IS {charger_id: action_index} for the update logic.
-
-        if isinstance(actions, dict): 
-            for charger_id, action_index in actions.items():
-                agent = self.agents.get(charger_id)
-                if not agent: continue
-
-                current_agent_state = get_agent_state(charger_id, state, agent_state_params)
-                next_agent_state = get_agent_state(charger_id, next_state, agent_state_params)
-                reward = agent_rewards.get(charger_id, 0) 
-
-                agent.update_q_table(current_agent_state, action_index, reward, next_agent_state)
-                update_count += 1
-                # Optional: Log significant updates
-                # ...
-
-        if update_count > 0: logger.debug(f"Updated Q-values for {update_count} agents.")
-
+        if not next_state:
+            logger.warning("MARL update_q_tables received empty next_state. Skipping.")
+            self._pending_step = None
+            return
+        result = self.observe_outcome(next_state)
+        if result["q_updates"] > 0: logger.debug(f"Updated Q-values from {result['q_updates']} replayed transitions.")
+
+    def decide(self, state_view, context=None):
+        """
+        算法注册表的统一接口: 构建动作映射 → 选择动作 → 转换为决策。
+        选择的 (state, action) 保留到 update_q_tables/observe_outcome，用于训练。
+        """
+        charger_action_maps, seeking_user_count = build_action_maps(state_view, self.marl_config)
+        marl_actions = self.choose_actions(state_view, {cid: data["map"] for cid, data in charger_action_maps.items()})
+        decisions = convert_actions_to_decisions(marl_actions, state_view, charger_action_maps)
+        return decisions, {"candidate_user_count": seeking_user_count}
+
+    def _array_paths(self):
+        """Q 数组 (.npy) 与智能体/编码元数据 (.json) 的路径"""
+        base = os.path.splitext(self.q_table_path)[0] if os.path.splitext(self.q_table_path)[1] else self.q_table_path
+        return base + ".npy", base + ".meta.json"
 
     def load_q_tables(self):
-        """Load Q-tables for all agents."""
-        logger.info(f"Loading Q-tables for {len(self.agents)} agents from path: {self.q_table_path}")
-        num_loaded = 0
-        # If path points to a single file containing all tables:
-        if self.q_table_path and os.path.exists(self.q_table_path) and os.path.isfile(self.q_table_path):
-             try:
-                 with open(self.q_table_path, 'rb') as f:
-                     all_q_tables = pickle.load(f)
-                     if isinstance(all_q_tables, dict):
-                          for agent_id, agent in self.agents.items():
-                              if agent_id in all_q_tables:
-                                   # Convert loaded dict back to defaultdict
-                                   loaded_agent_q = all_q_tables[agent_id]
-                                   agent.q_table = defaultdict(lambda: np.zeros(agent.action_space_size))
-                                   for state_key, q_values in loaded_agent_q.items():
-                                        if len(q_values) == agent.action_space_size:
-                                             agent.q_table[state_key] = np.array(q_values)
-                                        else:
-                                            logger.warning(f"Size mismatch loading Q-table for agent {agent_id}, state {state_key}. Skipping.")
-                                   num_loaded += 1
-                          logger.info(f"Loaded Q-tables for {num_loaded} agents from single file {self.q_table_path}")
-                     else:
-                          logger.error(f"Invalid format in Q-table file {self.q_table_path}. Expected dict.")
-             except Exception as e:
-                 logger.error(f"Error loading Q-tables from {self.q_table_path}: {e}", exc_info=True)
-        # If path points to a directory (load individual files)
-        elif self.q_table_path and os.path.isdir(self.q_table_path):
-             for agent_id, agent in self.agents.items():
-                  agent_file = os.path.join(self.q_table_path, f"{agent_id}_q_table.pkl")
-                  agent.load_q_table(agent_file) # Use agent's own load method
-                  if os.path.exists(agent_file): num_loaded +=1
-             logger.info(f"Attempted to load Q-tables for {len(self.agents)} agents from directory {self.q_table_path}. Found {num_loaded} files.")
-        else:
-             logger.warning(f"Q-table path '{self.q_table_path}' not found or invalid. Agents starting with empty Q-tables.")
+        """Load Q-tables: 优先读取 .npy 稠密数组，不存在时兼容旧版 pickle (单文件或目录)"""
+        if not self.q_table_path:
+            logger.warning("Q-table path not set. Agents starting with empty Q-tables.")
+            return
+        array_path, meta_path = self._array_paths()
+        legacy_file = os.path.splitext(self.q_table_path)[0] + ".pkl"
 
+        if os.path.isfile(array_path) and os.path.isfile(meta_path):
+            try:
+                with open(meta_path, 'r', encoding='utf-8') as f:
+                    meta = json.load(f)
+                loaded = np.load(array_path)
+                if loaded.shape[1:] != self.q_values.shape[1:] or meta.get("radices") != self.state_encoder.radices.tolist():
+                    logger.error(f"Q array {array_path} has shape {loaded.shape} / radices {meta.get('radices')}, "
+                                 f"expected {self.q_values.shape[1:]} / {self.state_encoder.radices.tolist()}. Ignoring it.")
+                    return
+                agent_ids = meta.get("agent_ids", [])[:loaded.shape[0]]
+                # 先登记 (可能扩展并替换 self.q_values)，再写入扩展后的数组
+                rows = self.register_agents(agent_ids)
+                self.q_values[rows] = loaded[:len(agent_ids)]
+                logger.info(f"Loaded Q array for {len(agent_ids)} agents from {array_path}")
+            except Exception as e:
+                logger.error(f"Error loading Q array from {array_path}: {e}", exc_info=True)
+        elif os.path.isfile(legacy_file):
+            try:
+                with open(legacy_file, 'rb') as f:
+                    all_q_tables = pickle.load(f)
+                if isinstance(all_q_tables, dict):
+                    for agent_id, agent_q in all_q_tables.items():
+                        self._import_legacy_q_table(agent_id, agent_q)
+                    logger.info(f"Converted legacy Q-tables for {len(all_q_tables)} agents from {legacy_file}")
+                else:
+                    logger.error(f"Invalid format in Q-table file {legacy_file}. Expected dict.")
+            except Exception as e:
+                logger.error(f"Error loading Q-tables from {legacy_file}: {e}", exc_info=True)
+        elif os.path.isdir(self.q_table_path):
+            # 旧版按智能体分文件保存的目录
+            num_loaded = 0
+            for name in sorted(os.listdir(self.q_table_path)):
+                if not name.endswith("_q_table.pkl"):
+                    continue
+                try:
+                    with open(os.path.join(self.q_table_path, name), 'rb') as f:
+                        self._import_legacy_q_table(name[:-len("_q_table.pkl")], pickle.load(f))
+                    num_loaded += 1
+                except Exception as e:
+                    logger.error(f"Error loading Q-table file {name}: {e}", exc_info=True)
+            logger.info(f"Converted legacy Q-tables for {num_loaded} agents from directory {self.q_table_path}")
+        else:
+            logger.warning(f"Q-table path '{self.q_table_path}' not found or invalid. Agents starting with empty Q-tables.")
+
+    def _import_legacy_q_table(self, agent_id, agent_q):
+        """旧版 {state_key: q_values} -> 稠密 Q 表中该智能体的行"""
+        row = self.register_agents([agent_id])[0]
+        for state_key, q_values in agent_q.items():
+            if len(q_values) != self.action_space_size:
+                logger.warning(f"Size mismatch loading Q-table for agent {agent_id}, state {state_key}. Skipping.")
+                continue
+            try:
+                self.q_values[row, self.state_encoder.encode_state_key(state_key)] = q_values
+            except (ValueError, SyntaxError):
+                logger.warning(f"Unrecognised state key '{state_key}' for agent {agent_id}. Skipping.")
 
     def save_q_tables(self):
-        """Save Q-tables for all agents."""
-        logger.info(f"Saving Q-tables for {len(self.agents)} agents to path: {self.q_table_path}")
+        """Save Q-tables: 所有智能体的 Q 值保存为一个 .npy 文件，智能体顺序与编码参数保存在 .meta.json"""
         if not self.q_table_path:
             logger.error("Cannot save Q-tables: q_table_path is not set.")
             return
+        array_path, meta_path = self._array_paths()
+        try:
+            q_table_dir = os.path.dirname(array_path)
+            if q_table_dir: os.makedirs(q_table_dir, exist_ok=True)
+            np.save(array_path, self.q_values[:len(self.agent_ids)])
+            with open(meta_path, 'w', encoding='utf-8') as f:
+                json.dump({
+                    "agent_ids": self.agent_ids,
+                    "features": list(AGENT_STATE_FEATURES),
+                    "radices": self.state_encoder.radices.tolist(),
+                    "action_space_size": self.action_space_size,
+                }, f, indent=2)
+            logger.info(f"Saved Q array ({len(self.agent_ids)} agents) to {array_path}")
+        except Exception as e:
+            logger.error(f"Error saving Q-tables to {array_path}: {e}", exc_info=True)
+
+def create_algorithm(config):
+    """算法注册表工厂: 按 config['scheduler']['marl_config'] 创建 MARLSystem"""
+    env_config = config.get("environment", {})
+    marl_config = config.get("scheduler", {}).get("marl_config", {})
+    # 获取充电桩数量，处理可能的缺失 (只用于预分配 Q 表，智能体按实际充电桩登记)
+    num_chargers = env_config.get("charger_count")
+    if num_chargers is None:
+        num_chargers = env_config.get("station_count", 20) * env_config.get("chargers_per_station", 10)
+        logger.warning(f"env_config['charger_count'] not found, calculated as {num_chargers}")
+    return MARLSystem(
+        num_chargers=num_chargers,
+        action_space_size=marl_config.get("action_space_size", 6),
+        learning_rate=marl_config.get("learning_rate", 0.01),
+        discount_factor=marl_config.get("discount_factor", 0.95),
+        exploration_rate=marl_config.get("exploration_rate", 0.1),
+        q_table_path=marl_config.get("q_table_path", None),
+        marl_config=marl_config,
+    )
 
-        # Option 1: Save all tables to a single file
-        if not os.path.splitext(self.q_table_path)[1]: # Check if it looks like a directory path
-             # Assume directory saving
-             os.makedirs(self.q_table_path, exist_ok=True)
-             num_saved = 0
-             for agent_id, agent in self.agents.items():
-                  agent_file = os.path.join(self.q_table_path, f"{agent_id}_q_table.pkl")
-                  agent.save_q_table(agent_file)
-                  num_saved +=1
-             logger.info(f"Saved Q-tables for {num_saved} agents to directory {self.q_table_path}")
-        else:
-             # Assume single file saving
-             all_q_tables_to_save = {}
-             for agent_id, agent in self.agents.items():
-                  # Convert defaultdict to regular dict for saving
-                  all_q_tables_to_save[agent_id] = dict(agent.q_table)
-
-             try:
-                  q_table_dir = os.path.dirname(self.q_table_path)
-                  if q_table_dir: os.makedirs(q_table_dir, exist_ok=True)
-                  with open(self.q_table_path, 'wb') as f:
-                      pickle.dump(all_q_tables_to_save, f)
-                  logger.info(f"Saved all Q-tables ({len(all_q_tables_to_save)} agents) to single file {self.q_table_path}")
-             except Exception as e:
-                  logger.error(f"Error saving Q-tables to {self.q_table_path}: {e}", exc_info=True)
 
 # !! IMPORTANT: Removed the duplicated MultiAgentSystem and related classes below !!
 # class MultiAgentSystem: ... (REMOVED)
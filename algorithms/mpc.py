@@ -0,0 +1,265 @@
+# ev_charging_project/algorithms/mpc.py
+"""
+滚动时域 (MPC) 智能充电调度
+
+每步先由基础分配算法 (默认 rule_based) 决定 用户 → 充电桩 的分配，然后对正在充电的会话在未来 H 步上
+求解一个 "填谷" 二次规划，得到每个充电桩本步的功率设定值:
+
+    min  Σ_t (B_t + Σ_c p[c,t])²
+    s.t. 0 <= p[c,t] <= p_max[c]            (充电桩/车辆功率上限 × SOC 衰减)
+         p[c,t] = 0, t >= deadline[c]        (会话剩余时长，超时会话会被充电桩结束)
+         Σ_t p[c,t]·Δt = e[c]               (本会话剩余需要的电量，不可行时尽量多充)
+         Σ_c p[c,t] <= max_ev_fleet_load_kw  (电网偏好中的车队负载上限)
+
+B_t 是按电网预测 (各区域 base_load_profile 按容量份额加权) 换算到充电负载量纲的基础负载，
+可选加上 price_weight × 电价。目标只依赖总负载，按充电桩逐个 "注水" (water-filling) 做块坐标下降即可
+收敛到最优；上一步的计划平移一步作为热启动，通常 1~2 轮扫描就收敛。热启动计划按分片 (state["shard_key"]，
+不分片时为 None) 分别保存，仿真时间倒退 (环境重置) 时丢弃。扫描轮数受 max_sweeps 和
+本步决策时间预算 (context["deadline"]) 限制。
+
+结果放在 metadata["power_setpoints_kw"] = {charger_id: kW} 中，由充电桩模型作为本步功率上限执行。
+计划按电网侧实际功率 (已含 SOC 衰减) 求解；充电桩模型对 min(额定, 车辆, power_cap_kw) 再乘一次 SOC 衰减，
+所以下发的设定值换算回衰减前的口径 p / taper，保证实际充电功率等于计划值。
+"""
+
+import logging
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from algorithms.registry import AlgorithmRegistry
+from simulation.charger_model import MAX_CHARGING_MINUTES, soc_taper_factor
+
+logger = logging.getLogger(__name__)
+
+
+class MPCScheduler:
+    def __init__(self, config):
+        self.config = config
+        self.params = config.get('algorithms', {}).get('mpc', {})
+        self.horizon_steps = max(1, self.params.get('horizon_steps', 12))
+        self.max_sweeps = max(1, self.params.get('max_sweeps', 8))
+        self.tolerance_kw = self.params.get('tolerance_kw', 0.5)
+        self.price_weight = self.params.get('price_weight', 0.0)
+        self.warm_start = self.params.get('warm_start', True)
+        self.assignment_algorithm_name = self.params.get('assignment_algorithm', 'rule_based')
+        self.time_step_minutes = config.get('environment', {}).get('time_step_minutes', 15)
+        self.dt_hours = self.time_step_minutes / 60.0
+        self._assignment_registry = None
+        # 热启动: 每个分片上一步的计划 {shard_key: (起始时间, {charger_id: 功率数组})}
+        self._previous_plans = {}
+        self.last_stats = {}
+
+        if self.assignment_algorithm_name == 'mpc':
+            logger.warning("MPC: assignment_algorithm cannot be 'mpc', using rule_based.")
+            self.assignment_algorithm_name = 'rule_based'
+
+    def _assignment_algorithm(self):
+        if self._assignment_registry is None:
+            self._assignment_registry = AlgorithmRegistry(self.config)
+        return self._assignment_registry.get(self.assignment_algorithm_name)
+
+    def decide(self, state_view, context=None):
+        """算法注册表的统一接口"""
+        context = context if context is not None else {}
+        decisions, metadata = {}, {}
+        assignment_algorithm = self._assignment_algorithm()
+        if assignment_algorithm is not None:
+            decisions, metadata = assignment_algorithm.decide(state_view, context)
+            metadata = dict(metadata)
+        else:
+            logger.error(f"MPC: assignment algorithm '{self.assignment_algorithm_name}' unavailable, only planning power.")
+
+        grid_preferences = context.get("grid_preferences") or {}
+        setpoints = self.plan_power(state_view, grid_preferences.get("max_ev_fleet_load_mw"), context.get("deadline"))
+        metadata["power_setpoints_kw"] = setpoints
+        metadata["mpc"] = self.last_stats
+        metadata["assignment_algorithm"] = self.assignment_algorithm_name
+        return decisions, metadata
+
+    def plan_power(self, state, max_ev_fleet_load_mw=None, deadline=None):
+        """求解未来 H 步的功率计划，返回本步的功率设定值 {charger_id: kW}"""
+        start = time.perf_counter()
+        now = self._parse_time(state.get("timestamp"))
+        shard_key = state.get("shard_key")
+        sessions = self._active_sessions(state, now)
+        if not sessions:
+            self._previous_plans[shard_key] = (now, {})
+            self.last_stats = {"sessions": 0, "horizon_steps": self.horizon_steps, "solve_ms": 0.0}
+            return {}
+
+        charger_ids = [s["charger_id"] for s in sessions]
+        p_max = np.array([s["p_max"] for s in sessions])
+        taper = np.array([s["taper"] for s in sessions])
+        energy = np.array([s["energy_kwh"] for s in sessions])
+        steps_left = np.array([s["steps_left"] for s in sessions])
+        horizon = np.arange(self.horizon_steps)
+        # upper[c, t]: 会话在 t 步仍在进行时的功率上限
+        upper = np.where(horizon[None, :] < steps_left[:, None], p_max[:, None], 0.0)
+        energy = np.minimum(energy, upper.sum(axis=1) * self.dt_hours)
+
+        fleet_limit_kw = np.inf
+        if max_ev_fleet_load_mw is not None and max_ev_fleet_load_mw < float('inf'):
+            fleet_limit_kw = max_ev_fleet_load_mw * 1000.0
+
+        base = self._base_load_forecast(state, now)
+        plan, warm_started = self._initial_plan(charger_ids, upper, energy, now, shard_key)
+        total = plan.sum(axis=0)
+        sweeps = 0
+        max_change = 0.0
+        for sweeps in range(1, self.max_sweeps + 1):
+            max_change = 0.0
+            for c in range(len(charger_ids)):
+                others = total - plan[c]
+                cap = np.minimum(upper[c], np.maximum(fleet_limit_kw - others, 0.0))
+                new_row = _water_fill(base + others, cap, energy[c] / self.dt_hours)
+                max_change = max(max_change, float(np.abs(new_row - plan[c]).max()))
+                plan[c] = new_row
+                total = others + new_row
+            if max_change <= self.tolerance_kw or (deadline is not None and deadline.expired()):
+                break
+
+        self._previous_plans[shard_key] = (now, dict(zip(charger_ids, plan)))
+        # 充电桩模型会再乘 SOC 衰减，设定值按衰减前的口径下发
+        setpoints = {cid: round(float(p), 3) for cid, p in zip(charger_ids, plan[:, 0] / taper)}
+        self.last_stats = {
+            "sessions": len(charger_ids),
+            "horizon_steps": self.horizon_steps,
+            "sweeps": sweeps,
+            "converged": max_change <= self.tolerance_kw,
+            "warm_started": warm_started,
+            "planned_ev_load_kw": round(float(total[0]), 2),
+            "planned_peak_ev_load_kw": round(float(total.max()), 2),
+            "unserved_energy_kwh": round(float(np.maximum(energy - plan.sum(axis=1) * self.dt_hours, 0).sum()), 3),
+            "solve_ms": round((time.perf_counter() - start) * 1000, 2),
+        }
+        logger.info(f"MPC: planned {len(charger_ids)} sessions over {self.horizon_steps} steps in {sweeps} sweeps "
+                    f"({self.last_stats['solve_ms']} ms), EV load now {self.last_stats['planned_ev_load_kw']} kW.")
+        return setpoints
+
+    def _parse_time(self, timestamp):
+        try:
+            return datetime.fromisoformat(timestamp) if timestamp else datetime.now()
+        except (ValueError, TypeError):
+            logger.warning(f"MPC: Invalid timestamp '{timestamp}'. Using current time.")
+            return datetime.now()
+
+    def _active_sessions(self, state, now):
+        """正在充电的会话: 功率上限、剩余电量 (电网侧 kWh) 和会话剩余步数"""
+        users_by_id = {u.get("user_id"): u for u in state.get("users", []) if isinstance(u, dict)}
+        sessions = []
+        for charger in state.get("chargers", []):
+            if not isinstance(charger, dict) or charger.get("status") != "occupied":
+                continue
+            user = users_by_id.get(charger.get("current_user"))
+            if user is None:
+                continue
+            soc = user.get("soc", 0)
+            target_soc = user.get("target_soc") or 95
+            efficiency = user.get("charging_efficiency", 0.92) or 0.92
+            energy_kwh = max(0.0, target_soc - soc) / 100.0 * user.get("battery_capacity", 60) / efficiency
+            taper = float(soc_taper_factor(soc))
+            p_max = min(charger.get("max_power", 60), user.get("max_charging_power", 60)) * taper
+
+            max_minutes = MAX_CHARGING_MINUTES.get(charger.get("type", "normal"), MAX_CHARGING_MINUTES["normal"])
+            start_time = charger.get("charging_start_time")
+            if isinstance(start_time, str):
+                start_time = self._parse_time(start_time)
+            elapsed = (now - start_time).total_seconds() / 60 if isinstance(start_time, datetime) else 0.0
+            steps_left = int(np.clip(np.ceil((max_minutes - elapsed) / self.time_step_minutes), 1, self.horizon_steps))
+            sessions.append({
+                "charger_id": charger["charger_id"],
+                "p_max": p_max,
+                "taper": taper,
+                "energy_kwh": energy_kwh,
+                "steps_left": steps_left,
+            })
+        return sessions
+
+    def _base_load_forecast(self, state, now):
+        """
+        未来 H 步的基础负载，换算到充电负载量纲。
+        电网模型按容量份额 s_r 把 (缩放后的) 车队负载分摊到各区域，Σ_r (base_r + s_r·k·P)² 对 P 的最优性条件
+        等价于压平 P + Σ_r s_r·base_r / (k·Σ_r s_r²)。
+        """
+        grid_status = state.get("grid_status", {})
+        profiles = grid_status.get("regional_profiles", {})
+        hours = [(now + timedelta(minutes=self.time_step_minutes * t)).hour for t in range(self.horizon_steps)]
+        capacities = np.array([p.get("system_capacity", 0) for p in profiles.values()], dtype=float)
+        base = np.zeros(self.horizon_steps)
+        if len(capacities) and capacities.sum() > 0:
+            shares = capacities / capacities.sum()
+            base_profiles = np.array([[p.get("base_load_profile", [0] * 24)[h % 24] for h in hours] for p in profiles.values()], dtype=float)
+            base = (shares[:, None] * base_profiles).sum(axis=0) / (self._ev_load_scale() * (shares ** 2).sum())
+
+        if self.price_weight:
+            peak_hours = grid_status.get("peak_hours", [])
+            valley_hours = grid_status.get("valley_hours", [])
+            prices = np.array([
+                grid_status.get("peak_price", 1.2) if h in peak_hours
+                else grid_status.get("valley_price", 0.4) if h in valley_hours
+                else grid_status.get("normal_price", 0.85)
+                for h in hours
+            ])
+            base = base + self.price_weight * prices
+        return base
+
+    def _ev_load_scale(self):
+        """充电桩模型按 1000 / user_count 缩放上报给电网的车队负载 (最大 10 倍)"""
+        user_count = self.config.get('environment', {}).get('user_count', 1000)
+        return min(1000 / user_count, 10.0) if user_count > 0 else 1.0
+
+    def _initial_plan(self, charger_ids, upper, energy, now, shard_key=None):
+        """热启动: 沿用本分片上一步的计划 (平移一步)；新会话先按尽快充满初始化"""
+        plan = np.zeros_like(upper)
+        previous_plan = {}
+        shift = 0
+        if self.warm_start and shard_key in self._previous_plans:
+            previous_time, previous_plan = self._previous_plans[shard_key]
+            shift = int(round((now - previous_time).total_seconds() / 60 / self.time_step_minutes))
+            if now < previous_time:
+                # 时间倒退 (环境重置): 旧计划属于上一次仿真，清空所有分片的热启动计划
+                logger.info(f"MPC: simulation time went back from {previous_time} to {now}, dropping warm-start plans.")
+                self._previous_plans = {}
+                previous_plan = {}
+            elif shift >= self.horizon_steps:
+                previous_plan = {}
+        warm_started = 0
+        for c, charger_id in enumerate(charger_ids):
+            previous = previous_plan.get(charger_id)
+            if previous is not None:
+                plan[c, :self.horizon_steps - shift] = previous[shift:]
+                warm_started += 1
+            else:
+                remaining = energy[c] / self.dt_hours
+                for t in range(self.horizon_steps):
+                    plan[c, t] = min(upper[c, t], remaining)
+                    remaining -= plan[c, t]
+        return np.minimum(plan, upper), warm_started
+
+
+def _water_fill(level, cap, target):
+    """
+    单个会话的最优响应: min Σ (level_t + p_t)²，0 <= p_t <= cap_t，Σ p_t = target。
+    解为 p_t = clip(ν - level_t, 0, cap_t)，ν 由分段线性函数在断点处的取值插值得到。
+    """
+    if target <= 0 or not np.any(cap > 0):
+        return np.zeros_like(cap)
+    if target >= cap.sum():
+        return cap.copy()
+    active = cap > 0
+    breakpoints = np.unique(np.concatenate([level[active], level[active] + cap[active]]))
+    filled = np.clip(breakpoints[:, None] - level[None, :], 0, cap[None, :]).sum(axis=1)
+    k = min(int(np.searchsorted(filled, target)), len(breakpoints) - 1)
+    if k == 0:
+        nu = breakpoints[0]
+    else:
+        lo, hi = filled[k - 1], filled[k]
+        nu = breakpoints[k - 1] + (breakpoints[k] - breakpoints[k - 1]) * (target - lo) / (hi - lo) if hi > lo else breakpoints[k]
+    return np.clip(nu - level, 0, cap)
+
+
+def create_algorithm(config):
+    """算法注册表工厂"""
+    return MPCScheduler(config)
@@ -0,0 +1,104 @@
+# ev_charging_project/algorithms/registry.py
+"""
+调度算法注册表
+
+算法以 "模块路径:工厂函数" 的形式登记 (类似 entry point)，第一次使用时才导入模块并创建实例，
+之后缓存复用。工厂函数签名为 factory(config)，返回的对象需提供统一接口:
+
+    decide(state_view, context) -> (decisions {user_id: charger_id}, metadata dict)
+
+context 中包含 manual_decisions、grid_preferences 等本步附加信息，
+以及本步的决策时间预算 deadline (algorithms/deadline.py)。
+可以通过 config['scheduler']['algorithm_registry'] 覆盖或增加算法，例如:
+
+    "algorithm_registry": {"my_algo": "my_package.my_module:create_algorithm"}
+"""
+
+import importlib
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ALGORITHMS = {
+    "rule_based": "algorithms.rule_based:create_algorithm",
+    "uncoordinated": "algorithms.uncoordinated:create_algorithm",
+    "coordinated_mas": "algorithms.coordinated_mas:create_algorithm",
+    "marl": "algorithms.marl:create_algorithm",
+    "mpc": "algorithms.mpc:create_algorithm",
+}
+
+
+class FunctionAlgorithm:
+    """把 schedule(state, config, manual_decisions, grid_preferences[, deadline]) 形式的模块函数包装为 decide 接口"""
+
+    def __init__(self, schedule_fn, config):
+        self.schedule_fn = schedule_fn
+        self.config = config
+
+    def decide(self, state_view, context=None):
+        context = context if context is not None else {}
+        kwargs = {}
+        if context.get("deadline") is not None:
+            kwargs["deadline"] = context["deadline"]
+        result = self.schedule_fn(state_view, self.config, context.get("manual_decisions"), context.get("grid_preferences"), **kwargs)
+        if isinstance(result, tuple) and len(result) == 2:
+            return result
+        return result, {}
+
+
+class AlgorithmRegistry:
+    """按名称懒加载并缓存调度算法实例 (线程安全，分片调度会并发调用 get)"""
+
+    def __init__(self, config, entry_points=None):
+        self.config = config
+        self.entry_points = dict(DEFAULT_ALGORITHMS)
+        self.entry_points.update(config.get("scheduler", {}).get("algorithm_registry", {}))
+        if entry_points:
+            self.entry_points.update(entry_points)
+        self._instances = {}
+        self._failed = set()
+        self._lock = threading.Lock()
+
+    def available(self):
+        """已登记的算法名称"""
+        return sorted(self.entry_points)
+
+    def is_registered(self, name):
+        return name in self.entry_points
+
+    def peek(self, name):
+        """返回已创建的实例，不触发加载"""
+        return self._instances.get(name)
+
+    def get(self, name):
+        """返回算法实例，首次调用时导入模块并通过工厂创建；失败返回 None (不重复尝试)"""
+        instance = self._instances.get(name)
+        if instance is not None or name in self._failed:
+            return instance
+        with self._lock:
+            if name in self._instances or name in self._failed:
+                return self._instances.get(name)
+            entry_point = self.entry_points.get(name)
+            if entry_point is None:
+                logger.error(f"Algorithm '{name}' is not registered. Available: {self.available()}")
+                return None
+            start = time.perf_counter()
+            try:
+                module_path, _, factory_name = entry_point.partition(":")
+                factory = getattr(importlib.import_module(module_path), factory_name or "create_algorithm")
+                instance = factory(self.config)
+            except Exception as e:
+                logger.error(f"Failed to load algorithm '{name}' from '{entry_point}': {e}", exc_info=True)
+                self._failed.add(name)
+                return None
+            self._instances[name] = instance
+            logger.info(f"Algorithm '{name}' loaded from '{entry_point}' in {(time.perf_counter() - start) * 1000:.1f} ms.")
+            return instance
+
+    def shutdown(self):
+        """释放实例持有的资源 (如线程池)"""
+        for instance in self._instances.values():
+            if hasattr(instance, "shutdown"):
+                instance.shutdown()
@@ -4,22 +4,31 @@ import math
 import random
 from datetime import datetime
 from collections import defaultdict
+
+import numpy as np
 try:
-    from simulation.utils import calculate_distance # 注意这里的导入路径
+    from simulation.utils import calculate_distance_matrix, positions_to_array # 注意这里的导入路径
 except ImportError:
-    logging.error("Could not import calculate_distance from simulation.utils in rule_based.py")
-    def calculate_distance(p1, p2): return 10.0 # Fallback
+    logging.error("Could not import distance helpers from simulation.utils in rule_based.py")
+    def positions_to_array(items, key='position'): return np.zeros((len(items), 2))
+    def calculate_distance_matrix(a, b): return np.full((len(a), len(b)), 10.0)
+from algorithms.assignment import ASSIGNMENT_MODES, DEFAULT_TIME_BUDGET_MS, solve_assignment, solve_auction, unassigned_with_capacity
+from algorithms.registry import FunctionAlgorithm
+from simulation.queue_estimator import QueueTimeEstimator
 
 logger = logging.getLogger(__name__)
 
 
-def schedule(state, config, manual_decisions=None, grid_preferences=None):
+def schedule(state, config, manual_decisions=None, grid_preferences=None, deadline=None, feature_cache=None):
     """
     基于规则的调度算法实现。
 
     Args:
         state (dict): 当前环境状态
         config (dict): 全局配置
+        deadline (Deadline): 本步决策时间预算 (可选)，耗尽时返回已有分配，其余候选用户记入 deferred_users
+        feature_cache (_ChargerFeatureCache): 跨步复用的充电桩特征 (可选)，按 state["dirty"] 只刷新变化的充电桩；
+            不传时每次调用按当前状态构建
 
     Returns:
         tuple: (调度决策 {user_id: charger_id}, 元数据 {str: any})
@@ -126,7 +135,9 @@ def schedule(state, config, manual_decisions=None, grid_preferences=None):
             urgency = min(1.0, max(0.0, urgency + (0.3 if needs_charge_flag else 0)))
             candidate_users.append((user_id, user, urgency, needs_charge_flag))
 
-    candidate_users.sort(key=lambda x: (-int(x[3]), -x[2]))
+    # 上一步因时间预算被推迟的用户优先处理，其次是明确需要充电的、紧急程度高的用户
+    deferred_ids = set(state.get("deferred_users", []))
+    candidate_users.sort(key=lambda x: (x[0] not in deferred_ids, -int(x[3]), -x[2]))
 
     # ... (Charger load calculation remains the same) ...
     charger_loads = defaultdict(int)
@@ -136,225 +147,385 @@ def schedule(state, config, manual_decisions=None, grid_preferences=None):
         charger_loads[cid] += len(charger.get("queue", []))
 
     # --- 为候选用户分配充电桩 ---
-    assigned_users = set()
-    num_assigned = 0
-    for user_id, user, urgency, needs_charge in candidate_users:
-        # ... (The entire loop for assigning chargers to users remains the same) ...
-        # ... (It calculates scores, finds the best charger, and adds to `decisions`) ...
-        if user_id in assigned_users: continue
-        best_charger_id = None
-        best_score = float('-inf')
-        user_pos = user.get("current_position", {})
-        available_chargers_with_dist = []
-        for cid, charger in charger_dict.items():
-            if charger.get("status") == "failure" or charger_loads.get(cid, 0) >= max_queue_len: continue
-            dist = calculate_distance(user_pos, charger.get("position", {}))
-            if dist != float('inf'): available_chargers_with_dist.append((cid, charger, dist))
-        
-        available_chargers_with_dist.sort(key=lambda x: x[2])
-        candidate_limit = rule_based_config.get("candidate_limit", 15)
-        nearby_chargers_to_consider = available_chargers_with_dist[:candidate_limit]
-
-        for charger_id, charger, distance in nearby_chargers_to_consider:
-            current_queue_len = charger_loads.get(charger_id, 0)
-            user_score = _calculate_user_satisfaction_score(user, charger, distance, current_queue_len, user_score_params)
-            profit_score = _calculate_operator_profit_score(user, charger, state, profit_score_params)
-            grid_score = _calculate_grid_friendliness_score(charger, state, grid_score_params)
-            
-            adjusted_weights = weights.copy()
-            # ... (weight adjustment logic) ...
-
-            combined_score = (user_score * adjusted_weights["user_satisfaction"] +
-                              profit_score * adjusted_weights["operator_profit"] +
-                              grid_score * adjusted_weights["grid_friendliness"])
-            
-            critical_need_bonus_config = rule_based_config.get('critical_need_bonus', {})
-            if user.get("soc", 100) < critical_need_bonus_config.get('soc_threshold', 40) or needs_charge:
-                combined_score += critical_need_bonus_config.get('bonus_value', 0.2)
-            
-            queue_penalty = rule_based_config.get("queue_penalty", 0.05)
-            penalized_score = combined_score - (current_queue_len * queue_penalty)
-
-            if penalized_score > best_score:
-                best_score = penalized_score
-                best_charger_id = charger_id
-
-        if best_charger_id:
-            if user_id not in assigned_users:
-                decisions[user_id] = best_charger_id
-                charger_loads[best_charger_id] += 1
-                assigned_users.add(user_id)
-                num_assigned += 1
+    # 评分按步批量计算: 电网/利润分量每个充电桩只算一次，用户分量为 用户×充电桩 矩阵。
+    # assignment_mode: "greedy" 按紧急程度顺序逐个分配；"min_cost" 对所有候选用户做一次最小费用匹配；
+    # "auction" 所有用户按轮同时出价、充电桩按紧急程度接受 (向量化，不依赖 scipy)。
+    charger_list = list(charger_dict.values())
+    charger_ids = [c["charger_id"] for c in charger_list]
+    operational = np.array([c.get("status") != "failure" for c in charger_list], dtype=bool)
+    loads = np.array([charger_loads.get(cid, 0) for cid in charger_ids], dtype=float)
+    candidate_limit = rule_based_config.get("candidate_limit", 15)
+    queue_penalty = rule_based_config.get("queue_penalty", 0.05)
+
+    if feature_cache is not None:
+        charger_features = feature_cache.refresh(charger_list, state.get("dirty"))
+    else:
+        charger_features = _ChargerFeatures(charger_list)
+    scores = _BatchedScorer(
+        [entry[1] for entry in candidate_users], charger_list, grid_status, current_hour,
+        weights, user_score_params, profit_score_params, grid_score_params, charger_features
+    )
+    # use_queue_estimates 开启时排队评分用到达时的预计等待 (environment 发布的 queue_estimates)，
+    # 默认关闭或没有估计时使用当前排队人数 (与原有评分一致)
+    queue_estimator = QueueTimeEstimator.from_snapshot(state.get("queue_estimates")) if rule_based_config.get("use_queue_estimates", False) else None
+    queue_wait = _QueueWait(loads, scores.distances, queue_estimator, charger_ids, rule_based_config.get("travel_minutes_per_km", 2.0))
+    critical_need_bonus_config = rule_based_config.get('critical_need_bonus', {})
+    user_socs = np.array([entry[1].get("soc", 100) for entry in candidate_users], dtype=float)
+    needs_flags = np.array([bool(entry[3]) for entry in candidate_users], dtype=bool)
+    need_bonus = np.where(
+        (user_socs < critical_need_bonus_config.get('soc_threshold', 40)) | needs_flags,
+        critical_need_bonus_config.get('bonus_value', 0.2), 0.0
+    )
+
+    assignment_mode = rule_based_config.get("assignment_mode", "greedy")
+    if assignment_mode not in ASSIGNMENT_MODES:
+        logger.warning(f"RuleBased: Unknown assignment_mode '{assignment_mode}', using greedy.")
+        assignment_mode = "greedy"
+    assignment_stats = {}
+    deferred_users = []
+    if assignment_mode in ("min_cost", "auction"):
+        # 批量分配: 候选桩按本步初始负载确定，排队位 k 的得分按负载 loads+k 计算
+        available = operational & (loads < max_queue_len)
+        user_candidates = [
+            _nearest_candidates(scores.distances[row], available, candidate_limit)
+            for row in range(len(candidate_users))
+        ]
+
+        def slot_score(rows, col, slot):
+            slot_load = queue_wait.effective_loads(rows, col, loads[col] + slot)
+            return scores.combined_scores(rows, col, slot_load) + need_bonus[rows] - slot_load * queue_penalty
+
+        capacity = np.where(operational, np.maximum(max_queue_len - loads, 0), 0).astype(int)
+        assignment_params = dict(rule_based_config.get("assignment_params", {}))
+        if deadline is not None and deadline.limited:
+            # 求解器超出预算时自身会退化 (贪心 / 返回已接受的出价)，这里只需要把单步剩余时间传进去
+            assignment_params["time_budget_ms"] = min(assignment_params.get("time_budget_ms", DEFAULT_TIME_BUDGET_MS), deadline.remaining_ms())
+        solver = solve_auction if assignment_mode == "auction" else solve_assignment
+        matched, assignment_stats = solver(user_candidates, capacity, slot_score, assignment_params)
+        for row, col in sorted(matched.items()):
+            decisions[candidate_users[row][0]] = charger_ids[col]
+            charger_loads[charger_ids[col]] += 1
+        num_assigned = len(matched)
+        if assignment_stats.get("stopped_early"):
+            # 求解器超出预算提前停止: 还有空位却没分配到的用户留到下一步，而不是当作 "无桩可分" 缓存
+            deferred_users = [candidate_users[row][0] for row in unassigned_with_capacity(user_candidates, capacity, matched)]
+    else:
+        num_assigned, deferred_users = _assign_greedy(candidate_users, scores, charger_ids, operational, loads, charger_loads,
+                                                      max_queue_len, candidate_limit, queue_penalty, need_bonus, decisions,
+                                                      deadline, queue_wait)
     
     # --- START OF FIX ---
     # 在函数的最后，创建元数据字典并返回元组
     metadata = {
-        "candidate_user_count": len(candidate_users)
+        "candidate_user_count": len(candidate_users),
+        "assignment_mode": assignment_mode,
+        "deferred_users": deferred_users,
     }
+    if assignment_stats:
+        metadata["assignment_stats"] = assignment_stats
     logger.info(f"RuleBased made {num_assigned} assignments for {len(candidate_users)} candidates.")
     
     # 确保返回的是一个包含两个元素的元组
     return decisions, metadata
     # --- END OF FIX ---
-# --- Scoring helper functions ---
-def _calculate_user_satisfaction_score(user, charger, distance, current_queue_len, params):
-    """Calculates user satisfaction score [-1, 1] using parameters from config."""
-    
-    # 1. Distance factor
-    dist_tiers = params.get('distance_tiers', [[2, 0.5, -0.1], [5, 0.3, -0.1], [10, 0.0, -0.05]])
-    # Make the base penalty less severe
-    dist_base_penalty = params.get('dist_base_penalty', -0.15) # Reduced from -0.25
-    distance_score = dist_base_penalty # Start with base penalty for long distances
-    for tier_max_dist, base_score, per_km_penalty in dist_tiers:
-        if distance < tier_max_dist:
-            distance_score = base_score - (distance - (dist_tiers[[i[0] for i in dist_tiers].index(tier_max_dist)-1][0] if [i[0] for i in dist_tiers].index(tier_max_dist) > 0 else 0) ) * per_km_penalty
-            break
-    else: # Executed if loop doesn't break (distance > last tier_max_dist)
-        last_tier_dist = dist_tiers[-1][0] if dist_tiers else 10
-        # Make the long-distance penalty factor less harsh
-        default_dist_factor = params.get('default_dist_factor', -0.015) # Reduced from -0.025
-        distance_score = max(-0.5, dist_base_penalty - (distance - last_tier_dist) * default_dist_factor)
-
-    # 2. Wait time factor
-    wait_time_tiers = params.get('wait_time_tiers', [[0, 0.5], [2, 0.3], [5, 0.1], [8, -0.1]])
-    default_wait_score = params.get('default_wait_score', -0.3)
-    wait_score = default_wait_score
-    for max_queue, score_val in wait_time_tiers:
-        if current_queue_len <= max_queue:
-            wait_score = score_val
-            break
-            
-    # 3. Power matching factor
-    charger_power = charger.get("max_power", 50)
-    user_type = user.get("user_type", "private")
-    user_soc = user.get("soc", 50)
-    urgency = max(0, (params.get('power_expected_base_soc_threshold', 40) - user_soc) / params.get('power_expected_base_soc_threshold', 40)) if user_soc < params.get('power_expected_base_soc_threshold', 40) else 0
-    
-    power_expected_base = params.get('power_expected_base', 20)
-    power_expected_urgency_factor = params.get('power_expected_urgency_factor', 30)
-    expected_power = power_expected_base + urgency * power_expected_urgency_factor
-    
-    profile_factors = params.get('power_expected_profile_factors', {})
-    expected_power *= profile_factors.get(user_type, 1.0)
-        
-    power_ratio = charger_power / expected_power if expected_power > 0 else 1.0
-    power_score_tiers = params.get('power_score_tiers', [[1.5, 0.4], [1.0, 0.3], [0.7, 0.1], [0.5, -0.1]])
-    default_power_score = params.get('default_power_score', -0.2)
-    power_score = default_power_score
-    for min_ratio, score_val in power_score_tiers:
-        if power_ratio >= min_ratio:
-            power_score = score_val
-            break
-
-    # 4. Price factor
-    price_multiplier = charger.get("price_multiplier", 1.0) # Lower is better for user
-    price_score_mult = params.get('price_score_multiplier', 0.5)
-    price_score_max_abs = params.get('price_score_max_abs', 0.3)
-    price_score = max(-price_score_max_abs, min(price_score_max_abs, (1.0 - price_multiplier) * price_score_mult))
-
-    # 5. Tiered Urgency/Risk Adjustment (previously Emergency SOC adjustment)
-    # This factor boosts the importance of distance and wait time for users with low SOC.
-    urgency_factor = 1.0
-    # Add a new tier for "at-risk" users (e.g., SOC < 40%)
-    urgency_soc_thresholds = params.get('emergency_soc_thresholds', [15, 25, 40]) # Added 40%
-    urgency_factors = params.get('emergency_factors', [1.6, 1.3, 1.1])          # Added 1.1 factor
-
-    if user_soc < urgency_soc_thresholds[0]: 
-        urgency_factor = urgency_factors[0] # Critical
-    elif user_soc < urgency_soc_thresholds[1]: 
-        urgency_factor = urgency_factors[1] # Emergency
-    elif user_soc < urgency_soc_thresholds[2]:
-        urgency_factor = urgency_factors[2] # At-risk
-
-    # Combine components
-    component_weights = params.get('component_weights', {"distance": 0.4, "wait_time": 0.3, "power": 0.15, "price": 0.15})
-    # Apply the urgency factor to time-sensitive components
-    satisfaction = (
-        distance_score * component_weights.get('distance', 0.4) * urgency_factor +
-        wait_score * component_weights.get('wait_time', 0.3) * urgency_factor +
-        power_score * component_weights.get('power', 0.15) +
-        price_score * component_weights.get('price', 0.15)
-    )
-    
-    # Final adjustments
-    # The config keys here might need updating to reflect the new "urgency" logic vs "emergency"
-    if urgency_factor > 1.0 and satisfaction < params.get('emergency_satisfaction_min_score_adjustment', -0.5):
-        satisfaction = max(params.get('emergency_satisfaction_min_score_adjustment', -0.5), satisfaction * params.get('emergency_satisfaction_adjustment_factor', 0.8))
-    
-    return max(-1.0, min(1.0, satisfaction))
-def _calculate_operator_profit_score(user, charger, state, params):
-    grid_status = state.get("grid_status", {})
-    current_price = grid_status.get("current_price", 0.85) # Base electricity price
-    user_soc = user.get("soc", 50)
-    
-    charge_needed_factor = (100 - user_soc) / 50.0 # Scale: more need = higher factor
-    charger_type = charger.get("type", "normal")
-    charger_price_multiplier = charger.get("price_multiplier", 1.0) # From charger's own settings
-    queue_length = len(charger.get("queue", []))
 
-    effective_price = current_price * charger_price_multiplier
-    score = effective_price # Base score
 
-    if charger_type == "fast": score *= params.get('fast_charger_multiplier', 1.15)
-    elif charger_type == "superfast": score *= params.get('superfast_charger_multiplier', 1.30)
+class RuleBasedAlgorithm(FunctionAlgorithm):
+    """
+    注册表中的 rule_based 实例: 在 schedule 之外持有充电桩特征缓存。
+    每个注册表各自创建实例 (分片调度时每个分片一个)，缓存不会被并发的分片共享。
+    """
 
-    score -= queue_length * params.get('queue_penalty_per_person', 0.15)
-    score *= (1 + charge_needed_factor * params.get('charge_needed_score_factor', 0.05))
+    def __init__(self, config):
+        super().__init__(schedule, config)
+        self.feature_cache = _ChargerFeatureCache()
 
-    norm_min = params.get('normalization_min_assumed_score', 0.5)
-    norm_max = params.get('normalization_max_assumed_score', 2.0)
-    normalized_score = (score - norm_min) / (norm_max - norm_min) if (norm_max - norm_min) != 0 else 0.5
-    final_score = 2 * normalized_score - 1
-    
-    return max(-1.0, min(1.0, final_score))
+    def decide(self, state_view, context=None):
+        context = context if context is not None else {}
+        return schedule(state_view, self.config, context.get("manual_decisions"), context.get("grid_preferences"),
+                        deadline=context.get("deadline"), feature_cache=self.feature_cache)
 
 
-def _calculate_grid_friendliness_score(charger, state, params):
-    grid_status = state.get("grid_status", {})
-    hour = datetime.fromisoformat(state.get('timestamp', '')).hour if state.get('timestamp') else datetime.now().hour
-    grid_load_percentage = grid_status.get("grid_load_percentage", 50)
-    renewable_ratio = grid_status.get("renewable_ratio", 0) / 100.0 if grid_status.get("renewable_ratio") is not None else 0.0
-    peak_hours = grid_status.get("peak_hours", []) # Consider sourcing from main config or grid_status
-    valley_hours = grid_status.get("valley_hours", [])
-    charger_max_power = charger.get("max_power", 50)
+def create_algorithm(config):
+    """算法注册表工厂"""
+    return RuleBasedAlgorithm(config)
 
-    # 1. Load score
-    load_tiers = params.get('load_score_tiers', [[30, 0.8, 0.0], [50, 0.5, -0.015], [70, 0.2, -0.01], [85, 0.0, -0.015]])
-    default_load_factor = params.get('default_load_factor', -0.01)
-    default_load_base_penalty = params.get('default_load_base_penalty', -0.225)
-    max_load_penalty = params.get('max_load_score_penalty', -0.5)
-    
-    load_score = default_load_base_penalty
-    for i, (threshold, base_score, factor) in enumerate(load_tiers):
-        if grid_load_percentage < threshold:
-            prev_threshold = load_tiers[i-1][0] if i > 0 else 0
-            load_score = base_score - (grid_load_percentage - prev_threshold) * factor
-            break
-    else: # Executed if grid_load_percentage >= last threshold
-        last_threshold = load_tiers[-1][0] if load_tiers else 85
-        load_score = max(max_load_penalty, default_load_base_penalty - (grid_load_percentage - last_threshold) * default_load_factor)
-
-    # 2. Renewable score
-    renewable_score = params.get('renewable_score_multiplier', 0.8) * renewable_ratio
-
-    # 3. Time score
-    time_scores = params.get('time_scores', {"peak": -0.3, "valley": 0.6, "shoulder": 0.2})
-    if hour in peak_hours: time_score = time_scores.get('peak', -0.3)
-    elif hour in valley_hours: time_score = time_scores.get('valley', 0.6)
-    else: time_score = time_scores.get('shoulder', 0.2)
-
-    # 4. Power penalty
-    power_penalty = 0
-    power_penalty_thresholds = params.get('power_penalty_thresholds', [150, 50])
-    power_penalties = params.get('power_penalties', [0.1, 0.05])
-    if charger_max_power > power_penalty_thresholds[0]: power_penalty = power_penalties[0]
-    elif charger_max_power > power_penalty_thresholds[1]: power_penalty = power_penalties[1]
-    
-    raw_score = load_score + renewable_score + time_score - power_penalty
-    
-    # Adjustments and clamping
-    if raw_score < 0: raw_score *= params.get('negative_score_adjustment_factor', 0.8)
-    else: raw_score = min(1.0, raw_score * params.get('positive_score_adjustment_factor', 1.1))
-        
-    final_score = max(params.get('final_score_min_clamp', -0.9), min(params.get('final_score_max_clamp', 1.0), raw_score))
-    return final_score
\ No newline at end of file
+
+def _nearest_candidates(dist_row, available, candidate_limit):
+    """返回最近的 candidate_limit 个可用充电桩下标 (距离相同时保持原顺序，与逐个排序的结果一致)"""
+    available_idx = np.flatnonzero(available & np.isfinite(dist_row))
+    if available_idx.size == 0 or candidate_limit <= 0:
+        return available_idx[:0]
+    available_dist = dist_row[available_idx]
+    if available_idx.size > candidate_limit:
+        kth_dist = np.partition(available_dist, candidate_limit - 1)[candidate_limit - 1]
+        within = available_dist <= kth_dist
+        available_idx, available_dist = available_idx[within], available_dist[within]
+    return available_idx[np.argsort(available_dist, kind='stable')[:candidate_limit]]
+
+
+def _assign_greedy(candidate_users, scores, charger_ids, operational, loads, charger_loads,
+                   max_queue_len, candidate_limit, queue_penalty, need_bonus, decisions, deadline=None, queue_wait=None):
+    """按紧急程度顺序逐个分配，每次选当前负载下得分最高的附近充电桩；预算耗尽时返回尚未处理的用户"""
+    assigned_users = set()
+    num_assigned = 0
+    for row, (user_id, user, urgency, needs_charge) in enumerate(candidate_users):
+        if deadline is not None and deadline.should_stop(row):
+            return num_assigned, [entry[0] for entry in candidate_users[row:] if entry[0] not in assigned_users]
+        if user_id in assigned_users: continue
+        nearby_idx = _nearest_candidates(scores.distances[row], operational & (loads < max_queue_len), candidate_limit)
+        if nearby_idx.size == 0:
+            continue
+
+        candidate_loads = loads[nearby_idx]
+        if queue_wait is not None:
+            candidate_loads = queue_wait.effective_loads(row, nearby_idx, candidate_loads)
+        penalized_scores = (scores.combined_scores(row, nearby_idx, candidate_loads)
+                            + need_bonus[row] - candidate_loads * queue_penalty)
+        # argmax 返回第一个最大值，与原先 "严格大于才替换" 的逐个比较一致
+        best_idx = nearby_idx[int(np.argmax(penalized_scores))]
+        best_charger_id = charger_ids[best_idx]
+
+        decisions[user_id] = best_charger_id
+        charger_loads[best_charger_id] += 1
+        loads[best_idx] += 1
+        assigned_users.add(user_id)
+        num_assigned += 1
+    return num_assigned, []
+
+
+class _QueueWait:
+    """
+    排队评分使用的 "等效排队人数": 到达时的预计等待 / 单次会话时长 + 本步新分配到该桩的人数。
+    未开启 use_queue_estimates 或没有 queue_estimates 时直接使用当前负载 (排队 + 正在充电)。
+    """
+
+    def __init__(self, loads, distances, estimator, charger_ids, travel_minutes_per_km):
+        self.initial_loads = loads.copy()
+        self.distances = distances
+        self.travel_minutes_per_km = travel_minutes_per_km
+        self.backlog = self.session = None
+        if estimator is not None:
+            self.backlog, session = estimator.wait_arrays(charger_ids)
+            self.session = np.maximum(session, 1e-6)
+
+    def effective_loads(self, rows, charger_idx, loads):
+        if self.backlog is None:
+            return loads
+        arrival_minutes = self.distances[rows, charger_idx] * self.travel_minutes_per_km
+        waiting = np.maximum(self.backlog[charger_idx] - arrival_minutes, 0) / self.session[charger_idx]
+        return waiting + (loads - self.initial_loads[charger_idx])
+
+
+# --- Batched scoring ---
+def _first_tier_scores(values, tiers, matches, default_score):
+    """逐元素选取第一个满足 matches(value, threshold) 的分档分数 (与标量版 for/break 逻辑一致)"""
+    result = np.full(np.shape(values), default_score, dtype=float)
+    unresolved = np.ones(np.shape(values), dtype=bool)
+    for threshold, score_val in tiers:
+        hit = unresolved & matches(values, threshold)
+        result[hit] = score_val
+        unresolved &= ~hit
+    return result
+
+
+class _ChargerFeatures:
+    """充电桩静态特征 (位置、最大功率、价格系数、类型) 的数组形式"""
+
+    def __init__(self, chargers):
+        self.positions = positions_to_array(chargers)
+        self.max_power = np.array([c.get("max_power", 50) for c in chargers], dtype=float)
+        self.price_multiplier = np.array([c.get("price_multiplier", 1.0) for c in chargers], dtype=float)
+        self.types = np.array([c.get("type", "normal") for c in chargers], dtype=object)
+
+    def update_row(self, i, charger):
+        self.positions[i] = positions_to_array([charger])[0]
+        self.max_power[i] = charger.get("max_power", 50)
+        self.price_multiplier[i] = charger.get("price_multiplier", 1.0)
+        self.types[i] = charger.get("type", "normal")
+
+
+class _ChargerFeatureCache:
+    """
+    充电桩特征的跨步缓存 (每个 RuleBasedAlgorithm 实例一个)。
+
+    充电桩集合不变、且 state["dirty"] 是紧接着上次刷新的增量 (step 相同或加一) 时，只重建 dirty 充电桩对应的行；
+    首步、环境重置、充电桩增减、漏掉某一步或没有 dirty 信息时整体重建。
+    environment 的 dirty 充电桩包含类型、最大功率和价格系数的变化；步与步之间修改这些参数需调用
+    environment.mark_chargers_dirty。
+    """
+
+    def __init__(self):
+        self.charger_ids = None
+        self.index = {}
+        self.features = None
+        self.last_step = None
+        self.full_rebuilds = 0
+
+    def refresh(self, chargers, dirty=None):
+        charger_ids = tuple(c.get("charger_id") for c in chargers)
+        step = dirty.get("step") if dirty else None
+        contiguous = step is not None and self.last_step is not None and step in (self.last_step, self.last_step + 1)
+        if charger_ids != self.charger_ids or not contiguous or dirty.get("full", True):
+            self.charger_ids = charger_ids
+            self.index = {cid: i for i, cid in enumerate(charger_ids)}
+            self.features = _ChargerFeatures(chargers)
+            self.full_rebuilds += 1
+        else:
+            for cid in dirty.get("chargers", []):
+                i = self.index.get(cid)
+                if i is not None:
+                    self.features.update_row(i, chargers[i])
+        self.last_step = step
+        return self.features
+
+
+class _BatchedScorer:
+    """
+    rule_based 的批量评分器，结果与原先逐个 用户-充电桩 计算的标量评分函数一致 (tests/test_rule_based_scoring.py 中保留作对照)。
+
+    - 电网友好度只取决于充电桩和当前时间步，每个充电桩计算一次；
+    - 运营商利润 = 充电桩基础分 × 用户充电需求系数，用外积得到 用户×充电桩 矩阵；
+    - 用户满意度中与排队无关的部分预先算成矩阵，排队等待分在分配时按当前负载补上。
+    """
+
+    def __init__(self, users, chargers, grid_status, current_hour, weights, user_params, profit_params, grid_params,
+                 charger_features=None):
+        self.user_params = user_params
+        self.w_user = weights.get("user_satisfaction", 0.0)
+        self.w_profit = weights.get("operator_profit", 0.0)
+        self.w_grid = weights.get("grid_friendliness", 0.0)
+
+        if charger_features is None:
+            charger_features = _ChargerFeatures(chargers)
+        self.distances = calculate_distance_matrix(positions_to_array(users, "current_position"), charger_features.positions)
+        user_socs = np.array([u.get("soc", 50) for u in users], dtype=float)
+        charger_power = charger_features.max_power
+
+        grid_scores = self._grid_scores(charger_power, grid_status, current_hour, grid_params)
+        profit_scores = self._profit_scores(user_socs, chargers, charger_features, grid_status, profit_params)
+        self.static_user_scores, self.urgency_factor = self._static_user_scores(
+            users, user_socs, charger_features.price_multiplier, charger_power, user_params)
+        # 与负载无关的加权分: 利润 + 电网
+        self.static_other_scores = profit_scores * self.w_profit + grid_scores[None, :] * self.w_grid
+
+        wait_component_weight = user_params.get('component_weights', {"distance": 0.4, "wait_time": 0.3, "power": 0.15, "price": 0.15}).get('wait_time', 0.3)
+        self.wait_weight_per_user = wait_component_weight * self.urgency_factor
+
+    def combined_scores(self, rows, charger_idx, charger_loads):
+        """返回用户 rows 在充电桩 charger_idx (及其负载) 上的加权总分 (不含紧急加分和排队惩罚)，参数按 numpy 规则广播"""
+        params = self.user_params
+        wait_scores = _first_tier_scores(
+            charger_loads, params.get('wait_time_tiers', [[0, 0.5], [2, 0.3], [5, 0.1], [8, -0.1]]),
+            lambda values, max_queue: values <= max_queue, params.get('default_wait_score', -0.3)
+        )
+        satisfaction = self.static_user_scores[rows, charger_idx] + wait_scores * self.wait_weight_per_user[rows]
+
+        min_adjustment = params.get('emergency_satisfaction_min_score_adjustment', -0.5)
+        adjust = (self.urgency_factor[rows] > 1.0) & (satisfaction < min_adjustment)
+        satisfaction = np.where(adjust, np.maximum(min_adjustment, satisfaction * params.get('emergency_satisfaction_adjustment_factor', 0.8)), satisfaction)
+        satisfaction = np.clip(satisfaction, -1.0, 1.0)
+
+        return satisfaction * self.w_user + self.static_other_scores[rows, charger_idx]
+
+    def _static_user_scores(self, users, user_socs, price_multiplier, charger_power, params):
+        """用户满意度中与排队无关的部分 (距离、功率匹配、价格)，返回 (矩阵, 各用户紧急系数)"""
+        # 1. Distance factor
+        distances = self.distances
+        dist_tiers = params.get('distance_tiers', [[2, 0.5, -0.1], [5, 0.3, -0.1], [10, 0.0, -0.05]])
+        dist_base_penalty = params.get('dist_base_penalty', -0.15)
+        last_tier_dist = dist_tiers[-1][0] if dist_tiers else 10
+        with np.errstate(invalid='ignore'):
+            distance_score = np.maximum(-0.5, dist_base_penalty - (distances - last_tier_dist) * params.get('default_dist_factor', -0.015))
+            unresolved = np.ones(distances.shape, dtype=bool)
+            for i, (tier_max_dist, base_score, per_km_penalty) in enumerate(dist_tiers):
+                prev_tier_dist = dist_tiers[i-1][0] if i > 0 else 0
+                hit = unresolved & (distances < tier_max_dist)
+                distance_score[hit] = base_score - (distances[hit] - prev_tier_dist) * per_km_penalty
+                unresolved &= ~hit
+
+        # 3. Power matching factor
+        soc_threshold = params.get('power_expected_base_soc_threshold', 40)
+        urgency = np.where(user_socs < soc_threshold, np.maximum(0, (soc_threshold - user_socs) / soc_threshold), 0.0)
+        profile_factors = params.get('power_expected_profile_factors', {})
+        expected_power = (params.get('power_expected_base', 20) + urgency * params.get('power_expected_urgency_factor', 30)) \
+            * np.array([profile_factors.get(u.get("user_type", "private"), 1.0) for u in users], dtype=float)
+        safe_expected = np.where(expected_power > 0, expected_power, 1.0)
+        power_ratio = np.where(expected_power[:, None] > 0, charger_power[None, :] / safe_expected[:, None], 1.0)
+        power_score = _first_tier_scores(
+            power_ratio, params.get('power_score_tiers', [[1.5, 0.4], [1.0, 0.3], [0.7, 0.1], [0.5, -0.1]]),
+            lambda values, min_ratio: values >= min_ratio, params.get('default_power_score', -0.2)
+        )
+
+        # 4. Price factor
+        price_score_max_abs = params.get('price_score_max_abs', 0.3)
+        price_score = np.clip((1.0 - price_multiplier) * params.get('price_score_multiplier', 0.5), -price_score_max_abs, price_score_max_abs)
+
+        # 5. Tiered urgency factor
+        urgency_soc_thresholds = params.get('emergency_soc_thresholds', [15, 25, 40])
+        urgency_factors = params.get('emergency_factors', [1.6, 1.3, 1.1])
+        urgency_factor = np.select(
+            [user_socs < urgency_soc_thresholds[0], user_socs < urgency_soc_thresholds[1], user_socs < urgency_soc_thresholds[2]],
+            urgency_factors[:3], default=1.0
+        )
+
+        component_weights = params.get('component_weights', {"distance": 0.4, "wait_time": 0.3, "power": 0.15, "price": 0.15})
+        static_scores = (distance_score * component_weights.get('distance', 0.4) * urgency_factor[:, None]
+                         + power_score * component_weights.get('power', 0.15)
+                         + price_score[None, :] * component_weights.get('price', 0.15))
+        return static_scores, urgency_factor
+
+    @staticmethod
+    def _profit_scores(user_socs, chargers, charger_features, grid_status, params):
+        current_price = grid_status.get("current_price", 0.85)
+        type_multipliers = {"fast": params.get('fast_charger_multiplier', 1.15), "superfast": params.get('superfast_charger_multiplier', 1.30)}
+        type_factor = np.array([type_multipliers.get(t, 1.0) for t in charger_features.types], dtype=float)
+        queue_lengths = np.array([len(c.get("queue", [])) for c in chargers], dtype=float)
+        charger_base = current_price * charger_features.price_multiplier * type_factor \
+            - queue_lengths * params.get('queue_penalty_per_person', 0.15)
+        charge_needed_factor = (100 - user_socs) / 50.0
+        score = charger_base[None, :] * (1 + charge_needed_factor[:, None] * params.get('charge_needed_score_factor', 0.05))
+
+        norm_min = params.get('normalization_min_assumed_score', 0.5)
+        norm_max = params.get('normalization_max_assumed_score', 2.0)
+        if norm_max - norm_min != 0:
+            normalized = (score - norm_min) / (norm_max - norm_min)
+        else:
+            normalized = np.full(score.shape, 0.5)
+        return np.clip(2 * normalized - 1, -1.0, 1.0)
+
+    @staticmethod
+    def _grid_scores(charger_power, grid_status, hour, params):
+        grid_load_percentage = grid_status.get("grid_load_percentage", 50)
+        renewable_ratio = grid_status.get("renewable_ratio", 0) / 100.0 if grid_status.get("renewable_ratio") is not None else 0.0
+        peak_hours = grid_status.get("peak_hours", [])
+        valley_hours = grid_status.get("valley_hours", [])
+
+        load_tiers = params.get('load_score_tiers', [[30, 0.8, 0.0], [50, 0.5, -0.015], [70, 0.2, -0.01], [85, 0.0, -0.015]])
+        default_load_factor = params.get('default_load_factor', -0.01)
+        default_load_base_penalty = params.get('default_load_base_penalty', -0.225)
+        for i, (threshold, base_score, factor) in enumerate(load_tiers):
+            if grid_load_percentage < threshold:
+                prev_threshold = load_tiers[i-1][0] if i > 0 else 0
+                load_score = base_score - (grid_load_percentage - prev_threshold) * factor
+                break
+        else:
+            last_threshold = load_tiers[-1][0] if load_tiers else 85
+            load_score = max(params.get('max_load_score_penalty', -0.5), default_load_base_penalty - (grid_load_percentage - last_threshold) * default_load_factor)
+
+        renewable_score = params.get('renewable_score_multiplier', 0.8) * renewable_ratio
+
+        time_scores = params.get('time_scores', {"peak": -0.3, "valley": 0.6, "shoulder": 0.2})
+        if hour in peak_hours: time_score = time_scores.get('peak', -0.3)
+        elif hour in valley_hours: time_score = time_scores.get('valley', 0.6)
+        else: time_score = time_scores.get('shoulder', 0.2)
+
+        power_penalty_thresholds = params.get('power_penalty_thresholds', [150, 50])
+        power_penalties = params.get('power_penalties', [0.1, 0.05])
+        power_penalty = np.where(charger_power > power_penalty_thresholds[0], power_penalties[0],
+                                 np.where(charger_power > power_penalty_thresholds[1], power_penalties[1], 0.0))
+
+        raw_score = load_score + renewable_score + time_score - power_penalty
+        raw_score = np.where(raw_score < 0, raw_score * params.get('negative_score_adjustment_factor', 0.8),
+                             np.minimum(1.0, raw_score * params.get('positive_score_adjustment_factor', 1.1)))
+        return np.clip(raw_score, params.get('final_score_min_clamp', -0.9), params.get('final_score_max_clamp', 1.0))
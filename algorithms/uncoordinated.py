@@ -2,24 +2,28 @@
 import logging
 import math
 import random
-from collections import defaultdict
+
+import numpy as np
 try:
-    from simulation.utils import calculate_distance # 注意导入路径
+    from simulation.utils import calculate_distance_matrix, positions_to_array # 注意导入路径
 except ImportError:
-    logging.error("Could not import calculate_distance from simulation.utils in uncoordinated.py")
-    def calculate_distance(p1, p2): return 10.0 # Fallback
+    logging.error("Could not import distance helpers from simulation.utils in uncoordinated.py")
+    def positions_to_array(items, key='position'): return np.zeros((len(items), 2))
+    def calculate_distance_matrix(a, b): return np.full((len(a), len(b)), 10.0)
+from algorithms.registry import FunctionAlgorithm
 
 logger = logging.getLogger(__name__)
 
-def schedule(state, config, manual_decisions=None, grid_preferences=None): # Added config
+def schedule(state, config, manual_decisions=None, grid_preferences=None, deadline=None): # Added config
     """
     无序充电算法实现 (先到先得，或基于简单距离/队列)。
 
     Args:
         state (dict): 当前环境状态
+        deadline (Deadline): 本步决策时间预算 (可选)，耗尽时未处理的用户记入 deferred_users
 
     Returns:
-        dict: 调度决策 {user_id: charger_id}
+        tuple: (调度决策 {user_id: charger_id}, 元数据 {str: any})
     """
     decisions = {}
     
@@ -34,7 +38,7 @@ def schedule(state, config, manual_decisions=None, grid_preferences=None): # Add
     chargers = state.get("chargers", [])
     if not users or not chargers:
         logger.warning("Uncoordinated: No users or chargers in state.")
-        return decisions
+        return decisions, {"candidate_user_count": 0}
 
     # 筛选需要充电决策的用户
     candidate_users = []
@@ -48,73 +52,88 @@ def schedule(state, config, manual_decisions=None, grid_preferences=None): # Add
 
     if not candidate_users:
         # logger.debug("Uncoordinated: No users actively seeking charge.")
-        return decisions
+        return decisions, {"candidate_user_count": 0}
 
     random.shuffle(candidate_users) # 模拟随机决策顺序
+    # 上一步因时间预算被推迟的用户排在前面 (稳定排序，其余保持随机顺序)
+    deferred_ids = set(state.get("deferred_users", []))
+    if deferred_ids:
+        candidate_users.sort(key=lambda u: u.get("user_id") not in deferred_ids)
 
     # 获取充电桩状态和队列信息
     charger_dict = {c["charger_id"]: c for c in chargers if isinstance(c,dict) and c.get("charger_id") and c.get("status") != "failure"}
     if not charger_dict:
         logger.warning("Uncoordinated: No operational chargers found.")
-        return decisions
-
-    # 记录本轮已分配给充电桩的用户数，模拟用户看到的情况
-    current_assignments = defaultdict(int)
-
-    assigned_users_this_step = set() # 防止重复分配
-
-    for user in candidate_users:
+        return decisions, {"candidate_user_count": len(candidate_users)}
+
+    # 一次性计算 用户 × 充电桩 的距离矩阵和评分矩阵 (按本步开始时的排队人数)，每个用户取 argmin。
+    # 用户依次"占用"所选充电桩的排队位置: 本轮被占用过的充电桩评分只会变差，
+    # 因此只有当某用户的 argmin 恰好落在已被占用的充电桩上时，才需要按最新排队人数重算该用户这一行。
+    charger_ids = list(charger_dict.keys())
+    charger_list = list(charger_dict.values())
+    distances = calculate_distance_matrix(positions_to_array(candidate_users, 'current_position'),
+                                          positions_to_array(charger_list))
+    # 当前总排队人数 (真实队列 + 正在充电 + 本轮已分配)
+    waiting = np.array([len(c.get("queue", [])) + (1 if c.get("status") == "occupied" else 0) for c in charger_list], dtype=float)
+
+    # Uncoordinated user choice strategy:
+    # SOC 很低或用户已主动决定要充电时只看距离；否则综合距离和排队人数
+    dist_weight = score_weights.get('distance', 0.7)
+    queue_penalty_km_equivalent = score_weights.get('queue_penalty_km', 5.0)
+    distance_only = np.array([
+        u.get("soc", 100) < low_soc_threshold_for_distance_only or u.get("needs_charge_decision", False)
+        for u in candidate_users
+    ], dtype=bool)
+
+    def score_rows(rows, waiting_counts):
+        row_dist = distances[rows]
+        scores = np.where(distance_only[rows, None], row_dist,
+                          row_dist * dist_weight + waiting_counts[None, :] * queue_penalty_km_equivalent)
+        scores[~np.isfinite(row_dist) | (waiting_counts >= max_queue_allowed)[None, :]] = np.inf
+        return scores
+
+    all_rows = np.arange(len(candidate_users))
+    initial_scores = score_rows(all_rows, waiting)
+    best = np.argmin(initial_scores, axis=1)
+    best_feasible = np.isfinite(initial_scores[all_rows, best])
+
+    touched = np.zeros(len(charger_ids), dtype=bool) # 本轮已被分配过的充电桩
+    open_slots = int(np.count_nonzero(waiting < max_queue_allowed)) # 仍可排队的充电桩数
+    deferred_users = []
+    for index, user in enumerate(candidate_users):
+        if deadline is not None and deadline.should_stop(index):
+            deferred_users = [u.get("user_id") for u in candidate_users[index:] if u.get("user_id") not in decisions]
+            break
         user_id = user.get("user_id")
-        if not user_id or user_id in assigned_users_this_step: continue
-
-        user_pos = user.get("current_position", {})
-        soc = user.get("soc", 100)
-        
-        # The user's own model has determined they need a charge.
-        needs_charge_flag = user.get("needs_charge_decision", False) 
-
-        possible_targets = []
-        for cid, charger in charger_dict.items():
-            # 计算当前总排队人数（真实队列+本轮已分配）
-            current_queue_len = len(charger.get("queue", []))
-            if charger.get("status") == "occupied": current_queue_len += 1
-            total_waiting = current_queue_len + current_assignments.get(cid, 0)
-
-            if total_waiting < max_queue_allowed:
-                dist = calculate_distance(user_pos, charger.get("position", {}))
-                if dist == float('inf'): continue # 跳过无效距离
-
-                # Uncoordinated user choice strategy:
-                # If SOC is very low OR the user has proactively decided they need a charge, prioritize distance.
-                # Otherwise, consider both distance and queue.
-                eval_score = 0
-                # A user who has decided they need a charge should act like they have low SOC: prioritize proximity.
-                if soc < low_soc_threshold_for_distance_only or needs_charge_flag:
-                    eval_score = dist # Primarily distance
-                else:
-                    dist_weight = score_weights.get('distance', 0.7)
-                    queue_penalty_km_equivalent = score_weights.get('queue_penalty_km', 5.0)
-                    eval_score = dist * dist_weight + total_waiting * queue_penalty_km_equivalent
-
-                possible_targets.append((cid, eval_score))
-
-        if not possible_targets:
+        if not user_id or user_id in decisions: continue # 防止重复分配
+
+        choice = best[index]
+        if touched[choice]:
+            # 冲突: 首选充电桩的排队人数已变化，按当前排队人数重算该用户
+            row_scores = score_rows(all_rows[index:index + 1], waiting)[0]
+            choice = int(np.argmin(row_scores))
+            if not np.isfinite(row_scores[choice]):
+                continue
+        elif not best_feasible[index]:
             # logger.warning(f"Uncoordinated: No suitable chargers found for user {user_id}")
             continue
 
-        # 选择评估分数最低（最优）的充电桩
-        possible_targets.sort(key=lambda x: x[1])
-        best_charger_id = possible_targets[0][0]
-
-        if best_charger_id:
-            decisions[user_id] = best_charger_id
-            current_assignments[best_charger_id] += 1 # 更新本轮分配计数
-            assigned_users_this_step.add(user_id)
-            # logger.debug(f"Uncoordinated assigned user {user_id} to charger {best_charger_id}")
+        decisions[user_id] = charger_ids[choice]
+        waiting[choice] += 1 # 更新本轮分配计数
+        touched[choice] = True
+        if waiting[choice] >= max_queue_allowed:
+            open_slots -= 1
+            if open_slots <= 0:
+                break # 所有充电桩的排队都已满，后面的用户不可能再被分配
 
     logger.info(f"Uncoordinated made {len(decisions)} assignments for {len(candidate_users)} candidates.")
-    # --- ADD THIS PART ---
     metadata = {
-        "candidate_user_count": len(candidate_users)
+        "candidate_user_count": len(candidate_users),
+        "deferred_users": deferred_users,
     }
-    return decisions
\ No newline at end of file
+    return decisions, metadata
+
+
+def create_algorithm(config):
+    """算法注册表工厂"""
+    return FunctionAlgorithm(schedule, config)
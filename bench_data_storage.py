@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+运营商数据存储查询基准
+生成指定规模的 realtime_data / charging_sessions 数据，分别在 "无二级索引 + 旧查询" 和
+"应用迁移后 (索引 + charger_latest_status / financial_hourly_rollup)" 两种情况下测量仪表盘常用查询的延迟，并打印查询计划。
+
+最后用 sqlite 和 duckdb 两种分析后端分别运行 analyze_station_performance / get_historical_demand_patterns /
+get_expansion_recommendations (需要安装 duckdb)。
+
+用法:
+    python bench_data_storage.py --rows 10000000 --sessions 1000000 --db /tmp/bench_operator.db
+"""
+
+import sys
+import os
+import argparse
+import random
+import sqlite3
+import time
+from datetime import datetime, timedelta
+
+# 添加项目根目录到Python路径
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from data_storage import MIGRATIONS, OperatorDataStorage
+from storage_backends import HAS_DUCKDB
+
+LEGACY_LATEST_STATUS_SQL = """
+    SELECT station_id, COUNT(DISTINCT charger_id), SUM(queue_length)
+    FROM (
+        SELECT r.*
+        FROM realtime_data r
+        INNER JOIN (
+            SELECT charger_id, MAX(timestamp) as max_time
+            FROM realtime_data
+            GROUP BY charger_id
+        ) m ON r.charger_id = m.charger_id AND r.timestamp = m.max_time
+    ) latest
+    GROUP BY station_id
+"""
+
+LATEST_STATUS_SQL = """
+    SELECT station_id, COUNT(DISTINCT charger_id), SUM(queue_length)
+    FROM charger_latest_status
+    GROUP BY station_id
+"""
+
+FINANCIAL_ROLLUP_SQL = """
+    SELECT hour_start, station_id, sessions_count, total_revenue
+    FROM financial_hourly_rollup WHERE hour_start BETWEEN ? AND ?
+    ORDER BY hour_start, station_id
+"""
+
+# (名称, SQL, 参数生成函数)；与 OperatorDataStorage 中的查询条件一致
+ANALYTIC_QUERIES = [
+    ("financial_summary (1 day)",
+     """SELECT strftime('%Y-%m-%d %H:00:00', start_time) as datetime_hour, station_id, COUNT(*), SUM(revenue)
+        FROM charging_sessions WHERE start_time BETWEEN ? AND ?
+        GROUP BY datetime_hour, station_id""",
+     lambda station: [(datetime.now() - timedelta(days=1)).strftime('%Y-%m-%d 00:00:00'),
+                      (datetime.now() - timedelta(days=1)).strftime('%Y-%m-%d 23:59:59')]),
+    ("historical_demand_patterns (28 days)",
+     """SELECT strftime('%Y-%m-%d', start_time) as date, strftime('%H', start_time) as hour, COUNT(*)
+        FROM charging_sessions WHERE station_id = ? AND start_time >= date('now', ? || ' days')
+        GROUP BY date, hour""",
+     lambda station: [station, '-28']),
+    ("station_performance (30 days)",
+     """SELECT COUNT(*), SUM(energy_kwh), AVG(duration_minutes)
+        FROM charging_sessions WHERE station_id = ? AND start_time >= date('now', ? || ' days')""",
+     lambda station: [station, '-30']),
+]
+
+
+def populate(db_path, rows, sessions, chargers, stations, days, batch=200_000):
+    """按时间顺序批量写入 realtime_data (经过触发器) 和 charging_sessions"""
+    conn = sqlite3.connect(db_path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=OFF")
+    start = datetime.now() - timedelta(days=days)
+    step_seconds = days * 86400 / max(1, rows // chargers)
+    statuses = ["available", "occupied", "occupied", "failure"]
+
+    t0 = time.perf_counter()
+    written = 0
+    while written < rows:
+        count = min(batch, rows - written)
+        batch_rows = []
+        for i in range(written, written + count):
+            charger = i % chargers
+            ts = start + timedelta(seconds=(i // chargers) * step_seconds)
+            batch_rows.append((ts.strftime('%Y-%m-%d %H:%M:%S'), f"charger_{charger}", f"station_{charger % stations}",
+                               statuses[i % 4], 50.0, i % 5, None, 0.5))
+        with conn:
+            conn.executemany("""
+                INSERT INTO realtime_data (timestamp, charger_id, station_id, status, power_output,
+                                           queue_length, current_user, utilization_rate)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """, batch_rows)
+        written += count
+    realtime_s = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    written = 0
+    while written < sessions:
+        count = min(batch, sessions - written)
+        batch_rows = []
+        for i in range(written, written + count):
+            st = start + timedelta(seconds=random.random() * days * 86400)
+            batch_rows.append((f"S{i}", f"charger_{i % chargers}", f"station_{i % stations}", f"user_{i % 5000}",
+                               st.strftime('%Y-%m-%d %H:%M:%S'), (st + timedelta(minutes=45)).strftime('%Y-%m-%d %H:%M:%S'),
+                               45.0, 30.0, 20.0, 35.0, 20.0, 80.0, 1.1, 3.0))
+        with conn:
+            conn.executemany("""
+                INSERT INTO charging_sessions (session_id, charger_id, station_id, user_id, start_time, end_time,
+                    duration_minutes, energy_kwh, cost, revenue, start_soc, end_soc, price_per_kwh, service_fee)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, batch_rows)
+        written += count
+    sessions_s = time.perf_counter() - t0
+    with conn:
+        conn.executemany("INSERT OR REPLACE INTO station_config (station_id, name) VALUES (?, ?)",
+                         [(f"station_{i}", f"Station {i}") for i in range(stations)])
+    conn.close()
+    return realtime_s, sessions_s
+
+
+def timed(conn, sql, params=(), repeat=3):
+    """返回 repeat 次执行中的最短耗时 (毫秒)"""
+    best = float('inf')
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        conn.execute(sql, params).fetchall()
+        best = min(best, (time.perf_counter() - t0) * 1000)
+    return best
+
+
+def query_plan(conn, sql, params=()):
+    return "; ".join(row[-1] for row in conn.execute("EXPLAIN QUERY PLAN " + sql, params).fetchall())
+
+
+def index_statements():
+    return [statement for version, _, statements in MIGRATIONS if version == 1 for statement in statements]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="运营商数据存储查询基准")
+    parser.add_argument("--rows", type=int, default=10_000_000, help="realtime_data 行数")
+    parser.add_argument("--sessions", type=int, default=1_000_000, help="charging_sessions 行数")
+    parser.add_argument("--chargers", type=int, default=2000)
+    parser.add_argument("--stations", type=int, default=100)
+    parser.add_argument("--days", type=int, default=60)
+    parser.add_argument("--db", default="bench_operator_data.db")
+    parser.add_argument("--keep", action="store_true", help="保留已有数据库，跳过数据生成")
+    parser.add_argument("--analytics-db", default=None, help="DuckDB 分析库路径 (默认 <db>.duckdb，每次重新导入)")
+    parser.add_argument("--legacy-scan-limit", type=int, default=200_000,
+                        help="超过该行数时不在无索引情况下运行旧的最新状态查询 (其自连接为 O(n^2))")
+    args = parser.parse_args()
+
+    if not args.keep:
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(args.db + suffix):
+                os.remove(args.db + suffix)
+        storage = OperatorDataStorage(args.db, async_writes=False)
+        storage.close()
+        print(f"生成数据: realtime_data {args.rows:,} 行, charging_sessions {args.sessions:,} 行 ...")
+        realtime_s, sessions_s = populate(args.db, args.rows, args.sessions, args.chargers, args.stations, args.days)
+        print(f"  realtime_data 写入 {realtime_s:.1f}s ({args.rows / max(realtime_s, 1e-9):,.0f} 行/s, 含最新状态触发器)")
+        print(f"  charging_sessions 写入 {sessions_s:.1f}s (含小时财务汇总触发器)")
+
+    conn = sqlite3.connect(args.db)
+    # 生成数据时站点为 station_0 .. station_{stations-1}，取中间一个 (--keep 时需与生成时的 --stations 一致)
+    station = f"station_{max(1, args.stations) // 2}"
+    index_names = [statement.split()[5] for statement in index_statements()]
+
+    # 1. 无二级索引 + 旧的最新状态查询
+    for name in index_names:
+        conn.execute(f"DROP INDEX IF EXISTS {name}")
+    conn.execute("ANALYZE")
+    before = {}
+    row_count = conn.execute("SELECT COUNT(*) FROM realtime_data").fetchone()[0]
+    if row_count <= args.legacy_scan_limit:
+        before["latest_station_status"] = (timed(conn, LEGACY_LATEST_STATUS_SQL, repeat=1), query_plan(conn, LEGACY_LATEST_STATUS_SQL))
+    else:
+        before["latest_station_status"] = (float('nan'), query_plan(conn, LEGACY_LATEST_STATUS_SQL) + " (skipped, O(n^2))")
+    for name, sql, params_fn in ANALYTIC_QUERIES:
+        before[name] = (timed(conn, sql, params_fn(station)), query_plan(conn, sql, params_fn(station)))
+
+    # 2. 应用迁移中的索引 + charger_latest_status
+    t0 = time.perf_counter()
+    for statement in index_statements():
+        conn.execute(statement)
+    conn.execute("ANALYZE")
+    conn.commit()
+    print(f"创建索引 {time.perf_counter() - t0:.1f}s")
+    after = {"latest_station_status": (timed(conn, LATEST_STATUS_SQL), query_plan(conn, LATEST_STATUS_SQL))}
+    # 仅有 (charger_id, timestamp) 索引时旧查询的耗时，作为 charger_latest_status 表的对照
+    before["latest_station_status (legacy query, indexed)"] = (timed(conn, LEGACY_LATEST_STATUS_SQL, repeat=1), "")
+    after["latest_station_status (legacy query, indexed)"] = after["latest_station_status"]
+    for name, sql, params_fn in ANALYTIC_QUERIES:
+        after[name] = (timed(conn, sql, params_fn(station)), query_plan(conn, sql, params_fn(station)))
+    # get_financial_summary 读取由触发器维护的 financial_hourly_rollup
+    financial_params = ANALYTIC_QUERIES[0][2](station)
+    before["financial_summary (hourly rollup)"] = before["financial_summary (1 day)"]
+    after["financial_summary (hourly rollup)"] = (timed(conn, FINANCIAL_ROLLUP_SQL, financial_params),
+                                                  query_plan(conn, FINANCIAL_ROLLUP_SQL, financial_params))
+    conn.close()
+
+    print(f"\n{'query':<48}{'before (ms)':>14}{'after (ms)':>14}{'speedup':>10}")
+    for name in before:
+        b, a = before[name][0], after[name][0]
+        print(f"{name:<48}{b:>14.1f}{a:>14.2f}{b / max(a, 1e-6):>9.0f}x")
+    print("\n查询计划:")
+    for name in before:
+        if before[name][1]:
+            print(f"- {name}\n    before: {before[name][1]}\n    after:  {after[name][1]}")
+
+    bench_analytics_backends(args.db, args.analytics_db or args.db + ".duckdb", station)
+
+
+def bench_analytics_backends(db_path, duckdb_path, station):
+    """sqlite / duckdb 分析后端上的长时间段分析方法耗时 (毫秒)"""
+    calls = [
+        ("analyze_station_performance (30 days)", lambda s: s.analyze_station_performance(station, 30)),
+        ("get_historical_demand_patterns (28 days)", lambda s: s.get_historical_demand_patterns(station, 28)),
+        ("get_expansion_recommendations (7 days)", lambda s: s.get_expansion_recommendations()),
+    ]
+    if not HAS_DUCKDB:
+        print("\n未安装 duckdb，跳过分析后端对比")
+        return
+    if os.path.exists(duckdb_path):
+        os.remove(duckdb_path)
+
+    results = {}
+    for backend in ("sqlite", "duckdb"):
+        t0 = time.perf_counter()
+        storage = OperatorDataStorage(db_path, async_writes=False, analytics_backend=backend, analytics_path=duckdb_path)
+        if backend == "duckdb":
+            print(f"\nDuckDB 分析库导入 {time.perf_counter() - t0:.1f}s")
+        for name, call in calls:
+            best = float('inf')
+            for _ in range(3):
+                t0 = time.perf_counter()
+                call(storage)
+                best = min(best, (time.perf_counter() - t0) * 1000)
+            results.setdefault(name, {})[backend] = best
+        storage.close()
+
+    print(f"\n{'analytics method':<48}{'sqlite (ms)':>14}{'duckdb (ms)':>14}{'speedup':>10}")
+    for name, timings in results.items():
+        print(f"{name:<48}{timings['sqlite']:>14.1f}{timings['duckdb']:>14.1f}{timings['sqlite'] / max(timings['duckdb'], 1e-6):>9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
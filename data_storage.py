@@ -7,26 +7,675 @@
 import sqlite3
 import json
 import os
+import atexit
+import queue
+import threading
+import time
+from contextlib import contextmanager
 from datetime import datetime, timedelta
-from typing import Dict, List, Optional, Tuple, Any
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
 from collections import defaultdict
 import pandas as pd
 import numpy as np
 import logging
 
+from storage_backends import AnalyticsBackend, create_analytics_backend
+
+try:
+    from simulation.utils import config as utils_config
+except ImportError:
+    utils_config = {}
+
 logger = logging.getLogger(__name__)
 
+_STOP_WRITER = object()
+
+INSERT_REALTIME_SQL = """
+    INSERT INTO realtime_data 
+    (timestamp, charger_id, station_id, status, power_output, 
+     queue_length, current_user, utilization_rate)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+# 同一 session_id 再次保存时覆盖原记录；用 upsert 而不是 INSERT OR REPLACE，
+# 这样 financial_hourly_rollup 的 UPDATE 触发器能先减去旧值再加上新值
+INSERT_SESSION_SQL = """
+    INSERT INTO charging_sessions 
+    (session_id, charger_id, station_id, user_id, start_time, 
+     end_time, duration_minutes, energy_kwh, cost, revenue,
+     start_soc, end_soc, price_per_kwh, service_fee)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(session_id) DO UPDATE SET
+        charger_id = excluded.charger_id,
+        station_id = excluded.station_id,
+        user_id = excluded.user_id,
+        start_time = excluded.start_time,
+        end_time = excluded.end_time,
+        duration_minutes = excluded.duration_minutes,
+        energy_kwh = excluded.energy_kwh,
+        cost = excluded.cost,
+        revenue = excluded.revenue,
+        start_soc = excluded.start_soc,
+        end_soc = excluded.end_soc,
+        price_per_kwh = excluded.price_per_kwh,
+        service_fee = excluded.service_fee
+"""
+
+INSERT_FINANCIAL_SQL = """
+    INSERT OR REPLACE INTO financial_records
+    (date, hour, station_id, revenue, electricity_cost, 
+     service_cost, profit, sessions_count, energy_delivered, avg_price_per_kwh)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+INSERT_FORECAST_SQL = """
+    INSERT OR REPLACE INTO demand_forecast
+    (forecast_date, station_id, hour, predicted_sessions,
+     predicted_energy, predicted_queue_length, 
+     confidence_level, model_version)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+# 批量写入语句 -> 目标表 (写入提交后通知监听者)
+_SQL_TABLES = {
+    INSERT_REALTIME_SQL: "realtime_data",
+    INSERT_SESSION_SQL: "charging_sessions",
+    INSERT_FINANCIAL_SQL: "financial_records",
+    INSERT_FORECAST_SQL: "demand_forecast",
+}
+
+# 会话对小时汇总行的贡献；{row} 为 NEW 或 OLD，{sign} 为 1 (加) 或 -1 (减)
+_FINANCIAL_ROLLUP_DELTA = """
+    INSERT INTO financial_hourly_rollup
+        (hour_start, station_id, sessions_count, total_energy, total_revenue, total_cost,
+         sum_price, price_samples, sum_duration, duration_samples)
+    SELECT strftime('%Y-%m-%d %H:00:00', {row}.start_time), {row}.station_id, {sign},
+           {sign} * COALESCE({row}.energy_kwh, 0), {sign} * COALESCE({row}.revenue, 0), {sign} * COALESCE({row}.cost, 0),
+           {sign} * COALESCE({row}.price_per_kwh, 0), {sign} * ({row}.price_per_kwh IS NOT NULL),
+           {sign} * COALESCE({row}.duration_minutes, 0), {sign} * ({row}.duration_minutes IS NOT NULL)
+    WHERE strftime('%Y-%m-%d %H:00:00', {row}.start_time) IS NOT NULL
+    ON CONFLICT(hour_start, station_id) DO UPDATE SET
+        sessions_count = sessions_count + excluded.sessions_count,
+        total_energy = total_energy + excluded.total_energy,
+        total_revenue = total_revenue + excluded.total_revenue,
+        total_cost = total_cost + excluded.total_cost,
+        sum_price = sum_price + excluded.sum_price,
+        price_samples = price_samples + excluded.price_samples,
+        sum_duration = sum_duration + excluded.sum_duration,
+        duration_samples = duration_samples + excluded.duration_samples;
+"""
+
+_FINANCIAL_ROLLUP_CLEANUP = """
+    DELETE FROM financial_hourly_rollup
+    WHERE hour_start = strftime('%Y-%m-%d %H:00:00', OLD.start_time) AND station_id = OLD.station_id
+      AND sessions_count <= 0;
+"""
+
+# 数据库迁移: (版本号, 名称, SQL 列表)。_init_database 建表后按版本号顺序执行尚未应用的迁移，
+# 已应用的版本记录在 schema_migrations 表中。新的迁移只能追加在末尾，不能修改已发布的迁移。
+MIGRATIONS = [
+    (1, "analytic_indexes", [
+        "CREATE INDEX IF NOT EXISTS idx_realtime_charger_time ON realtime_data (charger_id, timestamp)",
+        "CREATE INDEX IF NOT EXISTS idx_realtime_time ON realtime_data (timestamp)",
+        "CREATE INDEX IF NOT EXISTS idx_sessions_station_start ON charging_sessions (station_id, start_time)",
+        "CREATE INDEX IF NOT EXISTS idx_sessions_start ON charging_sessions (start_time)",
+        "CREATE INDEX IF NOT EXISTS idx_alerts_status_type ON alerts (status, alert_type, charger_id)",
+        "CREATE INDEX IF NOT EXISTS idx_maintenance_station_created ON maintenance_orders (station_id, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_maintenance_created ON maintenance_orders (created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_forecast_station_date ON demand_forecast (station_id, forecast_date, hour)",
+    ]),
+    # 每个充电桩的最新状态，由 realtime_data 上的触发器在写入时维护，
+    # get_latest_station_status 不再需要对整个 realtime_data 做 GROUP BY + 自连接
+    (2, "charger_latest_status", [
+        """
+        CREATE TABLE IF NOT EXISTS charger_latest_status (
+            charger_id TEXT PRIMARY KEY,
+            timestamp TIMESTAMP,
+            station_id TEXT NOT NULL,
+            status TEXT NOT NULL,
+            power_output REAL DEFAULT 0,
+            queue_length INTEGER DEFAULT 0,
+            current_user TEXT,
+            utilization_rate REAL DEFAULT 0
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_latest_station ON charger_latest_status (station_id)",
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_realtime_latest_status AFTER INSERT ON realtime_data
+        BEGIN
+            INSERT INTO charger_latest_status
+                (charger_id, timestamp, station_id, status, power_output, queue_length, current_user, utilization_rate)
+            VALUES
+                (NEW.charger_id, NEW.timestamp, NEW.station_id, NEW.status, NEW.power_output,
+                 NEW.queue_length, NEW.current_user, NEW.utilization_rate)
+            ON CONFLICT(charger_id) DO UPDATE SET
+                timestamp = excluded.timestamp,
+                station_id = excluded.station_id,
+                status = excluded.status,
+                power_output = excluded.power_output,
+                queue_length = excluded.queue_length,
+                current_user = excluded.current_user,
+                utilization_rate = excluded.utilization_rate
+            WHERE excluded.timestamp >= charger_latest_status.timestamp;
+        END
+        """,
+        # 回填已有数据 (同一时刻的多条记录取 id 最大的一条)
+        """
+        INSERT OR REPLACE INTO charger_latest_status
+            (charger_id, timestamp, station_id, status, power_output, queue_length, current_user, utilization_rate)
+        SELECT r.charger_id, r.timestamp, r.station_id, r.status, r.power_output,
+               r.queue_length, r.current_user, r.utilization_rate
+        FROM realtime_data r
+        WHERE r.id = (
+            SELECT r2.id FROM realtime_data r2
+            WHERE r2.charger_id = r.charger_id
+            ORDER BY r2.timestamp DESC, r2.id DESC
+            LIMIT 1
+        )
+        """,
+    ]),
+    # realtime_data 的降采样层级 (见 compact_realtime_data)；保存累加值以便增量合并
+    (3, "realtime_rollups", [
+        statement
+        for table in ("realtime_rollup_15min", "realtime_rollup_hourly")
+        for statement in (
+            f"""
+            CREATE TABLE IF NOT EXISTS {table} (
+                bucket_start TIMESTAMP NOT NULL,
+                charger_id TEXT NOT NULL,
+                station_id TEXT NOT NULL,
+                samples INTEGER NOT NULL,
+                sum_power REAL DEFAULT 0,
+                max_power REAL DEFAULT 0,
+                sum_queue REAL DEFAULT 0,
+                max_queue INTEGER DEFAULT 0,
+                sum_utilization REAL DEFAULT 0,
+                occupied_samples INTEGER DEFAULT 0,
+                failure_samples INTEGER DEFAULT 0,
+                PRIMARY KEY (charger_id, bucket_start)
+            )
+            """,
+            f"CREATE INDEX IF NOT EXISTS idx_{table}_time ON {table} (bucket_start)",
+            f"CREATE INDEX IF NOT EXISTS idx_{table}_station_time ON {table} (station_id, bucket_start)",
+        )
+    ] + [
+        """
+        CREATE TABLE IF NOT EXISTS rollup_state (
+            tier TEXT PRIMARY KEY,
+            rolled_until TIMESTAMP
+        )
+        """,
+    ]),
+    # 按小时、站点预聚合的财务数据，由 charging_sessions 上的触发器在写入会话的同一事务中维护，
+    # get_financial_summary 的耗时只与查询的小时数和站点数有关，与会话总数无关
+    (4, "financial_hourly_rollup", [
+        """
+        CREATE TABLE IF NOT EXISTS financial_hourly_rollup (
+            hour_start TIMESTAMP NOT NULL,
+            station_id TEXT NOT NULL,
+            sessions_count INTEGER DEFAULT 0,
+            total_energy REAL DEFAULT 0,
+            total_revenue REAL DEFAULT 0,
+            total_cost REAL DEFAULT 0,
+            sum_price REAL DEFAULT 0,
+            price_samples INTEGER DEFAULT 0,
+            sum_duration REAL DEFAULT 0,
+            duration_samples INTEGER DEFAULT 0,
+            PRIMARY KEY (hour_start, station_id)
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_financial_rollup_station ON financial_hourly_rollup (station_id, hour_start)",
+        f"""
+        CREATE TRIGGER IF NOT EXISTS trg_sessions_rollup_insert AFTER INSERT ON charging_sessions
+        BEGIN
+            {_FINANCIAL_ROLLUP_DELTA.format(row="NEW", sign=1)}
+        END
+        """,
+        f"""
+        CREATE TRIGGER IF NOT EXISTS trg_sessions_rollup_update AFTER UPDATE ON charging_sessions
+        BEGIN
+            {_FINANCIAL_ROLLUP_DELTA.format(row="OLD", sign=-1)}
+            {_FINANCIAL_ROLLUP_CLEANUP}
+            {_FINANCIAL_ROLLUP_DELTA.format(row="NEW", sign=1)}
+        END
+        """,
+        f"""
+        CREATE TRIGGER IF NOT EXISTS trg_sessions_rollup_delete AFTER DELETE ON charging_sessions
+        BEGIN
+            {_FINANCIAL_ROLLUP_DELTA.format(row="OLD", sign=-1)}
+            {_FINANCIAL_ROLLUP_CLEANUP}
+        END
+        """,
+        # 回填已有会话
+        """
+        INSERT OR REPLACE INTO financial_hourly_rollup
+            (hour_start, station_id, sessions_count, total_energy, total_revenue, total_cost,
+             sum_price, price_samples, sum_duration, duration_samples)
+        SELECT strftime('%Y-%m-%d %H:00:00', start_time), station_id, COUNT(*),
+               SUM(COALESCE(energy_kwh, 0)), SUM(COALESCE(revenue, 0)), SUM(COALESCE(cost, 0)),
+               SUM(COALESCE(price_per_kwh, 0)), COUNT(price_per_kwh),
+               SUM(COALESCE(duration_minutes, 0)), COUNT(duration_minutes)
+        FROM charging_sessions
+        WHERE strftime('%Y-%m-%d %H:00:00', start_time) IS NOT NULL
+        GROUP BY 1, station_id
+        """,
+    ]),
+    # 降采样改为按插入顺序 (realtime_data.id) 记录各层级的汇总进度: 按时间戳的水位在仿真时间回退
+    # (每次运行都从当天零点开始) 时会漏掉新写入的旧时间戳数据。已有进度按旧水位换算:
+    # 时间戳不早于旧水位的最早一行之前的数据视为已汇总。
+    (5, "rollup_progress_by_id", [
+        """
+        CREATE TABLE IF NOT EXISTS rollup_progress (
+            tier TEXT PRIMARY KEY,
+            rolled_id INTEGER NOT NULL DEFAULT 0
+        )
+        """,
+        """
+        INSERT OR REPLACE INTO rollup_progress (tier, rolled_id)
+        SELECT s.tier, COALESCE(
+            (SELECT MIN(r.id) - 1 FROM realtime_data r WHERE r.timestamp >= s.rolled_until),
+            (SELECT COALESCE(MAX(id), 0) FROM realtime_data)
+        )
+        FROM rollup_state s
+        WHERE s.rolled_until IS NOT NULL
+        """,
+        "DROP TABLE IF EXISTS rollup_state",
+    ]),
+]
+
+# realtime_data 保留策略: 原始数据保留 raw_days 天，15 分钟汇总保留 rollup_15min_days 天，
+# 小时汇总保留 rollup_hourly_days 天 (None 为永久)。天数以库中最新的仿真时间为基准，而不是墙上时间。
+DEFAULT_RETENTION = {
+    "raw_days": 7,
+    "rollup_15min_days": 90,
+    "rollup_hourly_days": None,
+    "compaction_interval_s": 300,
+}
+
+# (层级, 分辨率分钟, 表名, 原始时间戳所在桶的 SQL 表达式)，从粗到细。各层级都直接由原始数据汇总
+ROLLUP_TIERS = [
+    ("hourly", 60, "realtime_rollup_hourly", "strftime('%Y-%m-%d %H:00:00', timestamp)"),
+    ("15min", 15, "realtime_rollup_15min",
+     "strftime('%Y-%m-%d %H:', timestamp) || printf('%02d', CAST(strftime('%M', timestamp) AS INTEGER) / 15 * 15) || ':00'"),
+]
+
+_ROLLUP_COLUMNS = ("bucket_start, charger_id, station_id, samples, sum_power, max_power, "
+                   "sum_queue, max_queue, sum_utilization, occupied_samples, failure_samples")
+
+# 原始数据按汇总表的列形式读出，便于与汇总层 UNION
+_RAW_AS_ROLLUP_SQL = """
+    SELECT timestamp AS bucket_start, charger_id, station_id, 1 AS samples,
+           power_output AS sum_power, power_output AS max_power,
+           queue_length AS sum_queue, queue_length AS max_queue, utilization_rate AS sum_utilization,
+           CASE WHEN status = 'occupied' THEN 1 ELSE 0 END AS occupied_samples,
+           CASE WHEN status = 'failure' THEN 1 ELSE 0 END AS failure_samples
+    FROM realtime_data
+"""
+
+_ROLLUP_UPSERT = """
+    ON CONFLICT(charger_id, bucket_start) DO UPDATE SET
+        station_id = excluded.station_id,
+        samples = samples + excluded.samples,
+        sum_power = sum_power + excluded.sum_power,
+        max_power = MAX(max_power, excluded.max_power),
+        sum_queue = sum_queue + excluded.sum_queue,
+        max_queue = MAX(max_queue, excluded.max_queue),
+        sum_utilization = sum_utilization + excluded.sum_utilization,
+        occupied_samples = occupied_samples + excluded.occupied_samples,
+        failure_samples = failure_samples + excluded.failure_samples
+"""
+
+
+def _format_timestamp(value: datetime) -> str:
+    return value.strftime('%Y-%m-%d %H:%M:%S')
+
+
+def _parse_timestamp(value) -> datetime:
+    """解析库中的时间戳 (sqlite3 默认适配器写入 'YYYY-MM-DD HH:MM:SS[.ffffff]'，也接受 ISO 格式的 'T')"""
+    if isinstance(value, datetime):
+        return value
+    return datetime.fromisoformat(str(value).replace('T', ' '))
+
+
 class OperatorDataStorage:
-    """运营商数据存储管理类"""
+    """
+    运营商数据存储管理类
+
+    使用长连接 (WAL 模式)。查询和需要返回值的写操作 (告警、工单) 在调用线程上同步执行；
+    实时快照、充电会话、财务记录、需求预测等批量写入放入队列，由后台写线程合并成批量事务
+    (executemany) 写入，仿真线程不会因为磁盘写入而阻塞。需要立即读到刚写入的数据时调用 flush()。
+    会话和实时快照历史的分析查询由 self.analytics (见 storage_backends) 执行，可选 sqlite 或 duckdb。
+    """
     
-    def __init__(self, db_path: str = "operator_data.db"):
+    def __init__(self, db_path: str = "operator_data.db", async_writes: bool = True, batch_size: int = 5000,
+                 retention: Optional[Dict] = None, analytics_backend: str = "sqlite",
+                 analytics_path: Optional[str] = None):
         self.db_path = db_path
+        self.async_writes = async_writes
+        self.batch_size = max(1, batch_size)  # 后台写线程单个事务最多合并的行数
+        self.retention = dict(DEFAULT_RETENTION)
+        self.retention.update(retention or {})
+        self._last_compaction = time.monotonic()
+        self._local = threading.local()  # 每个线程各自的长连接
+        self._connections = []
+        self._conn_lock = threading.Lock()
+        self._write_queue = queue.Queue()
+        self._writer = None
+        self._writer_lock = threading.Lock()
+        # 提交到 SQLite 和转发到分析后端在这把锁内完成，切换分析后端时持有它以暂停写线程
+        self._analytics_lock = threading.RLock()
+        self._analytics_lagging = set()  # 追加到分析后端失败、停止推进高水位的表
+        self._commit_listeners = []
+        self._closed = False
         self._init_database()
+        self.analytics: AnalyticsBackend = create_analytics_backend(analytics_backend, self, analytics_path)
+        atexit.register(self.close)
+
+    # === 连接与批量写入 ===
+
+    def _open_connection(self):
+        conn = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False, cached_statements=256)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _thread_connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._open_connection()
+            self._local.conn = conn
+            with self._conn_lock:
+                self._connections.append(conn)
+        return conn
+
+    @contextmanager
+    def _db(self):
+        """
+        同步读写使用的长连接，每个线程一条 (WAL 模式下后台查询线程上的长查询不会阻塞 GUI 线程的读)；
+        with 块结束时提交事务，出错时回滚
+        """
+        conn = self._thread_connection()
+        with conn:
+            yield conn
+
+    def _enqueue_rows(self, sql: str, rows: List[Tuple]):
+        """把待写入的行交给后台写线程；关闭异步写入时直接批量写入"""
+        if not rows:
+            return
+        if not self.async_writes or self._closed:
+            with self._analytics_lock:
+                with self._db() as conn:
+                    conn.executemany(sql, rows)
+                self._forward_to_analytics(conn, sql, rows)
+            self._notify_commit({_SQL_TABLES.get(sql)})
+            return
+        self._ensure_writer()
+        self._write_queue.put((sql, rows))
+
+    def _ensure_writer(self):
+        if self._writer is not None and self._writer.is_alive():
+            return
+        with self._writer_lock:
+            if self._writer is None or not self._writer.is_alive():
+                self._writer = threading.Thread(target=self._writer_loop, name="operator-storage-writer", daemon=True)
+                self._writer.start()
+
+    def _writer_loop(self):
+        """后台写线程: 取出队列中已有的全部写入 (最多 batch_size 行)，在一个事务里按语句分组 executemany"""
+        conn = self._open_connection()
+        try:
+            while True:
+                item = self._write_queue.get()
+                batch = [] if item is _STOP_WRITER else [item]
+                stop = item is _STOP_WRITER
+                row_count = sum(len(rows) for _, rows in batch)
+                while not stop and row_count < self.batch_size:
+                    try:
+                        item = self._write_queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if item is _STOP_WRITER:
+                        stop = True
+                        break
+                    batch.append(item)
+                    row_count += len(item[1])
+
+                if batch:
+                    # 相邻的同一语句合并为一次 executemany，保持写入顺序
+                    groups = []
+                    for sql, rows in batch:
+                        if groups and groups[-1][0] == sql:
+                            groups[-1][1].extend(rows)
+                        else:
+                            groups.append((sql, list(rows)))
+                    with self._analytics_lock:
+                        try:
+                            with conn:
+                                for sql, rows in groups:
+                                    conn.executemany(sql, rows)
+                        except Exception as e:
+                            logger.warning(f"批量写入失败 ({row_count} 行)，逐条重试: {e}")
+                            groups = self._write_groups_isolated(conn, groups)
+                        for sql, rows in groups:
+                            self._forward_to_analytics(conn, sql, rows)
+                    self._notify_commit({_SQL_TABLES.get(sql) for sql, _ in groups})
+                for _ in range(len(batch) + (1 if stop else 0)):
+                    self._write_queue.task_done()
+                if stop:
+                    break
+                # 后台写线程定期做降采样和过期清理，不占用仿真线程
+                interval = self.retention.get("compaction_interval_s")
+                if interval is not None and time.monotonic() - self._last_compaction >= interval:
+                    self._last_compaction = time.monotonic()
+                    self._compact(conn)
+                    self._notify_commit({"realtime_data"})
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _write_groups_isolated(conn, groups):
+        """
+        批量事务失败后的重试: 每个语句组单独一个事务；组内仍失败时逐行写入 (出错的语句只回滚自身，事务继续)，
+        只丢弃出错的行。返回实际写入的 (sql, rows)
+        """
+        written = []
+        for sql, rows in groups:
+            try:
+                with conn:
+                    conn.executemany(sql, rows)
+                written.append((sql, rows))
+                continue
+            except Exception:
+                pass
+            ok_rows = []
+            with conn:
+                for row in rows:
+                    try:
+                        conn.execute(sql, row)
+                        ok_rows.append(row)
+                    except Exception as e:
+                        logger.error(f"写入失败，丢弃 1 行: {e} ({row})")
+            if ok_rows:
+                written.append((sql, ok_rows))
+        return written
+
+    def add_commit_listener(self, callback: Callable[[Set[str]], None]):
+        """
+        注册批次提交回调: 每个批次提交到 SQLite (并转发到分析后端) 之后以写入的表名集合调用。
+        回调在后台写线程上执行，应尽快返回 (例如只发出 Qt 信号)
+        """
+        if callback not in self._commit_listeners:
+            self._commit_listeners.append(callback)
+
+    def remove_commit_listener(self, callback: Callable[[Set[str]], None]):
+        if callback in self._commit_listeners:
+            self._commit_listeners.remove(callback)
+
+    def _notify_commit(self, tables: Set[str]):
+        tables.discard(None)
+        if not tables:
+            return
+        for callback in list(self._commit_listeners):
+            try:
+                callback(tables)
+            except Exception as e:
+                logger.error(f"批次提交回调出错: {e}")
+
+    def _forward_to_analytics(self, conn, sql: str, rows: List[Tuple]):
+        """
+        已提交到 SQLite 的会话/快照同步追加到分析后端 (SQLite 后端为空操作)，并推进分析后端的高水位。
+        调用方持有 _analytics_lock，此时 SQLite 中的最大 id 就是已转发的最后一行。
+        某个表追加失败后不再推进它的高水位，下次打开分析库时从失败处补导入
+        """
+        if self.analytics.name == "sqlite":
+            return
+        if sql is INSERT_SESSION_SQL:
+            table, append = "charging_sessions", self.analytics.append_sessions
+        elif sql is INSERT_REALTIME_SQL:
+            table, append = "realtime_data", self.analytics.append_snapshots
+        else:
+            return
+        try:
+            append(rows)
+            if table not in self._analytics_lagging:
+                last_id = conn.execute(f"SELECT MAX(id) FROM {table}").fetchone()[0]
+                self.analytics.mark_synced(table, last_id or 0)
+        except Exception as e:
+            self._analytics_lagging.add(table)
+            logger.error(f"追加到分析后端 {self.analytics.name} 失败 ({len(rows)} 行): {e}")
+
+    def set_analytics_backend(self, name: str, path: Optional[str] = None):
+        """
+        切换分析后端；DuckDB 分析库打开时从 SQLite 导入高水位之后的数据。
+        切换期间写线程暂停: 切换前提交的批次已转发给旧后端 (并包含在导入中)，之后提交的批次只转发给新后端，
+        不需要等待写入队列清空
+        """
+        with self._analytics_lock:
+            previous = self.analytics
+            self.analytics = create_analytics_backend(name, self, path)
+            self._analytics_lagging = set()
+        previous.close()
+        return self.analytics.name
+
+    # === 保留策略与降采样 ===
+
+    def compact_realtime_data(self, reference_time: Optional[datetime] = None) -> Dict:
+        """
+        把尚未汇总的原始数据汇总到 15 分钟/小时层级并按保留策略清理过期数据，返回统计信息。
+        异步写入时后台写线程每 compaction_interval_s 秒自动执行一次。
+        """
+        self.flush()
+        return self._compact(self._thread_connection(), reference_time)
+
+    def _compact(self, conn, reference_time=None):
+        stats = {"rolled_hourly": 0, "rolled_15min": 0, "pruned_raw": 0, "pruned_15min": 0, "pruned_hourly": 0}
+        try:
+            # 1. 按插入顺序增量汇总: 每个层级汇总 id 在 (已汇总的最大 id, 当前最大 id] 内的原始数据。
+            #    汇总是可加的 (upsert 累加)，之后写入同一时间桶的数据 (包括仿真时间回退后写入的) 会合并进同一行。
+            #    读取进度、汇总和更新进度在同一个 BEGIN IMMEDIATE 事务中，并发的汇总不会重复累加。
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                max_id = conn.execute("SELECT MAX(id) FROM realtime_data").fetchone()[0] or 0
+                rolled = dict(conn.execute("SELECT tier, rolled_id FROM rollup_progress").fetchall())
+                for tier, _, table, bucket_sql in ROLLUP_TIERS:
+                    since_id = rolled.get(tier, 0)
+                    if since_id < max_id:
+                        stats[f"rolled_{tier}"] = conn.execute(f"""
+                            INSERT INTO {table} ({_ROLLUP_COLUMNS})
+                            SELECT {bucket_sql}, charger_id, MAX(station_id), COUNT(*),
+                                   SUM(power_output), MAX(power_output), SUM(queue_length), MAX(queue_length), SUM(utilization_rate),
+                                   SUM(CASE WHEN status = 'occupied' THEN 1 ELSE 0 END), SUM(CASE WHEN status = 'failure' THEN 1 ELSE 0 END)
+                            FROM realtime_data
+                            WHERE id > ? AND id <= ?
+                            GROUP BY 1, charger_id
+                            {_ROLLUP_UPSERT}
+                        """, (since_id, max_id)).rowcount
+                        conn.execute("INSERT OR REPLACE INTO rollup_progress (tier, rolled_id) VALUES (?, ?)", (tier, max_id))
+                    rolled[tier] = max(since_id, max_id)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+
+            # 2. 清理过期数据，天数以库中最新的仿真时间为基准；原始数据只删除已汇总到所有层级的行。
+            #    按天分批删除以缩短单个事务
+            if reference_time is None:
+                latest = conn.execute("SELECT MAX(timestamp) FROM realtime_data").fetchone()[0]
+                if latest is None:
+                    return stats
+                reference_time = _parse_timestamp(latest)
+            fully_rolled_id = min(rolled.values())
+            for stat_key, retention_key, table, column, extra_where, extra_params in (
+                ("pruned_raw", "raw_days", "realtime_data", "timestamp", "AND id <= ?", (fully_rolled_id,)),
+                ("pruned_15min", "rollup_15min_days", "realtime_rollup_15min", "bucket_start", "", ()),
+                ("pruned_hourly", "rollup_hourly_days", "realtime_rollup_hourly", "bucket_start", "", ()),
+            ):
+                days = self.retention.get(retention_key)
+                if days is None:
+                    continue
+                prune_before = _format_timestamp(reference_time - timedelta(days=days))
+                stats[stat_key] = self._delete_by_day(conn, table, column, prune_before, extra_where, extra_params)
+
+            logger.info(f"realtime_data 降采样/清理完成: {stats}")
+        except Exception as e:
+            logger.error(f"realtime_data 降采样/清理失败: {e}")
+        return stats
+
+    @staticmethod
+    def _delete_by_day(conn, table, column, before, extra_where="", extra_params=()):
+        oldest = conn.execute(f"SELECT MIN({column}) FROM {table} WHERE 1 {extra_where}", extra_params).fetchone()[0]
+        if oldest is None or oldest >= before:
+            return 0
+        deleted = 0
+        day = _parse_timestamp(oldest).replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1)
+        while True:
+            bound = min(_format_timestamp(day), before)
+            with conn:
+                deleted += conn.execute(f"DELETE FROM {table} WHERE {column} < ? {extra_where}",
+                                        (bound,) + tuple(extra_params)).rowcount
+            if bound >= before:
+                return deleted
+            day += timedelta(days=1)
+
+    def _realtime_source(self, conn, start: str, resolution_minutes: int = 60) -> Tuple[str, List, List[str]]:
+        """
+        realtime 数据的查询路由: 返回 (子查询 SQL, 参数, 使用的层级)，子查询为汇总表列形式的 [start, 现在] 数据。
+        使用分辨率不超过 resolution_minutes 的最粗层级，加上该层级尚未汇总的原始数据 (id 大于汇总进度)。
+        比所有汇总层级都细的分辨率只读原始数据，因此只覆盖 raw_days 保留期内的数据。
+        """
+        rolled = dict(conn.execute("SELECT tier, rolled_id FROM rollup_progress").fetchall())
+        for tier, resolution, table, _ in ROLLUP_TIERS:
+            if resolution <= resolution_minutes:
+                sql = (f"SELECT {_ROLLUP_COLUMNS} FROM {table} WHERE bucket_start >= ? "
+                       f"UNION ALL {_RAW_AS_ROLLUP_SQL} WHERE timestamp >= ? AND id > ?")
+                return sql, [start, start, rolled.get(tier, 0)], [tier, "raw"]
+        return f"{_RAW_AS_ROLLUP_SQL} WHERE timestamp >= ?", [start], ["raw"]
+
+    def flush(self):
+        """等待后台写线程写完所有已排队的数据"""
+        if self._writer is not None and self._writer.is_alive():
+            self._write_queue.join()
+
+    def close(self):
+        """写完排队数据并关闭连接 (进程退出时自动调用)"""
+        if self._closed:
+            return
+        self._closed = True
+        if self._writer is not None and self._writer.is_alive():
+            self._write_queue.put(_STOP_WRITER)
+            self._writer.join()
+        self._writer = None
+        self.analytics.close()
+        with self._conn_lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections = []
+            self._local = threading.local()
     
     def _init_database(self):
         """初始化数据库表结构"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._db() as conn:
                 cursor = conn.cursor()
                 
                 # 实时运行数据表
@@ -160,37 +809,63 @@ class OperatorDataStorage:
                 """)
                 
                 conn.commit()
+                self._apply_migrations(conn)
                 logger.info("运营商数据库初始化完成")
                 
         except Exception as e:
             logger.error(f"数据库初始化失败: {e}")
     
+    def _apply_migrations(self, conn):
+        """按版本号顺序执行尚未应用的迁移，每个迁移在一个事务中完成"""
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INTEGER PRIMARY KEY,
+                name TEXT NOT NULL,
+                applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        conn.commit()
+        applied = {row[0] for row in conn.execute("SELECT version FROM schema_migrations")}
+        for version, name, statements in MIGRATIONS:
+            if version in applied:
+                continue
+            try:
+                for statement in statements:
+                    conn.execute(statement)
+                conn.execute("INSERT INTO schema_migrations (version, name) VALUES (?, ?)", (version, name))
+                conn.commit()
+                logger.info(f"已应用数据库迁移 {version}: {name}")
+            except Exception as e:
+                conn.rollback()
+                logger.error(f"数据库迁移 {version} ({name}) 失败: {e}")
+                break
+
+    def schema_version(self) -> int:
+        """当前数据库已应用的最高迁移版本"""
+        try:
+            with self._db() as conn:
+                row = conn.execute("SELECT MAX(version) FROM schema_migrations").fetchone()
+                return row[0] or 0
+        except Exception as e:
+            logger.error(f"读取数据库版本失败: {e}")
+            return 0
+
     # === 实时数据管理 ===
     
     def save_realtime_snapshot(self, chargers_data: List[Dict], timestamp: datetime):
-        """保存实时数据快照"""
+        """保存实时数据快照 (后台批量写入)"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                
-                for charger in chargers_data:
-                    cursor.execute("""
-                        INSERT INTO realtime_data 
-                        (timestamp, charger_id, station_id, status, power_output, 
-                         queue_length, current_user, utilization_rate)
-                        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-                    """, (
-                        timestamp,
-                        charger.get('charger_id'),
-                        charger.get('location', 'unknown'),
-                        charger.get('status', 'unknown'),
-                        charger.get('current_power', 0),
-                        len(charger.get('queue', [])),
-                        charger.get('current_user'),
-                        charger.get('utilization_rate', 0)
-                    ))
-                
-                conn.commit()
+            rows = [(
+                timestamp,
+                charger.get('charger_id'),
+                charger.get('location', 'unknown'),
+                charger.get('status', 'unknown'),
+                charger.get('current_power', 0),
+                len(charger.get('queue', [])),
+                charger.get('current_user'),
+                charger.get('utilization_rate', 0)
+            ) for charger in chargers_data]
+            self._enqueue_rows(INSERT_REALTIME_SQL, rows)
                 
         except Exception as e:
             logger.error(f"保存实时数据失败: {e}")
@@ -198,8 +873,8 @@ class OperatorDataStorage:
     def get_latest_station_status(self) -> Dict[str, Dict]:
         """获取各站点最新状态"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                # 使用SQLite兼容的子查询方式获取每个充电桩的最新记录
+            with self._db() as conn:
+                # 每个充电桩的最新记录由触发器维护在 charger_latest_status 中 (迁移 2)
                 query = """
                     SELECT 
                         station_id,
@@ -209,15 +884,7 @@ class OperatorDataStorage:
                         SUM(CASE WHEN status = 'failure' THEN 1 ELSE 0 END) as failed,
                         AVG(utilization_rate) as avg_utilization,
                         SUM(queue_length) as total_queue
-                    FROM (
-                        SELECT r.*
-                        FROM realtime_data r
-                        INNER JOIN (
-                            SELECT charger_id, MAX(timestamp) as max_time
-                            FROM realtime_data
-                            GROUP BY charger_id
-                        ) m ON r.charger_id = m.charger_id AND r.timestamp = m.max_time
-                    ) latest
+                    FROM charger_latest_status
                     GROUP BY station_id
                 """
                 
@@ -236,34 +903,28 @@ class OperatorDataStorage:
     
     def save_charging_session(self, session_data: Dict):
         """保存充电会话记录"""
+        self.save_charging_sessions([session_data])
+
+    def save_charging_sessions(self, sessions: List[Dict]):
+        """批量保存充电会话记录 (后台批量写入)"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                
-                cursor.execute("""
-                    INSERT OR REPLACE INTO charging_sessions 
-                    (session_id, charger_id, station_id, user_id, start_time, 
-                     end_time, duration_minutes, energy_kwh, cost, revenue,
-                     start_soc, end_soc, price_per_kwh, service_fee)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                """, (
-                    session_data.get('session_id'),
-                    session_data.get('charger_id'),
-                    session_data.get('station_id'),
-                    session_data.get('user_id'),
-                    session_data.get('start_time'),
-                    session_data.get('end_time'),
-                    session_data.get('duration_minutes', 0),
-                    session_data.get('energy_kwh', 0),
-                    session_data.get('cost', 0),
-                    session_data.get('revenue', 0),
-                    session_data.get('start_soc', 0),
-                    session_data.get('end_soc', 0),
-                    session_data.get('price_per_kwh', 0),
-                    session_data.get('service_fee', 0)
-                ))
-                
-                conn.commit()
+            rows = [(
+                session_data.get('session_id'),
+                session_data.get('charger_id'),
+                session_data.get('station_id'),
+                session_data.get('user_id'),
+                session_data.get('start_time'),
+                session_data.get('end_time'),
+                session_data.get('duration_minutes', 0),
+                session_data.get('energy_kwh', 0),
+                session_data.get('cost', 0),
+                session_data.get('revenue', 0),
+                session_data.get('start_soc', 0),
+                session_data.get('end_soc', 0),
+                session_data.get('price_per_kwh', 0),
+                session_data.get('service_fee', 0)
+            ) for session_data in sessions]
+            self._enqueue_rows(INSERT_SESSION_SQL, rows)
                 
         except Exception as e:
             logger.error(f"保存充电会话失败: {e}")
@@ -275,24 +936,22 @@ class OperatorDataStorage:
                             station_id: Optional[str] = None) -> pd.DataFrame:
         """获取财务汇总数据，支持按小时聚合"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                # --- START OF MODIFICATION ---
-                # 查询语句改为按小时聚合 (strftime('%Y-%m-%d %H:00:00'))
+            with self._db() as conn:
+                # 读取按小时、站点预聚合的 financial_hourly_rollup (由会话写入触发器维护)
                 query = """
                     SELECT 
-                        strftime('%Y-%m-%d %H:00:00', start_time) as datetime_hour,
+                        hour_start as datetime_hour,
                         station_id,
-                        COUNT(*) as sessions_count,
-                        SUM(energy_kwh) as total_energy,
-                        SUM(revenue) as total_revenue,
-                        SUM(cost) as total_cost,
-                        SUM(revenue) - SUM(cost) as total_profit,
-                        AVG(price_per_kwh) as avg_price,
-                        AVG(duration_minutes) as avg_duration
-                    FROM charging_sessions
-                    WHERE start_time BETWEEN ? AND ?
+                        sessions_count,
+                        total_energy,
+                        total_revenue,
+                        total_cost,
+                        total_revenue - total_cost as total_profit,
+                        sum_price / NULLIF(price_samples, 0) as avg_price,
+                        sum_duration / NULLIF(duration_samples, 0) as avg_duration
+                    FROM financial_hourly_rollup
+                    WHERE hour_start BETWEEN ? AND ?
                 """
-                # --- END OF MODIFICATION ---
                 
                 # 调整日期范围以确保包含 end_date 的所有小时
                 start_dt_str = f"{start_date} 00:00:00"
@@ -303,8 +962,7 @@ class OperatorDataStorage:
                     query += " AND station_id = ?"
                     params.append(station_id)
                 
-                # 按小时和站点分组
-                query += " GROUP BY datetime_hour, station_id ORDER BY datetime_hour, station_id"
+                query += " ORDER BY datetime_hour, station_id"
                 
                 df = pd.read_sql_query(query, conn, params=params)
                 logger.info(f"Financial summary query returned {len(df)} hourly records for period {start_date} to {end_date}.")
@@ -315,30 +973,20 @@ class OperatorDataStorage:
             return pd.DataFrame()
     
     def save_hourly_financial_record(self, record: Dict):
-        """保存小时级财务记录"""
+        """保存小时级财务记录 (后台批量写入)"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                
-                cursor.execute("""
-                    INSERT OR REPLACE INTO financial_records
-                    (date, hour, station_id, revenue, electricity_cost, 
-                     service_cost, profit, sessions_count, energy_delivered, avg_price_per_kwh)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                """, (
-                    record.get('date'),
-                    record.get('hour'),
-                    record.get('station_id'),
-                    record.get('revenue', 0),
-                    record.get('electricity_cost', 0),
-                    record.get('service_cost', 0),
-                    record.get('profit', 0),
-                    record.get('sessions_count', 0),
-                    record.get('energy_delivered', 0),
-                    record.get('avg_price_per_kwh', 0)
-                ))
-                
-                conn.commit()
+            self._enqueue_rows(INSERT_FINANCIAL_SQL, [(
+                record.get('date'),
+                record.get('hour'),
+                record.get('station_id'),
+                record.get('revenue', 0),
+                record.get('electricity_cost', 0),
+                record.get('service_cost', 0),
+                record.get('profit', 0),
+                record.get('sessions_count', 0),
+                record.get('energy_delivered', 0),
+                record.get('avg_price_per_kwh', 0)
+            )])
                 
         except Exception as e:
             logger.error(f"保存财务记录失败: {e}")
@@ -351,7 +999,7 @@ class OperatorDataStorage:
             # --- START OF FIX: 防止重复告警 ---
             # 对于特定类型的告警，如果已存在一个活跃的同类告警，则不重复创建。
             # 例如，一个充电桩的故障告警，只要还是 active，就不再创建新的。
-            with sqlite3.connect(self.db_path) as conn:
+            with self._db() as conn:
                 cursor = conn.cursor()
                 
                 # 检查是否存在相同的、仍在活跃的告警
@@ -375,7 +1023,7 @@ class OperatorDataStorage:
 
             alert_id = f"ALERT_{datetime.now().strftime('%Y%m%d%H%M%S%f')}_{alert_data.get('charger_id', 'SYS')}"
             
-            with sqlite3.connect(self.db_path) as conn:
+            with self._db() as conn:
                 cursor = conn.cursor()
                 cursor.execute("""
                     INSERT INTO alerts 
@@ -401,7 +1049,7 @@ class OperatorDataStorage:
     def get_active_alerts(self) -> List[Dict]:
         """获取活跃告警"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._db() as conn:
                 query = """
                     SELECT * FROM alerts 
                     WHERE status = 'active' 
@@ -418,7 +1066,7 @@ class OperatorDataStorage:
     def resolve_alert(self, alert_id: str, resolved_by: str, notes: str = ""):
         """解决告警"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._db() as conn:
                 cursor = conn.cursor()
                 
                 cursor.execute("""
@@ -442,7 +1090,7 @@ class OperatorDataStorage:
         try:
             order_id = f"MO_{datetime.now().strftime('%Y%m%d%H%M%S')}_{order_data.get('charger_id')}"
             
-            with sqlite3.connect(self.db_path) as conn:
+            with self._db() as conn:
                 cursor = conn.cursor()
                 
                 cursor.execute("""
@@ -471,7 +1119,7 @@ class OperatorDataStorage:
                               station_id: Optional[str] = None) -> pd.DataFrame:
         """获取维护历史"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._db() as conn:
                 query = """
                     SELECT * FROM maintenance_orders
                     WHERE created_at >= date('now', ? || ' days')
@@ -495,43 +1143,32 @@ class OperatorDataStorage:
         返回按 (星期几, 小时) 聚合的平均会话数和每日趋势。
         """
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                # 查询过去N天的每小时会话数
-                query = """
-                    SELECT 
-                        strftime('%Y-%m-%d', start_time) as date,
-                        strftime('%w', start_time) as weekday, -- 0=Sunday, 1=Monday, ..., 6=Saturday
-                        strftime('%H', start_time) as hour,
-                        COUNT(*) as sessions
-                    FROM charging_sessions
-                    WHERE station_id = ? AND start_time >= date('now', ? || ' days')
-                    GROUP BY date, hour
-                """
-                df = pd.read_sql_query(query, conn, params=[station_id, f'-{days}'])
-
-                if df.empty:
-                    logger.warning(f"No historical data found for station {station_id} in the last {days} days.")
-                    return {"hourly_avg": pd.DataFrame(), "daily_trend": 0.0}
-
-                # 计算每日总会话数以分析趋势
-                daily_totals = df.groupby('date')['sessions'].sum()
-                # 简单的线性回归来找趋势
-                if len(daily_totals) > 1:
-                    x = np.arange(len(daily_totals))
-                    y = daily_totals.values
-                    # 使用 numpy.polyfit 进行线性回归
-                    coeffs = np.polyfit(x, y, 1)
-                    daily_trend = coeffs[0] # 斜率，即每日会话数的平均增长量
-                else:
-                    daily_trend = 0.0
+            # 查询过去N天的每小时会话数
+            df = self.analytics.demand_counts(station_id, self._days_ago(days))
 
-                # 计算按 (星期几, 小时) 聚合的平均会话数
-                df['weekday'] = df['weekday'].astype(int)
-                df['hour'] = df['hour'].astype(int)
-                hourly_avg = df.groupby(['weekday', 'hour'])['sessions'].mean().reset_index()
-                
-                logger.info(f"Generated historical demand patterns for station {station_id}. Daily trend: {daily_trend:.2f} sessions/day.")
-                return {"hourly_avg": hourly_avg, "daily_trend": daily_trend}
+            if df.empty:
+                logger.warning(f"No historical data found for station {station_id} in the last {days} days.")
+                return {"hourly_avg": pd.DataFrame(), "daily_trend": 0.0}
+
+            # 计算每日总会话数以分析趋势
+            daily_totals = df.groupby('date')['sessions'].sum()
+            # 简单的线性回归来找趋势
+            if len(daily_totals) > 1:
+                x = np.arange(len(daily_totals))
+                y = daily_totals.values
+                # 使用 numpy.polyfit 进行线性回归
+                coeffs = np.polyfit(x, y, 1)
+                daily_trend = coeffs[0] # 斜率，即每日会话数的平均增长量
+            else:
+                daily_trend = 0.0
+
+            # 计算按 (星期几, 小时) 聚合的平均会话数
+            df['weekday'] = df['weekday'].astype(int)
+            df['hour'] = df['hour'].astype(int)
+            hourly_avg = df.groupby(['weekday', 'hour'])['sessions'].mean().reset_index()
+            
+            logger.info(f"Generated historical demand patterns for station {station_id}. Daily trend: {daily_trend:.2f} sessions/day.")
+            return {"hourly_avg": hourly_avg, "daily_trend": daily_trend}
 
         except Exception as e:
             logger.error(f"获取历史需求模式失败: {e}")
@@ -539,30 +1176,19 @@ class OperatorDataStorage:
     # === 需求预测 ===
     
     def save_demand_forecast(self, forecast_data: List[Dict]):
-        """保存需求预测数据"""
+        """保存需求预测数据 (后台批量写入)"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                
-                for forecast in forecast_data:
-                    cursor.execute("""
-                        INSERT OR REPLACE INTO demand_forecast
-                        (forecast_date, station_id, hour, predicted_sessions,
-                         predicted_energy, predicted_queue_length, 
-                         confidence_level, model_version)
-                        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-                    """, (
-                        forecast.get('forecast_date'),
-                        forecast.get('station_id'),
-                        forecast.get('hour'),
-                        forecast.get('predicted_sessions', 0),
-                        forecast.get('predicted_energy', 0),
-                        forecast.get('predicted_queue_length', 0),
-                        forecast.get('confidence_level', 0.8),
-                        forecast.get('model_version', 'v1.0')
-                    ))
-                
-                conn.commit()
+            rows = [(
+                forecast.get('forecast_date'),
+                forecast.get('station_id'),
+                forecast.get('hour'),
+                forecast.get('predicted_sessions', 0),
+                forecast.get('predicted_energy', 0),
+                forecast.get('predicted_queue_length', 0),
+                forecast.get('confidence_level', 0.8),
+                forecast.get('model_version', 'v1.0')
+            ) for forecast in forecast_data]
+            self._enqueue_rows(INSERT_FORECAST_SQL, rows)
                 
         except Exception as e:
             logger.error(f"保存需求预测失败: {e}")
@@ -570,7 +1196,7 @@ class OperatorDataStorage:
     def get_demand_forecast(self, station_id: str, days: int = 7) -> pd.DataFrame:
         """获取需求预测"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._db() as conn:
                 query = """
                     SELECT * FROM demand_forecast
                     WHERE station_id = ?
@@ -585,44 +1211,21 @@ class OperatorDataStorage:
             return pd.DataFrame()
     
     # === 分析方法 ===
+
+    def _days_ago(self, days: int) -> str:
+        """SQLite 的 date('now', '-N days')，作为各分析后端共用的起始日期"""
+        with self._db() as conn:
+            return conn.execute("SELECT date('now', ?)", (f'-{days} days',)).fetchone()[0]
     
     def analyze_station_performance(self, station_id: str, days: int = 30) -> Dict:
         """分析站点性能"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                # 获取基础统计
-                stats_query = """
-                    SELECT 
-                        COUNT(DISTINCT DATE(start_time)) as operating_days,
-                        COUNT(*) as total_sessions,
-                        SUM(energy_kwh) as total_energy,
-                        SUM(revenue) as total_revenue,
-                        AVG(duration_minutes) as avg_session_duration,
-                        AVG(energy_kwh) as avg_energy_per_session,
-                        AVG(price_per_kwh) as avg_price
-                    FROM charging_sessions
-                    WHERE station_id = ?
-                    AND start_time >= date('now', ? || ' days')
-                """
-                
-                stats_df = pd.read_sql_query(stats_query, conn, 
-                                            params=[station_id, f'-{days}'])
-                
-                # 获取时段分布
-                hourly_query = """
-                    SELECT 
-                        strftime('%H', start_time) as hour,
-                        COUNT(*) as sessions,
-                        SUM(energy_kwh) as energy
-                    FROM charging_sessions
-                    WHERE station_id = ?
-                    AND start_time >= date('now', ? || ' days')
-                    GROUP BY hour
-                """
-                
-                hourly_df = pd.read_sql_query(hourly_query, conn,
-                                             params=[station_id, f'-{days}'])
-                
+            since = self._days_ago(days)
+            # 会话统计和时段分布由分析后端执行
+            stats_df = self.analytics.session_stats(station_id, since)
+            hourly_df = self.analytics.hourly_distribution(station_id, since)
+
+            with self._db() as conn:
                 # 获取故障统计
                 failure_query = """
                     SELECT 
@@ -649,55 +1252,55 @@ class OperatorDataStorage:
     def get_expansion_recommendations(self) -> List[Dict]:
         """获取扩容建议"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                # 分析高负载站点
-                query = """
-                    SELECT 
-                        s.station_id,
-                        s.name,
-                        AVG(r.utilization_rate) as avg_utilization,
-                        AVG(r.queue_length) as avg_queue,
-                        COUNT(DISTINCT r.charger_id) as charger_count,
-                        SUM(CASE WHEN r.status = 'failure' THEN 1 ELSE 0 END) / 
-                            COUNT(*) * 100 as failure_rate
-                    FROM station_config s
-                    LEFT JOIN (
-                        SELECT * FROM realtime_data 
-                        WHERE timestamp >= datetime('now', '-7 days')
-                    ) r ON s.station_id = r.station_id
-                    GROUP BY s.station_id, s.name
-                    HAVING avg_utilization > 0.7 OR avg_queue > 3
-                """
-                
-                high_load_df = pd.read_sql_query(query, conn)
-                
-                recommendations = []
-                for _, station in high_load_df.iterrows():
-                    if station['avg_utilization'] > 0.8:
-                        rec_type = 'urgent_expansion'
-                        additional_chargers = max(2, int(station['charger_count'] * 0.5))
-                    elif station['avg_utilization'] > 0.7:
-                        rec_type = 'expansion'
-                        additional_chargers = max(1, int(station['charger_count'] * 0.3))
-                    else:
-                        rec_type = 'optimization'
-                        additional_chargers = 0
-                    
-                    recommendations.append({
-                        'station_id': station['station_id'],
-                        'station_name': station['name'],
-                        'recommendation_type': rec_type,
-                        'current_utilization': station['avg_utilization'],
-                        'avg_queue_length': station['avg_queue'],
-                        'suggested_additional_chargers': additional_chargers,
-                        'priority': 'high' if rec_type == 'urgent_expansion' else 'medium'
-                    })
-                
-                return recommendations
+            with self._db() as conn:
+                since = conn.execute("SELECT datetime('now', '-7 days')").fetchone()[0]
+                stations_df = pd.read_sql_query("SELECT station_id, name FROM station_config", conn)
+
+            # 分析高负载站点 (各站点 7 天的负载由分析后端计算)
+            load_df = self.analytics.station_load(since)
+            high_load_df = stations_df.merge(load_df, on='station_id')
+            high_load_df = high_load_df[(high_load_df['avg_utilization'] > 0.7) | (high_load_df['avg_queue'] > 3)]
+
+            recommendations = []
+            for _, station in high_load_df.iterrows():
+                if station['avg_utilization'] > 0.8:
+                    rec_type = 'urgent_expansion'
+                    additional_chargers = max(2, int(station['charger_count'] * 0.5))
+                elif station['avg_utilization'] > 0.7:
+                    rec_type = 'expansion'
+                    additional_chargers = max(1, int(station['charger_count'] * 0.3))
+                else:
+                    rec_type = 'optimization'
+                    additional_chargers = 0
                 
+                recommendations.append({
+                    'station_id': station['station_id'],
+                    'station_name': station['name'],
+                    'recommendation_type': rec_type,
+                    'current_utilization': station['avg_utilization'],
+                    'avg_queue_length': station['avg_queue'],
+                    'suggested_additional_chargers': additional_chargers,
+                    'priority': 'high' if rec_type == 'urgent_expansion' else 'medium'
+                })
+            
+            return recommendations
+            
         except Exception as e:
             logger.error(f"获取扩容建议失败: {e}")
             return []
 
+def create_operator_storage(storage_config: Optional[Dict] = None) -> OperatorDataStorage:
+    """按 config['data_storage'] 创建运营商数据存储 (数据库路径、分析后端、保留策略)"""
+    storage_config = storage_config if storage_config is not None else {}
+    return OperatorDataStorage(
+        db_path=storage_config.get("database_path", "operator_data.db"),
+        async_writes=storage_config.get("async_writes", True),
+        batch_size=storage_config.get("batch_size", 5000),
+        retention=storage_config.get("retention"),
+        analytics_backend=storage_config.get("analytics_backend", "sqlite"),
+        analytics_path=storage_config.get("analytics_path"),
+    )
+
+
 # 全局数据存储实例
-operator_storage = OperatorDataStorage()
\ No newline at end of file
+operator_storage = create_operator_storage(utils_config.get("data_storage", {}))
\ No newline at end of file
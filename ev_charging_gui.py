@@ -1469,7 +1469,7 @@ class ConfigDialog(QDialog):
         self.algorithm = QComboBox()
         self.algorithm.addItems([
             "rule_based", "uncoordinated", 
-            "coordinated_mas", "marl"
+            "coordinated_mas", "marl", "mpc"
         ])
         layout.addRow("调度算法:", self.algorithm)
         
@@ -2052,7 +2052,7 @@ class MainWindow(QMainWindow):
         self.algorithm_combo = QComboBox()
         self.algorithm_combo.addItems([
             "rule_based", "uncoordinated",
-            "coordinated_mas", "marl"
+            "coordinated_mas", "marl", "mpc"
         ])
         algo_layout.addWidget(self.algorithm_combo)
         layout.addLayout(algo_layout)
@@ -2324,6 +2324,7 @@ class MainWindow(QMainWindow):
                 # 应用会员优惠
                 if strategy.get('member_discount'):
                     charger['member_discount'] = 0.9  # 9折优惠
+            environment.mark_chargers_dirty(environment.chargers.keys())
                     
             logger.info("定价策略已应用到仿真环境")
 
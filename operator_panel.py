@@ -2,6 +2,7 @@
 import sys
 import json
 import logging
+import time
 from datetime import datetime, timedelta
 from typing import Dict, List, Optional, Any, Tuple
 import numpy as np
@@ -34,6 +35,7 @@ except ImportError:
     HAS_PYQTGRAPH = False
 
 from data_storage import operator_storage
+from storage_query_executor import StorageQueryExecutor
 
 logger = logging.getLogger(__name__)
 
@@ -41,6 +43,17 @@ logger = logging.getLogger(__name__)
 config = {}
 
 
+def create_query_executor(op_panel_config: Dict, parent=None) -> StorageQueryExecutor:
+    """按 operator_panel.query_executor 配置创建存储查询执行器"""
+    executor_config = op_panel_config.get('query_executor', {})
+    return StorageQueryExecutor(
+        max_workers=executor_config.get('max_workers', 2),
+        ttl_s=executor_config.get('cache_ttl_s', 30),
+        max_entries=executor_config.get('max_cache_entries', 64),
+        parent=parent,
+    )
+
+
 class StationStatusCard(QFrame):
     """站点状态卡片 - 简化版"""
     clicked = pyqtSignal(str)  # 站点ID
@@ -319,10 +332,11 @@ class PricingControlWidget(QWidget):
 
 class FinancialAnalysisWidget(QWidget):
     """财务分析组件"""
-    def __init__(self, op_panel_config: Dict, parent=None):
+    def __init__(self, op_panel_config: Dict, query_executor: Optional[StorageQueryExecutor] = None, parent=None):
         super().__init__(parent)
         self.op_panel_config = op_panel_config
         self.financial_config = self.op_panel_config.get('financial_analysis', {})
+        self.query_executor = query_executor or create_query_executor(op_panel_config, self)
         self.setupUI()
         
     def setupUI(self):
@@ -344,6 +358,9 @@ class FinancialAnalysisWidget(QWidget):
         self.query_btn = QPushButton("查询")
         self.query_btn.clicked.connect(self.queryFinancialData)
         time_layout.addWidget(self.query_btn)
+        # 时间范围改变时取消尚未返回的旧查询
+        self.start_date.dateChanged.connect(self._cancelQuery)
+        self.end_date.dateChanged.connect(self._cancelQuery)
         time_layout.addStretch()
         layout.addLayout(time_layout)
         
@@ -402,12 +419,20 @@ class FinancialAnalysisWidget(QWidget):
         card = QFrame(); card.setFrameStyle(QFrame.Shape.Box); card.setStyleSheet("QFrame { background: white; border: 1px solid #ddd; border-radius: 8px; padding: 15px; }"); layout = QVBoxLayout(card); title_label = QLabel(title); title_label.setStyleSheet("color: #666; font-size: 12px;"); layout.addWidget(title_label); value_label = QLabel(value); font_family = "Arial"; font_size = self.financial_config.get('summary_card_font_size', 16); font_weight_val = int(self.financial_config.get('summary_card_font_weight_bold_value', 75)); value_label.setFont(QFont(font_family, font_size, font_weight_val)); value_label.setObjectName(f"{title}_value"); layout.addWidget(value_label); return card
         
     def queryFinancialData(self):
-        """查询财务数据"""
+        """查询财务数据 (在查询线程池上执行，结果返回后更新界面)"""
         start = self.start_date.date().toString("yyyy-MM-dd")
         end = self.end_date.date().toString("yyyy-MM-dd")
         
-        df = operator_storage.get_financial_summary(start, end)
-        
+        self.query_btn.setText("查询中...")
+        self.query_executor.submit("financial_summary", operator_storage.get_financial_summary, start, end,
+                                   on_result=self._onFinancialData, on_error=lambda e: self.query_btn.setText("查询"))
+
+    def _cancelQuery(self, *_):
+        self.query_executor.cancel("financial_summary")
+        self.query_btn.setText("查询")
+
+    def _onFinancialData(self, df: pd.DataFrame):
+        self.query_btn.setText("查询")
         if df.empty:
             QMessageBox.information(self, "提示", "该时间段没有数据")
             # 清空旧数据
@@ -561,10 +586,11 @@ class FinancialAnalysisWidget(QWidget):
 
 class DemandForecastWidget(QWidget):
     """需求预测组件 (真实数据驱动版)"""
-    def __init__(self, op_panel_config: Dict, parent=None):
+    def __init__(self, op_panel_config: Dict, query_executor: Optional[StorageQueryExecutor] = None, parent=None):
         super().__init__(parent)
         self.demand_forecast_config = op_panel_config.get('demand_forecast', {})
         self.current_forecast_df = None
+        self.query_executor = query_executor or create_query_executor(op_panel_config, self)
         self.setupUI()
         
     def setupUI(self):
@@ -582,6 +608,9 @@ class DemandForecastWidget(QWidget):
         self.forecast_btn = QPushButton("生成预测")
         self.forecast_btn.clicked.connect(self.generateForecast)
         control_layout.addWidget(self.forecast_btn)
+        # 站点或天数改变时取消尚未返回的旧预测
+        self.station_combo.currentTextChanged.connect(self._cancelForecast)
+        self.days_spin.valueChanged.connect(self._cancelForecast)
         control_layout.addStretch()
         layout.addLayout(control_layout)
         
@@ -614,18 +643,33 @@ class DemandForecastWidget(QWidget):
             QMessageBox.warning(self, "提示", "请先选择一个站点。")
             return
         
-        # 1. 获取历史数据模式
+        # 1-2. 查询历史数据模式并执行预测 (在查询线程池上执行)
+        self.forecast_btn.setText("预测中...")
+        self.query_executor.submit(
+            "demand_forecast", self._loadForecast, station_id, days_to_forecast,
+            on_result=lambda forecast_data: self._onForecastReady(station_id, forecast_data),
+            on_error=lambda e: self.forecast_btn.setText("生成预测"))
+
+    def _cancelForecast(self, *_):
+        self.query_executor.cancel("demand_forecast")
+        self.forecast_btn.setText("生成预测")
+
+    def _loadForecast(self, station_id: str, days_to_forecast: int) -> Optional[pd.DataFrame]:
+        """查询线程上执行: 历史数据不足时返回 None"""
         historical_patterns = operator_storage.get_historical_demand_patterns(station_id)
-        
         if historical_patterns["hourly_avg"].empty:
+            return None
+        return pd.DataFrame(self._performForecast(historical_patterns, days_to_forecast))
+
+    def _onForecastReady(self, station_id: str, forecast_df: Optional[pd.DataFrame]):
+        self.forecast_btn.setText("生成预测")
+        if forecast_df is None:
             QMessageBox.information(self, "提示", f"站点 {station_id} 没有足够的历史数据来进行预测。")
             self.chart.clear()
             self.suggestions_text.setText("无可用数据。")
             return
 
-        # 2. 执行预测
-        forecast_data = self._performForecast(historical_patterns, days_to_forecast)
-        self.current_forecast_df = pd.DataFrame(forecast_data)
+        self.current_forecast_df = forecast_df
         
         # 3. 更新显示
         self._updateDisplay()
@@ -953,6 +997,13 @@ class FailureSimulationWidget(QWidget):
 class OperatorControlPanel(QWidget):
     # 信号定义
     pricingStrategyChanged = pyqtSignal(dict)
+    storageCommitted = pyqtSignal(object)  # 写线程提交批次后发出 (表名集合)，排队送到 GUI 线程
+
+    # 写入后需要失效的缓存查询: 会话影响财务汇总 (小时汇总触发器)、需求预测和扩容建议，快照影响站点负载 (扩容建议)
+    CACHE_CHANNELS_BY_TABLE = {
+        "charging_sessions": ("financial_summary", "demand_forecast", "expansion_recommendations"),
+        "realtime_data": ("expansion_recommendations",),
+    }
 
 
     def __init__(self, config_param, parent=None):
@@ -962,6 +1013,16 @@ class OperatorControlPanel(QWidget):
         self.panel_settings = self.op_panel_specific_config.get('main_panel_settings', {})
         self.simulation_environment = None
         self.current_data = {}
+        # 财务、预测、扩容建议查询共用的后台查询执行器
+        self.query_executor = create_query_executor(self.op_panel_specific_config, self)
+        # 缓存在批次提交之后失效 (而不是数据入队时)；快照每个仿真步都会提交，按间隔节流
+        executor_config = self.op_panel_specific_config.get('query_executor', {})
+        self.snapshot_invalidate_interval_s = executor_config.get('snapshot_invalidate_interval_s', 10)
+        self._last_snapshot_invalidation = float('-inf')
+        self.storageCommitted.connect(self._onStorageCommitted)
+        commit_listener = self.storageCommitted.emit
+        operator_storage.add_commit_listener(commit_listener)
+        self.destroyed.connect(lambda: operator_storage.remove_commit_listener(commit_listener))
         self.setupUI()
         self.setupTimers()
         
@@ -990,11 +1051,11 @@ class OperatorControlPanel(QWidget):
         
         # 财务分析
         # Ensure FinancialAnalysisWidget receives op_panel_config
-        self.financial_widget = FinancialAnalysisWidget(op_panel_config) 
+        self.financial_widget = FinancialAnalysisWidget(op_panel_config, self.query_executor)
         self.tab_widget.addTab(self.financial_widget, "📈 财务分析")
         
         # 需求预测
-        self.forecast_widget = DemandForecastWidget(op_panel_config) 
+        self.forecast_widget = DemandForecastWidget(op_panel_config, self.query_executor)
         self.tab_widget.addTab(self.forecast_widget, "🔮 需求预测")
 
         # --- START OF MODIFICATION ---
@@ -1050,11 +1111,13 @@ class OperatorControlPanel(QWidget):
         operator_storage.save_realtime_snapshot(chargers, timestamp)
         
         # 保存充电会话
+        sessions = []
         for charger in chargers:
             if charger.get('current_user') and 'charging_session' in charger:
                 session = charger['charging_session']
                 session['station_id'] = charger.get('location', 'unknown')
-                operator_storage.save_charging_session(session)
+                sessions.append(session)
+        operator_storage.save_charging_sessions(sessions)
         
         # 更新实时监控
         stations_status = self._aggregateStationStatus(chargers)
@@ -1073,6 +1136,19 @@ class OperatorControlPanel(QWidget):
         self.failure_sim_widget.update_lists(charger_ids, station_list)
         # --- END OF MODIFICATION ---
         
+    def _onStorageCommitted(self, tables):
+        """运营商存储提交了一批写入: 使读取这些表的缓存查询失效 (仅由快照引起的失效按间隔节流)"""
+        channels = set()
+        for table in tables:
+            if table == "realtime_data":
+                now = time.monotonic()
+                if now - self._last_snapshot_invalidation < self.snapshot_invalidate_interval_s:
+                    continue
+                self._last_snapshot_invalidation = now
+            channels.update(self.CACHE_CHANNELS_BY_TABLE.get(table, ()))
+        for channel in channels:
+            self.query_executor.invalidate(channel)
+
     def _aggregateStationStatus(self, chargers: List[Dict]) -> Dict[str, Dict]:
         """聚合站点状态"""
         stations = defaultdict(lambda: {
@@ -1314,9 +1390,11 @@ class OperatorControlPanel(QWidget):
         return report
 
     def showExpansionRecommendations(self):
-        """显示扩容建议"""
-        recommendations = operator_storage.get_expansion_recommendations()
-        
+        """显示扩容建议 (后台查询完成后弹出对话框)"""
+        self.query_executor.submit("expansion_recommendations", operator_storage.get_expansion_recommendations,
+                                   on_result=self._showExpansionDialog)
+
+    def _showExpansionDialog(self, recommendations: List[Dict]):
         dialog = QDialog(self)
         dialog.setWindowTitle("扩容建议")
         dialog_width = self.panel_settings.get('expansion_recs_dialog_width', 800)
@@ -9,6 +9,7 @@ import sys
 import os
 import json
 import logging
+import argparse
 import traceback
 from datetime import datetime
 import time
@@ -75,12 +76,12 @@ def run_simulation(config, max_steps=100):
                 current_state = environment.get_current_state()
                 logger.info(f"步骤 {step_count + 1}: 获取当前状态成功")
                 
-                # 调度决策
-                decisions = scheduler.make_scheduling_decision(current_state)
+                # 调度决策 (make_scheduling_decision 返回 (decisions, metadata))
+                decisions, scheduler_metadata = scheduler.make_scheduling_decision(current_state)
                 logger.info(f"步骤 {step_count + 1}: 生成调度决策成功")
                 
                 # 执行一步仿真
-                rewards, next_state, done = environment.step(decisions)
+                rewards, next_state, done = environment.step(decisions, scheduler_metadata=scheduler_metadata)
                 logger.info(f"步骤 {step_count + 1}: 仿真步骤执行成功")
                 
                 # 输出关键信息
@@ -121,21 +122,75 @@ def run_simulation(config, max_steps=100):
     
     return True
 
+def train_marl(config, episodes=10, max_steps=100):
+    """无界面多回合训练 MARL: 每步 choose → step → 经验回放批量更新，结束后保存 Q 表"""
+    config.setdefault('scheduler', {})['scheduling_algorithm'] = 'marl'
+    try:
+        environment = ChargingEnvironment(config)
+        scheduler = ChargingScheduler(config)
+        if scheduler.marl_system is None:
+            logger.error("MARL 系统初始化失败，无法训练")
+            return False
+
+        for episode in range(episodes):
+            episode_start = time.perf_counter()
+            environment.reset()
+            episode_reward = 0.0
+            step_count = 0
+            while step_count < max_steps:
+                current_state = environment.get_current_state()
+                decisions, scheduler_metadata = scheduler.make_scheduling_decision(current_state)
+                rewards, next_state, done = environment.step(decisions, scheduler_metadata=scheduler_metadata)
+                scheduler.learn(current_state, decisions, rewards, next_state)
+                episode_reward += rewards.get('total_reward', 0)
+                step_count += 1
+                if done:
+                    break
+
+            stats = scheduler.marl_system.training_throughput()
+            print(f"回合 {episode + 1}/{episodes}: {step_count} 步, 总奖励 {episode_reward:.2f}, "
+                  f"耗时 {time.perf_counter() - episode_start:.1f}s, 经验 {stats['transitions']}, "
+                  f"Q 更新 {stats['q_updates']}, 训练吞吐 {stats['transitions_per_sec']:.0f} transitions/s")
+
+        scheduler.save_q_tables()
+        stats = scheduler.marl_system.training_throughput()
+        logger.info(f"MARL 训练完成: {stats}")
+        print(f"\n✅ MARL 训练完成: {stats['transitions']} 条经验, {stats['transitions_per_sec']:.0f} transitions/s")
+    except Exception as e:
+        logger.error(f"MARL 训练失败: {e}")
+        logger.error(f"错误详情: {traceback.format_exc()}")
+        print(f"\n❌ MARL 训练失败: {e}")
+        return False
+
+    return True
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="EV充电仿真命令行工具")
+    parser.add_argument('--config', default='config.json', help="配置文件路径")
+    parser.add_argument('--steps', type=int, default=100, help="每次仿真 (每个训练回合) 的最大步数")
+    parser.add_argument('--train-marl', action='store_true', help="无界面训练 MARL Q 表")
+    parser.add_argument('--episodes', type=int, default=10, help="MARL 训练回合数")
+    return parser.parse_args(argv)
+
 def main():
     """主函数"""
+    args = parse_args()
     print("=== EV充电仿真命令行工具 ===")
     print(f"启动时间: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
     
     # 加载配置
-    config = load_config()
+    config = load_config(args.config)
     if config is None:
         print("❌ 配置加载失败，程序退出")
         return 1
     
     print("✅ 配置加载成功")
     
-    # 运行仿真
-    success = run_simulation(config)
+    # 运行仿真或训练
+    if args.train_marl:
+        success = train_marl(config, episodes=args.episodes, max_steps=args.steps)
+    else:
+        success = run_simulation(config, max_steps=args.steps)
     
     if success:
         print("\n🎉 仿真运行成功完成")
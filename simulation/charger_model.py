@@ -4,11 +4,105 @@ from datetime import datetime, timedelta
 import random
 import math # 需要 math
 
+import numpy as np
+
 logger = logging.getLogger(__name__)
 
+# 单次充电会话的最长时长 (分钟)，超时结束会话
+MAX_CHARGING_MINUTES = {"superfast": 30, "fast": 60, "normal": 180}
+
+
+def soc_taper_factor(soc):
+    """充电功率随 SOC 的衰减系数 (分段线性，最低 0.1)；soc 可以是标量或 numpy 数组"""
+    soc = np.asarray(soc, dtype=float)
+    factor = np.where(soc < 20, 1.0,
+             np.where(soc < 50, 1.0 - ((soc - 20) / 30) * 0.1,
+             np.where(soc < 80, 0.9 - ((soc - 50) / 30) * 0.2,
+                      0.7 - ((soc - 80) / 20) * 0.5)))
+    return np.maximum(0.1, factor)
+
+
+def _station_limits(config):
+    """充电站变压器容量: 全局默认值 + 按站点名覆盖；都未配置时返回 (None, {})"""
+    params = config.get("environment", {}).get("charger_model_params", {})
+    return params.get("station_transformer_limit_kw"), params.get("station_transformer_limits_kw", {}) or {}
+
+
+def _charging_kernel(chargers, users, time_step_hours, config):
+    """
+    向量化计算所有 occupied 充电桩本步的充电量。
+    返回 {charger_id: (充入电池的 kWh, 电网侧 kWh, 充电后的 SOC)}。
+    """
+    active = [
+        (charger_id, charger, users[charger["current_user"]])
+        for charger_id, charger in chargers.items()
+        if isinstance(charger, dict) and charger.get("status") == "occupied"
+        and charger.get("current_user") and charger.get("current_user") in users
+    ]
+    if not active:
+        return {}
+
+    charger_ids = [charger_id for charger_id, _, _ in active]
+    charger_types = [charger.get("type", "normal") for _, charger, _ in active]
+    soc = np.array([user.get("soc", 0) for _, _, user in active], dtype=float)
+    target_soc = np.array([user.get("target_soc", 95) for _, _, user in active], dtype=float)
+    battery_capacity = np.array([user.get("battery_capacity", 60) for _, _, user in active], dtype=float)
+    charger_max_power = np.array([charger.get("max_power", 60) for _, charger, _ in active], dtype=float)
+    vehicle_max_power = np.array([user.get("max_charging_power", 60) for _, _, user in active], dtype=float)
+    power_cap = np.array([
+        charger.get("power_cap_kw") if charger.get("power_cap_kw") is not None else np.inf
+        for _, charger, _ in active
+    ], dtype=float)
+    power_limit = np.minimum(np.minimum(charger_max_power, vehicle_max_power), np.maximum(power_cap, 0.0))
+
+    # 充电效率: 手动决策偏好快充且使用快充桩、快充偏好与桩类型匹配时有小幅提升
+    base_efficiency = np.array([user.get("charging_efficiency", 0.92) for _, _, user in active], dtype=float)
+    fast_pref = np.array([user.get("fast_charging_preference", 0.5) for _, _, user in active], dtype=float)
+    is_fast = np.array([t in ["fast", "superfast"] for t in charger_types], dtype=bool)
+    is_normal = np.array([t == "normal" for t in charger_types], dtype=bool)
+    manual_fast = np.array([
+        bool(user.get("manual_decision", False)) and user.get("preferred_charging_type", "快充") == "快充"
+        for _, _, user in active
+    ], dtype=bool)
+    efficiency_boost = np.where(manual_fast & is_fast, 0.03, 0.0)
+    efficiency_boost = efficiency_boost + np.where(is_fast & (fast_pref > 0.7), 0.02 * (fast_pref - 0.7) / 0.3, 0.0)
+    efficiency_boost = efficiency_boost + np.where(is_normal & (fast_pref < 0.3), 0.01 * (0.3 - fast_pref) / 0.3, 0.0)
+    efficiency = np.minimum(0.95, base_efficiency * (1 + efficiency_boost))
+
+    actual_power = power_limit * soc_taper_factor(soc)
+
+    # 站级变压器容量: 超限时按比例压低该站所有正在充电的桩
+    default_limit, station_limits = _station_limits(config)
+    if default_limit is not None or station_limits:
+        stations = [charger.get("location", "unknown") for _, charger, _ in active]
+        station_index = {name: i for i, name in enumerate(dict.fromkeys(stations))}
+        station_of = np.array([station_index[name] for name in stations])
+        station_power = np.bincount(station_of, weights=actual_power, minlength=len(station_index))
+        limits = np.array([
+            station_limits.get(name, default_limit if default_limit is not None else np.inf)
+            for name in station_index
+        ], dtype=float)
+        scale = np.where(station_power > limits, limits / np.maximum(station_power, 1e-9), 1.0)
+        actual_power = actual_power * scale[station_of]
+
+    power_to_battery = actual_power * efficiency
+    energy_needed = (np.maximum(0, target_soc - soc) / 100.0) * battery_capacity
+    energy_to_battery = np.minimum(energy_needed, power_to_battery * time_step_hours)
+    energy_from_grid = np.where(efficiency > 0, energy_to_battery / np.where(efficiency > 0, efficiency, 1.0), energy_to_battery)
+    soc_increase = np.where(battery_capacity > 0, energy_to_battery / np.where(battery_capacity > 0, battery_capacity, 1.0) * 100, 0.0)
+    new_soc = np.minimum(100, soc + soc_increase)
+
+    return {
+        charger_id: (float(to_battery), float(from_grid), float(soc_after))
+        for charger_id, to_battery, from_grid, soc_after in zip(charger_ids, energy_to_battery, energy_from_grid, new_soc)
+    }
+
+
 def simulate_step(chargers, users, current_time, time_step_minutes, grid_status, config):
     """
-    模拟所有充电桩的操作，特别关注手动决策用户
+    模拟所有充电桩的操作，特别关注手动决策用户。
+    充电功率 = min(充电桩额定功率, 车辆最大功率, 调度下发的 power_cap_kw) × SOC 衰减，
+    并受充电站变压器容量 (charger_model_params.station_transformer_limit_kw) 限制。
     """
     time_step_hours = round(time_step_minutes / 60, 4)
     total_ev_load = 0
@@ -19,6 +113,9 @@ def simulate_step(chargers, users, current_time, time_step_minutes, grid_status,
     # 获取运营商的电力成本率
     op_elec_cost_rate = config.get("metrics_params", {}).get("operator_profit", {}).get("operator_electricity_cost_rate_from_retail", 0.85)
 
+    # 所有正在充电的会话的功率和电量按数组一次算完，下面的循环只负责写回状态
+    charging_results = _charging_kernel(chargers, users, time_step_hours, config)
+
     for charger_id, charger in chargers.items():
         if not isinstance(charger, dict): continue
         if charger.get("status") == "failure": continue
@@ -26,140 +123,103 @@ def simulate_step(chargers, users, current_time, time_step_minutes, grid_status,
         current_user_id = charger.get("current_user")
 
         # --- 1. 处理正在充电的用户 ---
-        if charger.get("status") == "occupied" and current_user_id:
-            if current_user_id in users:
-                user = users[current_user_id]
-                current_soc = user.get("soc", 0)
-                battery_capacity = user.get("battery_capacity", 60)
-                target_soc = user.get("target_soc", 95)
-                initial_soc = user.get("initial_soc", current_soc)
-                is_manual_decision = user.get("manual_decision", False)
-
-                # 充电功率和效率计算 (这部分逻辑保持不变)
-                charger_type = charger.get("type", "normal")
-                charger_max_power = charger.get("max_power", 60)
-                vehicle_max_power = user.get("max_charging_power", 60)
-                power_limit = min(charger_max_power, vehicle_max_power)
-                base_efficiency = user.get("charging_efficiency", 0.92)
-                
-                fast_charging_preference = user.get("fast_charging_preference", 0.5)
-                efficiency_boost = 0.0
+        if charger_id in charging_results:
+            user = users[current_user_id]
+            current_soc = user.get("soc", 0)
+            target_soc = user.get("target_soc", 95)
+            initial_soc = user.get("initial_soc", current_soc)
+            is_manual_decision = user.get("manual_decision", False)
+            charger_type = charger.get("type", "normal")
+            actual_energy_charged_to_battery, actual_energy_from_grid, new_soc_candidate = charging_results[charger_id]
+
+            new_soc = current_soc # 初始化 new_soc
+            if actual_energy_charged_to_battery > 0.01:
+                new_soc = new_soc_candidate
+                user["soc"] = new_soc
+                user["current_range"] = user.get("max_range", 400) * (new_soc / 100)
+
+                actual_power_drawn_from_grid = actual_energy_from_grid / time_step_hours if time_step_hours > 0 else 0
+                total_ev_load += actual_power_drawn_from_grid
+
+                price_multiplier = charger.get("price_multiplier", 1.0)
                 if is_manual_decision:
-                    preferred_type = user.get("preferred_charging_type", "快充")
-                    if preferred_type == "快充" and charger_type in ["fast", "superfast"]:
-                        efficiency_boost += 0.03
-                if charger_type in ["fast", "superfast"]:
-                    if fast_charging_preference > 0.7:
-                        efficiency_boost += 0.02 * (fast_charging_preference - 0.7) / 0.3
-                elif charger_type == "normal" and fast_charging_preference < 0.3:
-                    efficiency_boost += 0.01 * (0.3 - fast_charging_preference) / 0.3
-                base_efficiency = min(0.95, base_efficiency * (1 + efficiency_boost))
-
-                soc_factor = 1.0
-                if current_soc < 20: soc_factor = 1.0
-                elif current_soc < 50: soc_factor = 1.0 - ((current_soc - 20) / 30) * 0.1
-                elif current_soc < 80: soc_factor = 0.9 - ((current_soc - 50) / 30) * 0.2
-                else: soc_factor = 0.7 - ((current_soc - 80) / 20) * 0.5
+                    price_multiplier *= 0.98
+                
+                revenue_this_step = actual_energy_from_grid * current_price_from_grid * price_multiplier
+                cost_base_price_this_step = actual_energy_from_grid * current_price_from_grid
+
+                # 安全地累加会话数据
+                charger["session_energy"] += actual_energy_from_grid
+                charger["session_revenue"] += revenue_this_step
+                charger["session_cost_base_price"] += cost_base_price_this_step
+
+            # 检查充电是否完成
+            charging_start_time = charger.get("charging_start_time", current_time - timedelta(minutes=time_step_minutes))
+            charging_duration_minutes = (current_time - charging_start_time).total_seconds() / 60
+            max_charging_time = MAX_CHARGING_MINUTES.get(charger_type, MAX_CHARGING_MINUTES["normal"])
+
+            if new_soc >= target_soc - 0.5 or charging_duration_minutes >= max_charging_time - 0.1:
+                reason = "target_reached" if new_soc >= target_soc - 0.5 else "time_limit_exceeded"
+                
+                # 在充电会话结束时，进行最终的成本和收入计算
+                final_session_energy = charger.get("session_energy", 0)
+                final_session_revenue = charger.get("session_revenue", 0)
+                final_session_cost_base_price = charger.get("session_cost_base_price", 0)
+                
+                avg_price_this_session = (final_session_cost_base_price / final_session_energy) if final_session_energy > 0 else current_price_from_grid
+                final_session_cost = final_session_energy * avg_price_this_session * op_elec_cost_rate
+                
+                logger.info(f"Session End: User {current_user_id} at {charger_id}. Energy: {final_session_energy:.2f}kWh, Revenue: ¥{final_session_revenue:.2f}, Cost: ¥{final_session_cost:.2f}")
+
+                charging_session = {
+                    "user_id": current_user_id, 
+                    "charger_id": charger_id,
+                    "station_id": charger.get("location", "unknown"),
+                    "start_time": charging_start_time.isoformat(), 
+                    "end_time": current_time.isoformat(),
+                    "duration_minutes": round(charging_duration_minutes, 2),
+                    "initial_soc": initial_soc, 
+                    "end_soc": new_soc,
+                    "energy_kwh": round(final_session_energy, 3),
+                    "cost": round(final_session_cost, 2),
+                    "revenue": round(final_session_revenue, 2),
+                    "price_per_kwh": round(avg_price_this_session, 3),
+                    "termination_reason": reason,
+                    "manual_decision": is_manual_decision
+                }
+                completed_sessions_this_step.append(charging_session)
+                
+                if "charging_history" not in user: user["charging_history"] = []
+                user["charging_history"].append(charging_session)
+                
+                # 累加到每日统计
+                charger["daily_revenue"] = charger.get("daily_revenue", 0) + final_session_revenue
+                charger["daily_energy"] = charger.get("daily_energy", 0) + final_session_energy
+
+                # 重置状态和会话临时变量
+                charger["status"] = "available"
+                charger["current_user"] = None
+                charger["charging_start_time"] = None
+                charger.pop("session_energy", None)
+                charger.pop("session_revenue", None)
+                charger.pop("session_cost_base_price", None)
+                charger["_prev_energy"] = charger.get("daily_energy", 0) # 更新快照值
+                charger["_prev_revenue"] = charger.get("daily_revenue", 0)
+
+                user["status"] = "post_charge"
+                user["target_charger"] = None
+                user["post_charge_timer"] = random.randint(1, 3)
+                user["initial_soc"] = None
+                user["target_soc"] = None
                 
-                actual_power = power_limit * max(0.1, soc_factor)
-                power_to_battery = actual_power * base_efficiency
-                soc_needed = max(0, target_soc - current_soc)
-                energy_needed = (soc_needed / 100.0) * battery_capacity
-                max_energy_this_step = power_to_battery * time_step_hours
-                actual_energy_charged_to_battery = min(energy_needed, max_energy_this_step)
-                actual_energy_from_grid = actual_energy_charged_to_battery / base_efficiency if base_efficiency > 0 else actual_energy_charged_to_battery
-
-                new_soc = current_soc # 初始化 new_soc
-                if actual_energy_charged_to_battery > 0.01:
-                    actual_soc_increase = (actual_energy_charged_to_battery / battery_capacity) * 100 if battery_capacity > 0 else 0
-                    new_soc = min(100, current_soc + actual_soc_increase)
-                    user["soc"] = new_soc
-                    user["current_range"] = user.get("max_range", 400) * (new_soc / 100)
-
-                    actual_power_drawn_from_grid = actual_energy_from_grid / time_step_hours if time_step_hours > 0 else 0
-                    total_ev_load += actual_power_drawn_from_grid
-
-                    price_multiplier = charger.get("price_multiplier", 1.0)
-                    if is_manual_decision:
-                        price_multiplier *= 0.98
-                    
-                    revenue_this_step = actual_energy_from_grid * current_price_from_grid * price_multiplier
-                    cost_base_price_this_step = actual_energy_from_grid * current_price_from_grid
-
-                    # 安全地累加会话数据
-                    charger["session_energy"] += actual_energy_from_grid
-                    charger["session_revenue"] += revenue_this_step
-                    charger["session_cost_base_price"] += cost_base_price_this_step
-
-                # 检查充电是否完成
-                charging_start_time = charger.get("charging_start_time", current_time - timedelta(minutes=time_step_minutes))
-                charging_duration_minutes = (current_time - charging_start_time).total_seconds() / 60
-                max_charging_time = 180
-                if charger_type == "superfast": max_charging_time = 30
-                elif charger_type == "fast": max_charging_time = 60
-
-                if new_soc >= target_soc - 0.5 or charging_duration_minutes >= max_charging_time - 0.1:
-                    reason = "target_reached" if new_soc >= target_soc - 0.5 else "time_limit_exceeded"
-                    
-                    # 在充电会话结束时，进行最终的成本和收入计算
-                    final_session_energy = charger.get("session_energy", 0)
-                    final_session_revenue = charger.get("session_revenue", 0)
-                    final_session_cost_base_price = charger.get("session_cost_base_price", 0)
-                    
-                    avg_price_this_session = (final_session_cost_base_price / final_session_energy) if final_session_energy > 0 else current_price_from_grid
-                    final_session_cost = final_session_energy * avg_price_this_session * op_elec_cost_rate
-                    
-                    logger.info(f"Session End: User {current_user_id} at {charger_id}. Energy: {final_session_energy:.2f}kWh, Revenue: ¥{final_session_revenue:.2f}, Cost: ¥{final_session_cost:.2f}")
-
-                    charging_session = {
-                        "user_id": current_user_id, 
-                        "charger_id": charger_id,
-                        "station_id": charger.get("location", "unknown"),
-                        "start_time": charging_start_time.isoformat(), 
-                        "end_time": current_time.isoformat(),
-                        "duration_minutes": round(charging_duration_minutes, 2),
-                        "initial_soc": initial_soc, 
-                        "end_soc": new_soc,
-                        "energy_kwh": round(final_session_energy, 3),
-                        "cost": round(final_session_cost, 2),
-                        "revenue": round(final_session_revenue, 2),
-                        "price_per_kwh": round(avg_price_this_session, 3),
-                        "termination_reason": reason,
-                        "manual_decision": is_manual_decision
-                    }
-                    completed_sessions_this_step.append(charging_session)
-                    
-                    if "charging_history" not in user: user["charging_history"] = []
-                    user["charging_history"].append(charging_session)
-                    
-                    # 累加到每日统计
-                    charger["daily_revenue"] = charger.get("daily_revenue", 0) + final_session_revenue
-                    charger["daily_energy"] = charger.get("daily_energy", 0) + final_session_energy
-
-                    # 重置状态和会话临时变量
-                    charger["status"] = "available"
-                    charger["current_user"] = None
-                    charger["charging_start_time"] = None
-                    charger.pop("session_energy", None)
-                    charger.pop("session_revenue", None)
-                    charger.pop("session_cost_base_price", None)
-                    charger["_prev_energy"] = charger.get("daily_energy", 0) # 更新快照值
-                    charger["_prev_revenue"] = charger.get("daily_revenue", 0)
-
-                    user["status"] = "post_charge"
-                    user["target_charger"] = None
-                    user["post_charge_timer"] = random.randint(1, 3)
-                    user["initial_soc"] = None
-                    user["target_soc"] = None
-                    
-                    # 处理预约完成
-                    if user.get('reservation_id'):
-                        from reservation_system import reservation_manager
-                        reservation_id = user.get('reservation_id')
-                        if reservation_manager.completeReservation(reservation_id):
-                            logger.info(f"预约 {reservation_id} 已完成 - 用户 {current_user_id} 充电结束")
-                        user['reservation_id'] = None
-                        user['is_reservation_user'] = False
+                # 处理预约完成
+                if user.get('reservation_id'):
+                    from reservation_system import reservation_manager
+                    reservation_id = user.get('reservation_id')
+                    if reservation_manager.completeReservation(reservation_id):
+                        logger.info(f"预约 {reservation_id} 已完成 - 用户 {current_user_id} 充电结束")
+                    user['reservation_id'] = None
+                    user['is_reservation_user'] = False
 
         # --- 2. 处理等待队列 ---
         if charger.get("status") == "available" and charger.get("queue"):
@@ -0,0 +1,161 @@
+# ev_charging_project/simulation/decision_cache.py
+"""
+调度结果缓存 (Decision cache)
+
+谷时段需求平稳时，调度算法会从几乎相同的输入反复算出相同的决策。DecisionCache 为每个候选用户计算量化签名
+(位置网格、SOC 档位、状态、是否需要充电决策)，与本步充电桩的量化签名 (哪些充电桩故障或排队已满) 和时段一起作为键，
+记住算法上一次对该用户给出的决策 (charger_id 或 None)。签名未变的用户直接复用缓存决策，不再交给算法；
+复用的充电桩必须仍可用且排队未满，复用的分配作为充电桩的额外排队交给算法 (algorithm_view)，避免算法把同一排队位再分出去。
+缓存按 LRU 淘汰，命中率等统计写入 metadata["decision_cache"]；环境重置或切换算法时由调度器清空。
+"""
+
+import logging
+import math
+from collections import OrderedDict
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+PASS_THROUGH_STATUSES = ("charging", "waiting")
+
+
+class DecisionCache:
+    def __init__(self, params=None, degrees_to_km=111.0):
+        self.params = params if params is not None else {}
+        self.enabled = self.params.get("enabled", False)
+        self.max_entries = max(1, self.params.get("max_entries", 10000))
+        self.position_cell_km = max(1e-6, self.params.get("position_cell_km", 0.5))
+        self.soc_bucket_pct = max(1e-6, self.params.get("soc_bucket_pct", 5))
+        self.hour_slot_minutes = max(1, self.params.get("hour_slot_minutes", 60))
+        self.degrees_to_km = degrees_to_km
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def clear(self):
+        self._entries.clear()
+
+    def _user_signature(self, user):
+        pos = user.get("current_position") or {}
+        lat, lng = pos.get("lat"), pos.get("lng")
+        if isinstance(lat, (int, float)) and isinstance(lng, (int, float)):
+            cell = (math.floor(lat * self.degrees_to_km / self.position_cell_km),
+                    math.floor(lng * self.degrees_to_km / self.position_cell_km))
+        else:
+            cell = None
+        return (
+            user.get("status"),
+            cell,
+            int(user.get("soc", 100) // self.soc_bucket_pct),
+            bool(user.get("needs_charge_decision", False)),
+        )
+
+    def context_key(self, state, algorithm_name, grid_preferences=None, optimization_weights=None):
+        """本步所有用户共用的键部分: 充电桩可用性签名 (故障或排队已满的充电桩) + 时段 + 算法/策略/优先级/车队负载上限/优化权重"""
+        unavailable = tuple(sorted(
+            c.get("charger_id") for c in state.get("chargers", [])
+            if isinstance(c, dict) and (c.get("status") == "failure" or len(c.get("queue", [])) >= c.get("queue_capacity", 5))
+        ))
+        hour_slot = None
+        timestamp = state.get("timestamp")
+        if timestamp:
+            try:
+                current_time = datetime.fromisoformat(timestamp)
+                hour_slot = (current_time.hour * 60 + current_time.minute) // self.hour_slot_minutes
+            except (TypeError, ValueError):
+                pass
+        grid_preferences = grid_preferences or {}
+        return hash((
+            unavailable, hour_slot, algorithm_name,
+            grid_preferences.get("charging_strategy"),
+            grid_preferences.get("charging_priority"),
+            grid_preferences.get("max_ev_fleet_load_mw"),
+            tuple(sorted((optimization_weights or {}).items())),
+        ))
+
+    def lookup(self, state, context_key):
+        """
+        返回 (reused, misses, miss_keys):
+        reused 为命中的 {user_id: charger_id}，misses 为需要交给算法的用户列表，miss_keys 为它们对应的缓存键。
+        缓存为 None 的用户 (上次算法没有为其分配) 命中后直接跳过。
+        """
+        chargers = {c.get("charger_id"): c for c in state.get("chargers", []) if isinstance(c, dict)}
+        reused_counts = {}
+        reused = {}
+        misses = []
+        miss_keys = {}
+        for user in state.get("users", []):
+            if not isinstance(user, dict) or not user.get("user_id"):
+                continue
+            user_id = user["user_id"]
+            if user.get("status") in PASS_THROUGH_STATUSES:
+                # 正在充电/排队的用户不是任何算法的候选，原样交给算法
+                misses.append(user)
+                continue
+            key = (user_id, self._user_signature(user), context_key)
+            if key not in self._entries:
+                self.misses += 1
+                misses.append(user)
+                miss_keys[user_id] = key
+                continue
+
+            charger_id = self._entries[key]
+            if charger_id is not None:
+                charger = chargers.get(charger_id)
+                queued = len(charger.get("queue", [])) + reused_counts.get(charger_id, 0) if charger else 0
+                if charger is None or charger.get("status") == "failure" or queued >= charger.get("queue_capacity", 5):
+                    # 缓存的充电桩已不可用，交给算法重新决策
+                    self.misses += 1
+                    misses.append(user)
+                    miss_keys[user_id] = key
+                    continue
+                reused[user_id] = charger_id
+                reused_counts[charger_id] = reused_counts.get(charger_id, 0) + 1
+            self._entries.move_to_end(key)
+            self.hits += 1
+        return reused, misses, miss_keys
+
+    @staticmethod
+    def algorithm_view(state, misses, reused):
+        """
+        交给算法的状态视图: 只包含未命中的用户；复用分配的用户追加到对应充电桩的排队中，
+        算法按排队长度计算的负载和容量 (以及 MAS 的车队功率估计，见 reserved_assignments) 都包含这些分配。
+        """
+        view = dict(state)
+        view["users"] = misses
+        if reused:
+            reserved_by_charger = {}
+            for user_id, charger_id in reused.items():
+                reserved_by_charger.setdefault(charger_id, []).append(user_id)
+            chargers = []
+            for charger in state.get("chargers", []):
+                reserved = reserved_by_charger.get(charger.get("charger_id")) if isinstance(charger, dict) else None
+                if reserved:
+                    charger = dict(charger)
+                    charger["queue"] = list(charger.get("queue", [])) + reserved
+                chargers.append(charger)
+            view["chargers"] = chargers
+            view["reserved_assignments"] = dict(reused)
+        return view
+
+    def store(self, miss_keys, decisions, skip_user_ids=()):
+        """记录算法对未命中用户的决策 (被推迟的用户不记录)"""
+        for user_id, key in miss_keys.items():
+            if user_id in skip_user_ids:
+                continue
+            self._entries[key] = decisions.get(user_id)
+            self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+        }
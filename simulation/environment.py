@@ -1,6 +1,7 @@
 # ev_charging_project/simulation/environment.py
 
 import logging
+from bisect import bisect_right
 from datetime import datetime, timedelta
 import random
 import math
@@ -13,6 +14,8 @@ try:
     from simulation.charger_model import simulate_step as simulate_chargers_step
     from simulation.metrics import calculate_rewards
     from simulation.utils import get_random_location, calculate_distance
+    from simulation.service_metrics import ServiceLevelTracker
+    from simulation.queue_estimator import QueueTimeEstimator
 except ImportError as e:
     logging.error(f"Error importing simulation submodules in environment.py: {e}", exc_info=True)
     # 在启动时如果无法导入核心模块，抛出错误可能更好
@@ -70,6 +73,21 @@ class ChargingEnvironment:
         self.history = []
         self.completed_charging_sessions = [] # 存储完成的充电会话日志
         self.uncoordinated_load_profile = []
+        # 服务水平统计 (排队等待时间分位数)，reset 时清空
+        self.service_tracker = ServiceLevelTracker(self.env_config.get('service_metrics_params', {}))
+        # 各充电桩的排队等待时间估计 (会话时长 EWMA + 当前会话剩余时间)，通过 state["queue_estimates"] 发布
+        self.queue_estimator = QueueTimeEstimator(self.env_config.get('queue_estimator_params', {}))
+        # 增量调度用的 "脏" 集合: 本步状态发生变化的用户/充电桩
+        dirty_params = self.env_config.get('dirty_tracking_params', {})
+        self.dirty_soc_thresholds = sorted(dirty_params.get('soc_thresholds', [15, 20, 25, 30, 40, 50, 60, 80, 90, 95]))
+        self.dirty_user_ids = set()
+        self.dirty_charger_ids = set()
+        self.dirty_full = True
+        # dirty 集合的序号，每步加一；消费方据此判断是否漏掉了某一步的增量
+        self.dirty_step = 0
+        self._last_charger_snapshot = None
+        # 上一步因决策时间预算耗尽而被推迟的用户，下一步优先处理
+        self.deferred_user_ids = set()
         # 初始化子模型 - GridModel 需要完整的 config
         self.grid_simulator = EnhancedGridModel(config)
 
@@ -102,6 +120,15 @@ class ChargingEnvironment:
         self.grid_simulator.reset() # 重置电网状态
         self.history = []
         self.completed_charging_sessions = []
+        self.service_tracker.reset()
+        self.queue_estimator.reset()
+        self.queue_estimator.update(self.chargers, self.users, self.current_time)
+        self.dirty_user_ids = set()
+        self.dirty_charger_ids = set()
+        self.dirty_full = True # 重置后第一步需要全量决策
+        self.dirty_step = 0
+        self._last_charger_snapshot = None
+        self.deferred_user_ids = set()
         logger.info(f"Environment reset complete. Simulation starts at: {self.start_time}")
         # 返回初始状态
         return self.get_current_state()
@@ -330,7 +357,8 @@ class ChargingEnvironment:
                     "status": "failure" if is_failure else "available", "current_user": None, "queue": [],
                     "queue_capacity": queue_capacity, "daily_revenue": 0.0, "daily_energy": 0.0,
                     "price_multiplier": p_mult if isinstance(p_mult, (int, float)) else 1.0, 
-                    "region": f"Region_{random.randint(1, self.region_count)}"
+                    "region": f"Region_{random.randint(1, self.region_count)}",
+                    "power_cap_kw": None, # 调度器下发的本步功率上限 (kW)，None 为不限
                 }
                 current_id += 1
 
@@ -346,6 +374,8 @@ class ChargingEnvironment:
 
         logger.debug(f"--- Step Start: {self.current_time} ---")
         step_start_time = time.time()
+        user_snapshot = self._snapshot_users()
+        charger_snapshot = self._snapshot_chargers()
         # 0. 检查并处理预约
         from reservation_system import reservation_manager
         processed_reservations = reservation_manager.checkAndProcessReservations(
@@ -543,6 +573,7 @@ class ChargingEnvironment:
                             # 强制添加到锁定的目标充电桩，无视队列容量
                             charger['queue'].append(user_id)
                             users_added_to_queue += 1
+                            self.service_tracker.record_arrival(user_id, target_charger_id, user.get('arrival_time_at_charger') or self.current_time)
                             
                             logger.info(f"=== FORCED MANUAL DECISION QUEUE ADDITION ===")
                             logger.info(f"Locked manual user {user_id} FORCED into queue for target charger {target_charger_id}")
@@ -557,6 +588,7 @@ class ChargingEnvironment:
                         elif current_queue_len < queue_capacity:
                             charger['queue'].append(user_id)
                             users_added_to_queue += 1
+                            self.service_tracker.record_arrival(user_id, target_charger_id, user.get('arrival_time_at_charger') or self.current_time)
                             
                             # 为普通手动决策用户提供优先级
                             if user.get('manual_decision'):
@@ -575,12 +607,13 @@ class ChargingEnvironment:
                         else:
                             logger.warning(f"User {user_id} arrived but queue full for charger {target_charger_id}")
 
-        # 模拟充电过程
+        # 模拟充电过程 (调度器下发的功率设定值只对本步有效)
+        self._apply_power_setpoints(scheduler_metadata)
         current_grid_status = self.grid_simulator.get_status()
         total_ev_load, completed_sessions_this_step = simulate_chargers_step(
             self.chargers, self.users, self.current_time, self.time_step_minutes, current_grid_status, self.config
         )
-        
+        self._update_service_levels(completed_sessions_this_step)
 
         # `completed_sessions_this_step`现在已经包含了成本和收入，直接保存即可
         if completed_sessions_this_step:
@@ -590,8 +623,8 @@ class ChargingEnvironment:
                 session_id = f"{session['user_id']}_{session['charger_id']}_{session['end_time']}"
                 session['session_id'] = session_id
                 
-                # 直接保存，因为所有财务数据已在charger_model中计算好
-                operator_storage.save_charging_session(session)
+            # 直接保存，因为所有财务数据已在charger_model中计算好 (整批交给后台写线程)
+            operator_storage.save_charging_sessions(completed_sessions_this_step)
             logger.info(f"Saved {len(completed_sessions_this_step)} completed charging sessions to the database.")
 
         self.completed_charging_sessions.extend(completed_sessions_this_step)
@@ -610,6 +643,9 @@ class ChargingEnvironment:
 
         # 1. 前进模拟时间
         self.current_time += timedelta(minutes=self.time_step_minutes)
+        self.queue_estimator.update(self.chargers, self.users, self.current_time)
+        self._update_deferred_users(scheduler_metadata)
+        self._update_dirty_sets(user_snapshot, charger_snapshot)
 
         # 2. 计算奖励并保存历史
         current_state = self.get_current_state()
@@ -635,10 +671,107 @@ class ChargingEnvironment:
             "users": users_list,
             "chargers": chargers_list,
             "grid_status": self.grid_simulator.get_status(), 
-            "history": self.history[-self.user_model_params.get('history_max_steps_snapshot', 96):]
+            "history": self.history[-self.user_model_params.get('history_max_steps_snapshot', 96):],
+            "service_levels": self.service_tracker.summary(),
+            "queue_estimates": self.queue_estimator.snapshot(),
+            "dirty": {
+                "full": self.dirty_full,
+                "step": self.dirty_step,
+                "users": sorted(self.dirty_user_ids),
+                "chargers": sorted(self.dirty_charger_ids),
+            },
+            "deferred_users": sorted(self.deferred_user_ids),
         }
         return state
 
+    def _snapshot_users(self):
+        """记录影响调度的用户字段: 状态、SOC 所在区间、目标充电桩、是否需要充电决策"""
+        thresholds = self.dirty_soc_thresholds
+        return {
+            user_id: (user.get('status'), bisect_right(thresholds, user.get('soc', 100)),
+                      user.get('target_charger'), bool(user.get('needs_charge_decision')))
+            for user_id, user in self.users.items()
+        }
+
+    def _snapshot_chargers(self):
+        """记录影响调度的充电桩字段: 状态、队列、当前用户，以及评分用到的类型、最大功率和价格系数"""
+        return {
+            charger_id: (charger.get('status'), tuple(charger.get('queue', [])), charger.get('current_user'),
+                         charger.get('type'), charger.get('max_power'), charger.get('price_multiplier'))
+            for charger_id, charger in self.chargers.items()
+        }
+
+    def mark_chargers_dirty(self, charger_ids):
+        """步与步之间改动充电桩参数后调用，让下一次发布的状态立即把这些充电桩列为 dirty (否则要到下一步结束才计入)"""
+        self.dirty_charger_ids |= {cid for cid in charger_ids if cid in self.chargers}
+
+    def _update_dirty_sets(self, user_snapshot, charger_snapshot):
+        """得到本步状态发生变化的用户 (与步开始时的快照比较) 和充电桩 (与上一步结束时比较)"""
+        current_chargers = self._snapshot_chargers()
+        # 充电桩与上一步结束时比较，步与步之间 (例如界面修改定价) 的改动也会计入
+        previous_chargers = self._last_charger_snapshot if self._last_charger_snapshot is not None else charger_snapshot
+        self.dirty_charger_ids = {cid for cid, snap in current_chargers.items() if previous_chargers.get(cid) != snap}
+        self._last_charger_snapshot = current_chargers
+        failed_chargers = {cid for cid, snap in current_chargers.items() if snap[0] == 'failure'}
+
+        current_users = self._snapshot_users()
+        self.dirty_user_ids = {
+            user_id for user_id, snap in current_users.items()
+            if user_snapshot.get(user_id) != snap or (snap[2] is not None and snap[2] in failed_chargers)
+        }
+        # 被推迟的用户即使状态未变也需要重新决策
+        self.dirty_user_ids |= self.deferred_user_ids
+        self.dirty_full = False
+        self.dirty_step += 1
+
+    def _apply_power_setpoints(self, scheduler_metadata):
+        """把 metadata['power_setpoints_kw'] 写入充电桩的 power_cap_kw，未下发设定值的充电桩不限功率"""
+        setpoints = (scheduler_metadata or {}).get("power_setpoints_kw") or {}
+        for charger_id, charger in self.chargers.items():
+            charger['power_cap_kw'] = setpoints.get(charger_id)
+
+    def _update_deferred_users(self, scheduler_metadata):
+        """记录调度器因时间预算未处理的用户 (已开始充电/排队的除外)"""
+        deferred = (scheduler_metadata or {}).get("deferred_users", [])
+        self.deferred_user_ids = {
+            user_id for user_id in deferred
+            if user_id in self.users and self.users[user_id].get('status') not in ['charging', 'waiting']
+        }
+
+    def _update_service_levels(self, completed_sessions):
+        """根据本步充电桩状态记录 start/finish 事件和队列长度"""
+        for session in completed_sessions:
+            user_id, charger_id = session.get('user_id'), session.get('charger_id')
+            if not self.service_tracker.has_started(user_id, charger_id):
+                # 本步内开始又结束的会话不会以 occupied 状态出现在下面的检查中，按会话记录补上开始事件
+                start_time = self._parse_session_time(session.get('start_time'))
+                self.service_tracker.record_start(user_id, charger_id, start_time, self.users.get(user_id, {}).get('arrival_time_at_charger'))
+            self.service_tracker.record_finish(user_id, charger_id, self.current_time)
+            charger_type = self.chargers.get(session.get('charger_id'), {}).get('type', 'normal')
+            self.queue_estimator.record_session(session.get('charger_id'), charger_type, session.get('duration_minutes'))
+
+        queue_lengths = []
+        for charger_id, charger in self.chargers.items():
+            if charger.get('status') == 'failure':
+                continue
+            queue_lengths.append(len(charger.get('queue', [])))
+            # 尚未记录开始事件的充电会话 (通常是本步刚开始的)，以充电桩上的 charging_start_time 为开始时间
+            user_id = charger.get('current_user')
+            if charger.get('status') == 'occupied' and user_id and not self.service_tracker.has_started(user_id, charger_id):
+                user = self.users.get(user_id, {})
+                start_time = self._parse_session_time(charger.get('charging_start_time'))
+                self.service_tracker.record_start(user_id, charger_id, start_time, user.get('arrival_time_at_charger'))
+        self.service_tracker.observe_queue_lengths(queue_lengths)
+
+
+    def _parse_session_time(self, value):
+        """会话时间可能是 datetime 或 ISO 字符串；缺失或无法解析时用当前仿真时间"""
+        if isinstance(value, datetime):
+            return value
+        try:
+            return datetime.fromisoformat(value) if value else self.current_time
+        except (TypeError, ValueError):
+            return self.current_time
 
     def _save_current_state(self, rewards, scheduler_metadata=None): # Added scheduler_metadata
         """保存当前的关键状态和奖励到历史记录"""
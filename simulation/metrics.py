@@ -528,7 +528,11 @@ def calculate_rewards(state, config):
     else:
         results['calculated_carbon_savings_kg'] = 0.0
         logger.warning("Insufficient data for carbon savings calculation.")
-        
+
+    # --- Service Levels (wait-time quantiles from session events) ---
+    # 由 ChargingEnvironment 的 ServiceLevelTracker 提供，这里只透传给 GUI/历史记录
+    results['service_levels'] = state.get('service_levels', {})
+
     return results
 # --- Carbon Savings Helper Function ---
 def _calculate_carbon_savings(current_carbon_intensity_profile_g_kwh: list[float],
@@ -0,0 +1,139 @@
+# ev_charging_project/simulation/queue_estimator.py
+"""
+排队等待时间估计 (Queue-time estimator)
+
+environment 持有一个 QueueTimeEstimator:
+- 每个充电会话结束时用实际时长更新该充电桩的会话时长指数加权均值 (EWMA)，没有观测时按充电桩类型取默认值；
+- 每步根据当前会话用户的 SOC、目标 SOC 和可用功率估计当前会话的剩余时间，
+  得到 backlog = 当前会话剩余时间 + 排队人数 × 会话时长估计。
+
+"如果 t 分钟后到达充电桩 c，预计要等多久" 为 max(0, backlog_c - t) + ahead × session_c，查询 O(1)。
+估计结果通过 state["queue_estimates"] 发布，调度算法和用户面板用 QueueTimeEstimator.from_snapshot 读取。
+"""
+
+import logging
+
+import numpy as np
+
+from simulation.charger_model import MAX_CHARGING_MINUTES, soc_taper_factor
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SESSION_MINUTES = {"superfast": 30, "fast": 45, "normal": 60}
+
+
+class QueueTimeEstimator:
+    def __init__(self, params=None):
+        self.params = params if params is not None else {}
+        self.ewma_alpha = min(1.0, max(0.0, self.params.get('ewma_alpha', 0.2)))
+        self.default_session_minutes = dict(DEFAULT_SESSION_MINUTES)
+        self.default_session_minutes.update(self.params.get('default_session_minutes', {}))
+        self.reset()
+
+    def reset(self):
+        self._session_minutes = {}    # charger_id -> 会话时长 EWMA (分钟)
+        self._session_count = {}      # charger_id -> 已观测的会话数
+        self._charger_types = {}
+        self._backlog_minutes = {}    # charger_id -> 当前时刻起排完现有队列需要的分钟数
+
+    def record_session(self, charger_id, charger_type, duration_minutes):
+        """会话结束时记录实际时长"""
+        if duration_minutes is None or duration_minutes < 0:
+            return
+        self._charger_types[charger_id] = charger_type
+        previous = self._session_minutes.get(charger_id)
+        if previous is None:
+            self._session_minutes[charger_id] = float(duration_minutes)
+        else:
+            self._session_minutes[charger_id] = previous + self.ewma_alpha * (duration_minutes - previous)
+        self._session_count[charger_id] = self._session_count.get(charger_id, 0) + 1
+
+    def session_minutes(self, charger_id, charger_type=None):
+        """充电桩单次会话时长估计 (分钟)"""
+        estimate = self._session_minutes.get(charger_id)
+        if estimate is not None:
+            return estimate
+        charger_type = charger_type or self._charger_types.get(charger_id, "normal")
+        return self.default_session_minutes.get(charger_type, self.default_session_minutes.get("normal", 60))
+
+    def update(self, chargers, users, current_time):
+        """每步调用: 重新估计所有充电桩的 backlog"""
+        charger_list = [c for c in (chargers.values() if isinstance(chargers, dict) else chargers) if isinstance(c, dict) and "charger_id" in c]
+        for charger in charger_list:
+            self._charger_types[charger["charger_id"]] = charger.get("type", "normal")
+
+        remaining = self._remaining_current_minutes(charger_list, users, current_time)
+        self._backlog_minutes = {}
+        for charger in charger_list:
+            charger_id = charger["charger_id"]
+            if charger.get("status") == "failure":
+                continue
+            queue_minutes = len(charger.get("queue", [])) * self.session_minutes(charger_id, charger.get("type"))
+            self._backlog_minutes[charger_id] = remaining.get(charger_id, 0.0) + queue_minutes
+
+    def _remaining_current_minutes(self, charger_list, users, current_time):
+        """当前会话剩余时间: 剩余电量 / (可用功率 × 平均衰减系数)，不超过会话时长上限的剩余部分"""
+        sessions = []
+        for charger in charger_list:
+            if charger.get("status") != "occupied":
+                continue
+            user = users.get(charger.get("current_user")) if isinstance(users, dict) else None
+            if user is not None:
+                sessions.append((charger, user))
+        if not sessions:
+            return {}
+
+        soc = np.array([u.get("soc", 0) for _, u in sessions], dtype=float)
+        target_soc = np.array([u.get("target_soc") or 95 for _, u in sessions], dtype=float)
+        battery_capacity = np.array([u.get("battery_capacity", 60) for _, u in sessions], dtype=float)
+        efficiency = np.array([u.get("charging_efficiency", 0.92) or 0.92 for _, u in sessions], dtype=float)
+        power = np.array([
+            min(c.get("max_power", 60), u.get("max_charging_power", 60),
+                c.get("power_cap_kw") if c.get("power_cap_kw") is not None else float('inf'))
+            for c, u in sessions
+        ], dtype=float)
+        taper = (soc_taper_factor(soc) + soc_taper_factor(target_soc)) / 2
+        energy_kwh = np.maximum(target_soc - soc, 0) / 100.0 * battery_capacity
+        minutes = np.where(power > 0, energy_kwh / np.maximum(power * taper * efficiency, 1e-6) * 60, np.inf)
+
+        limit = []
+        for charger, _ in sessions:
+            max_minutes = MAX_CHARGING_MINUTES.get(charger.get("type", "normal"), MAX_CHARGING_MINUTES["normal"])
+            start_time = charger.get("charging_start_time")
+            elapsed = (current_time - start_time).total_seconds() / 60 if hasattr(start_time, "timestamp") and current_time is not None else 0.0
+            limit.append(max(0.0, max_minutes - elapsed))
+        minutes = np.minimum(minutes, np.array(limit))
+        return {charger["charger_id"]: float(m) for (charger, _), m in zip(sessions, minutes)}
+
+    def expected_wait(self, charger_id, arrival_in_minutes=0.0, ahead=0):
+        """
+        t = arrival_in_minutes 分钟后到达充电桩的预计等待 (分钟)；ahead 为本步新增、排在前面的用户数。
+        未知充电桩返回 None。
+        """
+        backlog = self._backlog_minutes.get(charger_id)
+        if backlog is None:
+            return None
+        return max(0.0, backlog - arrival_in_minutes) + ahead * self.session_minutes(charger_id)
+
+    def wait_arrays(self, charger_ids):
+        """按 charger_ids 顺序返回 (backlog 分钟, 会话时长分钟) 两个数组，供调度算法向量化使用"""
+        backlog = np.array([self._backlog_minutes.get(cid, 0.0) for cid in charger_ids], dtype=float)
+        session = np.array([self.session_minutes(cid) for cid in charger_ids], dtype=float)
+        return backlog, session
+
+    def snapshot(self):
+        """发布到 state["queue_estimates"] 的只读快照"""
+        return {
+            "backlog_minutes": {cid: round(m, 2) for cid, m in self._backlog_minutes.items()},
+            "session_minutes": {cid: round(self.session_minutes(cid), 2) for cid in self._backlog_minutes},
+        }
+
+    @classmethod
+    def from_snapshot(cls, snapshot, params=None):
+        """由 state["queue_estimates"] 重建只读的估计器；没有快照时返回 None"""
+        if not snapshot:
+            return None
+        estimator = cls(params)
+        estimator._backlog_minutes = dict(snapshot.get("backlog_minutes", {}))
+        estimator._session_minutes = dict(snapshot.get("session_minutes", {}))
+        return estimator
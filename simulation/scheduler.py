@@ -3,25 +3,26 @@
 import logging
 import random
 from collections import defaultdict
-import math
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime # 需要导入 datetime 用于 MARL 辅助函数
 
-# 导入算法模块 (使用 try-except 增加健壮性)
-try:
-    from algorithms import rule_based, uncoordinated
-except ImportError as e:
-    logging.error(f"Failed to import base algorithms: {e}", exc_info=True)
-    # 定义空的 schedule 函数作为 fallback
-    rule_based = type('obj', (object,), {'schedule': lambda s, c: {}})()
-    uncoordinated = type('obj', (object,), {'schedule': lambda s: {}})()
+import numpy as np
+
+# 算法模块通过注册表在第一次使用时才导入
+from algorithms.registry import AlgorithmRegistry
+from algorithms.deadline import Deadline
+from .decision_cache import DecisionCache
 
 # 导入 utils (如果需要)
 try:
-    from .utils import calculate_distance
+    from .utils import calculate_distance, positions_to_array, config as utils_config
 except ImportError:
     # 如果 utils 导入失败，提供一个 fallback 或记录错误
     logging.warning("Could not import calculate_distance from simulation.utils")
     def calculate_distance(p1, p2): return 10.0 # Fallback distance
+    def positions_to_array(items, key='position'): return np.zeros((len(items), 2))
+    utils_config = {}
 
 logger = logging.getLogger(__name__)
 
@@ -35,7 +36,6 @@ class ChargingScheduler:
         """
         self.config = config
         # 安全地获取配置，提供默认空字典
-        env_config = config.get("environment", {})
         scheduler_config = self.config.get('scheduler', {}) # Use self.config here
         if not isinstance(scheduler_config, dict):
             logger.warning("Scheduler config section not found or not a dictionary. Using default algorithm.")
@@ -44,70 +44,117 @@ class ChargingScheduler:
         self.scheduling_algorithm_name = scheduler_config.get('scheduling_algorithm', 'coordinated_mas') # Changed self.algorithm to self.scheduling_algorithm_name
         logger.info(f"ChargingScheduler initialized. Default algorithm from config: '{self.scheduling_algorithm_name}'")
 
-        marl_specific_config = scheduler_config.get("marl_config", {})
-
+        # 算法按名称懒加载并缓存 (algorithms/registry.py)，切换策略时按需创建，不需要重建调度器
+        self.algorithm_registry = AlgorithmRegistry(self.config)
+        if not self.algorithm_registry.is_registered(self.scheduling_algorithm_name):
+            logger.warning(f"Configured algorithm '{self.scheduling_algorithm_name}' is not registered. "
+                           f"Available: {self.algorithm_registry.available()}")
 
-        # 根据算法初始化特定系统
-        self.coordinated_mas_system = None
-        self.marl_system = None
+        # 单步决策时间预算 (毫秒，None 为不限)；耗尽时算法返回已有分配，未处理的用户推迟到下一步
+        self.decision_time_budget_ms = scheduler_config.get("decision_time_budget_ms")
+        self.decision_min_batch = scheduler_config.get("decision_min_users_per_step", 20)
 
-        # Populate self.algorithms for simple modules
-        self.algorithms = {
-            "rule_based": rule_based,
-            "uncoordinated": uncoordinated
-            # Note: MARL and MAS are handled via their specific system instances (self.marl_system, self.coordinated_mas_system)
-        }
-
-        # Initialize systems based on the configured self.scheduling_algorithm_name
-        if self.scheduling_algorithm_name == "coordinated_mas":
-            logger.info("Initializing Coordinated MAS subsystem as it's the configured default...")
-            try:
-                from algorithms.coordinated_mas import MultiAgentSystem
-                self.coordinated_mas_system = MultiAgentSystem(main_config=self.config) # Pass main config
-                # self.coordinated_mas_system.config = self.config # This line is redundant if passed in constructor
-                if hasattr(self.coordinated_mas_system, 'coordinator') and hasattr(self.coordinated_mas_system.coordinator, 'set_weights'):
-                    coordinator_weights = scheduler_config.get('optimization_weights', {})
-                    if coordinator_weights:
-                        self.coordinated_mas_system.coordinator.set_weights(coordinator_weights)
-                logger.info("Coordinated MAS subsystem initialized.")
-            except ImportError:
-                 logger.error("Could not import MultiAgentSystem from algorithms.coordinated_mas.")
-                 # No change to self.scheduling_algorithm_name here, error will be caught when trying to use it
-            except Exception as e:
-                logger.error(f"Failed to initialize Coordinated MAS: {e}", exc_info=True)
+        # 增量调度: 只对本步状态变化 (environment 发布的 dirty 集合) 或上一步未分配成功的用户做决策
+        incremental_config = scheduler_config.get("incremental", {})
+        self.incremental_enabled = incremental_config.get("enabled", False)
+        self.pending_soc_threshold = incremental_config.get("pending_soc_threshold", 60)
+        self._pending_user_ids = set()
 
-        elif self.scheduling_algorithm_name == "marl":
-            logger.info("Initializing MARL subsystem as it's the configured default...")
-            try:
-                from algorithms.marl import MARLSystem
-                # 获取充电桩数量，处理可能的缺失
-                num_chargers = env_config.get("charger_count")
-                if num_chargers is None:
-                    stations = env_config.get("station_count", 20)
-                    per_station = env_config.get("chargers_per_station", 10)
-                    num_chargers = stations * per_station
-                    logger.warning(f"env_config['charger_count'] not found, calculated as {num_chargers}")
-
-                self.marl_system = MARLSystem(
-                     num_chargers=num_chargers,
-                     action_space_size=marl_specific_config.get("action_space_size", 6),
-                     learning_rate=marl_specific_config.get("learning_rate", 0.01),
-                     discount_factor=marl_specific_config.get("discount_factor", 0.95),
-                     exploration_rate=marl_specific_config.get("exploration_rate", 0.1),
-                     q_table_path=marl_specific_config.get("q_table_path", None),
-                     marl_config=marl_specific_config # Ensure this line is present
-                 )
-                logger.info("MARL subsystem initialized.")
-            except ImportError:
-                 logger.error("Could not import MARLSystem from algorithms.marl.")
-                 # No change to self.scheduling_algorithm_name here
-            except Exception as e:
-                logger.error(f"Failed to initialize MARL system: {e}", exc_info=True)
+        # 量化状态签名的决策缓存: 签名未变的用户复用上一次的决策 (MARL 按充电桩决策，不使用)
+        self.decision_cache = DecisionCache(
+            scheduler_config.get("decision_cache", {}),
+            utils_config.get('simulation_constants', {}).get('DEGREES_TO_KM_APPROX_FACTOR', 111.0))
 
+        # 大规模车队按区域分片调度 (MARL 的智能体与充电桩一一对应，不参与分片)
+        sharding_config = scheduler_config.get("sharding", {})
+        self.sharded_scheduler = None
+        if sharding_config.get("enabled", False) and self.scheduling_algorithm_name != "marl":
+            self.sharded_scheduler = ShardedScheduler(self, sharding_config)
+            logger.info(f"Sharded scheduling enabled: {sharding_config}")
 
 
     def make_scheduling_decision(self, current_state, manual_decisions=None, grid_preferences=None):
         """根据配置的算法进行调度决策，支持手动决策优先和电网偏好"""
+        deadline = Deadline(self.decision_time_budget_ms, self.decision_min_batch)
+        incremental = self.incremental_enabled and self.scheduling_algorithm_name != "marl"
+        decision_state = current_state
+        incremental_info = None
+        if incremental:
+            decision_state, incremental_info = self._build_incremental_state(current_state)
+
+        cached = self.decision_cache.enabled and self.scheduling_algorithm_name != "marl"
+        algorithm_state = decision_state
+        if cached:
+            dirty = current_state.get("dirty")
+            if dirty and dirty.get("full", False):
+                # 环境重置后的第一步: 上一次仿真的决策不再适用
+                self.decision_cache.clear()
+            context_key = self.decision_cache.context_key(
+                decision_state, self.scheduling_algorithm_name, grid_preferences,
+                self.config.get('scheduler', {}).get('optimization_weights'))
+            reused_decisions, miss_users, miss_keys = self.decision_cache.lookup(decision_state, context_key)
+            # 复用的分配作为充电桩的额外排队交给算法，算法不会再把这些排队位分给其他用户
+            algorithm_state = self.decision_cache.algorithm_view(decision_state, miss_users, reused_decisions)
+
+        if self.sharded_scheduler is not None and self.sharded_scheduler.should_shard(algorithm_state, grid_preferences):
+            decisions, metadata = self.sharded_scheduler.make_scheduling_decision(algorithm_state, manual_decisions, grid_preferences, deadline)
+        else:
+            decisions, metadata = self._make_single_scheduling_decision(algorithm_state, manual_decisions, grid_preferences, deadline)
+
+        if cached:
+            # 手动决策不写入缓存
+            self.decision_cache.store(miss_keys, decisions, set(metadata.get("deferred_users", [])) | set(manual_decisions or {}))
+            for user_id, charger_id in reused_decisions.items():
+                decisions.setdefault(user_id, charger_id)
+            metadata["decision_cache"] = dict(self.decision_cache.stats(), reused=len(reused_decisions))
+
+        deferred_users = [user_id for user_id in metadata.get("deferred_users", []) if user_id not in decisions]
+        metadata["deferred_users"] = deferred_users
+        metadata["deferred_user_count"] = len(deferred_users)
+        metadata["time_budget_ms"] = deadline.budget_ms
+        metadata["budget_exhausted"] = deadline.expired()
+        metadata["decision_time_ms"] = round(deadline.elapsed_ms(), 2)
+        if deferred_users:
+            logger.warning(f"SCHEDULER: Decision time budget ({deadline.budget_ms} ms) exhausted, {len(deferred_users)} users deferred to the next step.")
+
+        if incremental:
+            self._update_pending_users(decision_state, decisions)
+            incremental_info["pending_after"] = len(self._pending_user_ids)
+            metadata["incremental"] = incremental_info
+        return decisions, metadata
+
+    def _build_incremental_state(self, current_state):
+        """只保留 dirty 用户和待定用户的状态视图；充电桩保持完整以便正确计算容量"""
+        dirty = current_state.get("dirty")
+        users = current_state.get("users", [])
+        if not dirty or dirty.get("full", True):
+            self._pending_user_ids = set()
+            return current_state, {"mode": "full", "considered_users": len(users), "total_users": len(users)}
+
+        considered_ids = set(dirty.get("users", [])) | self._pending_user_ids
+        view = dict(current_state)
+        view["users"] = [u for u in users if isinstance(u, dict) and u.get("user_id") in considered_ids]
+        return view, {
+            "mode": "incremental",
+            "dirty_users": len(dirty.get("users", [])),
+            "dirty_chargers": len(dirty.get("chargers", [])),
+            "pending_before": len(self._pending_user_ids),
+            "considered_users": len(view["users"]),
+            "total_users": len(users),
+        }
+
+    def _update_pending_users(self, decision_state, decisions):
+        """本步考虑过、仍可能需要充电但未被分配的用户，下一步即使状态未变也继续考虑"""
+        self._pending_user_ids = {
+            u.get("user_id") for u in decision_state.get("users", [])
+            if isinstance(u, dict) and u.get("user_id") not in decisions
+            and u.get("status") not in ["charging", "waiting"]
+            and (u.get("needs_charge_decision") or u.get("soc", 100) < self.pending_soc_threshold)
+        }
+
+    def _make_single_scheduling_decision(self, current_state, manual_decisions=None, grid_preferences=None, deadline=None,
+                                         algorithm_registry=None):
+        """在完整状态 (或单个分片) 上运行所选算法；分片调度传入分片自己的注册表，算法实例不在分片间共享"""
         # 初始化元数据字典，确保总有返回值
         scheduler_metadata = {
             "algorithm_used": "unknown",
@@ -131,7 +178,7 @@ class ChargingScheduler:
         if ui_strategy == "uncoordinated":
             effective_algo_name = "uncoordinated"
         elif ui_strategy == "smart_charging_v1g":
-            if self.scheduling_algorithm_name in ["coordinated_mas", "marl"]: 
+            if self.scheduling_algorithm_name in ["coordinated_mas", "marl", "mpc"]: 
                 effective_algo_name = self.scheduling_algorithm_name
                 operational_mode = 'v1g'
         elif ui_strategy == "v2g_active":
@@ -141,61 +188,35 @@ class ChargingScheduler:
         
         scheduler_metadata["algorithm_used"] = effective_algo_name
 
-        # --- 获取算法模块或系统实例 ---
-        algo_module_or_system = None
-        if effective_algo_name == "coordinated_mas": algo_module_or_system = self.coordinated_mas_system
-        elif effective_algo_name == "marl": algo_module_or_system = self.marl_system
-        else: algo_module_or_system = self.algorithms.get(effective_algo_name)
-
-        if not algo_module_or_system:
-            logger.error(f"SCHEDULER: Algorithm module/system for '{effective_algo_name}' not found.")
+        # --- 获取算法实例 (首次使用时加载) ---
+        algorithm = (algorithm_registry or self.algorithm_registry).get(effective_algo_name)
+        if algorithm is None:
+            logger.error(f"SCHEDULER: Algorithm '{effective_algo_name}' could not be loaded.")
             return {}, scheduler_metadata # 保证返回两个值
 
-        if operational_mode and hasattr(algo_module_or_system, 'set_operational_mode'):
-            algo_module_or_system.set_operational_mode(operational_mode)
+        if operational_mode and hasattr(algorithm, 'set_operational_mode'):
+            algorithm.set_operational_mode(operational_mode)
 
         # --- 开始决策流程 ---
         try:
-            # 1. 处理手动决策 (这部分逻辑是正确的，保持不变)
+            # 1. 处理手动决策
             validated_manual_decisions = {}
             if manual_decisions and isinstance(manual_decisions, dict):
-                # ... (validation logic for manual decisions) ...
                 users_map = {u.get('user_id'): u for u in current_state.get('users', []) if isinstance(u, dict)}
                 chargers_map = {c.get('charger_id'): c for c in current_state.get('chargers', []) if isinstance(c, dict)}
                 for user_id, charger_id in manual_decisions.items():
                     if user_id in users_map and charger_id in chargers_map:
                          validated_manual_decisions[user_id] = charger_id
 
-            # 2. 调用算法模块获取决策和元数据
-            if hasattr(algo_module_or_system, 'schedule'):
-                # --- START OF FIX ---
-                # 正确解包算法返回的元组
-                algo_decisions, algo_metadata = algo_module_or_system.schedule(
-                    current_state, self.config, manual_decisions, grid_preferences
-                )
-                # 更新我们的主元数据
-                scheduler_metadata.update(algo_metadata)
-                # --- END OF FIX ---
-
-            elif hasattr(algo_module_or_system, 'make_decisions'): # For Coordinated MAS
-                # 假设 make_decisions 也返回元组
-                algo_decisions, algo_metadata = algo_module_or_system.make_decisions(
-                    current_state, manual_decisions, grid_preferences
-                )
-                scheduler_metadata.update(algo_metadata)
-
-            elif effective_algo_name == "marl" and self.marl_system:
-                # MARL的逻辑比较特殊，我们在这里封装它的返回
-                # ... (MARL action creation and conversion logic) ...
-                marl_actions = self.marl_system.choose_actions(current_state)
-                algo_decisions = self._convert_marl_actions_to_decisions(marl_actions, current_state, {}) # Placeholder for action maps
-                # MARL 目前没有返回元数据，所以我们用默认值
-                scheduler_metadata['candidate_user_count'] = len(algo_decisions) # 粗略估计
-            
-            else:
-                logger.error(f"SCHEDULER: Algorithm '{effective_algo_name}' has no recognized decision method.")
-                # 即使出错，也要保证返回两个值
-                return {}, scheduler_metadata
+            # 2. 所有算法使用统一接口 decide(state_view, context) -> (decisions, metadata)
+            context = {
+                "manual_decisions": manual_decisions,
+                "grid_preferences": grid_preferences,
+                "operational_mode": operational_mode,
+                "deadline": deadline,
+            }
+            algo_decisions, algo_metadata = algorithm.decide(current_state, context)
+            scheduler_metadata.update(algo_metadata)
 
             # 3. 合并决策 (算法决策优先，手动决策覆盖)
             # 注意：这里的逻辑应该是 manual_decisions 覆盖 algo_decisions
@@ -212,28 +233,45 @@ class ChargingScheduler:
         # 确保最终返回的是一个包含两个元素的元组
         return final_decisions, scheduler_metadata
     def _get_configured_algorithm_module(self):
-        """Helper to get the module instance based on self.scheduling_algorithm_name from config."""
-        # This method is primarily for simple modules listed in self.algorithms
-        # MAS and MARL are typically handled via their dedicated system instances.
-        if self.scheduling_algorithm_name in self.algorithms:
-            return self.algorithms[self.scheduling_algorithm_name]
-        elif self.scheduling_algorithm_name == "coordinated_mas" and self.coordinated_mas_system:
-             return self.coordinated_mas_system # Should be handled before calling this ideally
-        elif self.scheduling_algorithm_name == "marl" and self.marl_system:
-             return self.marl_system # Should be handled before calling this ideally
-        logger.error(f"Configured algorithm {self.scheduling_algorithm_name} module not found in self.algorithms or as a system.")
-        return None
-        
+        """返回当前配置算法的实例 (按需加载)"""
+        return self.algorithm_registry.get(self.scheduling_algorithm_name)
+
+    def set_algorithm(self, algorithm_name):
+        """运行中切换默认算法；新算法在下一次决策时懒加载，已加载的实例会被复用"""
+        if not self.algorithm_registry.is_registered(algorithm_name):
+            logger.error(f"Cannot switch to unregistered algorithm '{algorithm_name}'. Available: {self.algorithm_registry.available()}")
+            return False
+        self.scheduling_algorithm_name = algorithm_name
+        self.config.setdefault('scheduler', {})['scheduling_algorithm'] = algorithm_name
+        self.decision_cache.clear()
+        logger.info(f"Scheduler algorithm switched to '{algorithm_name}'.")
+        return True
+
+    @property
+    def coordinated_mas_system(self):
+        """兼容旧属性: 当前配置为 MAS 时返回 (并加载) 其实例，否则返回已加载的实例或 None"""
+        if self.scheduling_algorithm_name == "coordinated_mas":
+            return self.algorithm_registry.get("coordinated_mas")
+        return self.algorithm_registry.peek("coordinated_mas")
+
+    @property
+    def marl_system(self):
+        """兼容旧属性: 当前配置为 MARL 时返回 (并加载) 其实例，否则返回已加载的实例或 None"""
+        if self.scheduling_algorithm_name == "marl":
+            return self.algorithm_registry.get("marl")
+        return self.algorithm_registry.peek("marl")
+
+    def shutdown(self):
+        """释放算法和分片调度持有的线程池"""
+        if self.sharded_scheduler is not None:
+            self.sharded_scheduler.shutdown()
+        self.algorithm_registry.shutdown()
+
     # --- learn, load_q_tables, save_q_tables ---
     def learn(self, state, actions, rewards, next_state): # Use 'state' consistent with other methods if it's current_state
-        """如果使用 MARL，则调用其学习方法"""
-        if self.algorithm == "marl" and self.marl_system:
+        """如果使用 MARL，则用 step 后的状态补全上一次决策的经验并做批量 Q 更新"""
+        if self.scheduling_algorithm_name == "marl" and self.marl_system:
             try:
-                # TODO: 确认 MARLSystem.update_q_tables 需要的 actions 格式。
-                # 假设它需要原始的 {charger_id: action_index} 映射。
-                # 目前传入的是 decisions {user_id: charger_id}，这可能不正确。
-                # 需要在 run_simulation 循环中存储 marl_actions 并传递到这里，
-                # 或者让 MARLSystem.update_q_tables 能处理 decisions。
                 logger.debug("Calling MARL learn...")
                 self.marl_system.update_q_tables(state, actions, rewards, next_state)
             except Exception as e:
@@ -241,13 +279,13 @@ class ChargingScheduler:
 
     def load_q_tables(self):
         """如果使用 MARL，加载 Q 表"""
-        if self.algorithm == "marl" and self.marl_system:
+        if self.scheduling_algorithm_name == "marl" and self.marl_system:
             logger.info("Scheduler attempting to load MARL Q-tables...")
             self.marl_system.load_q_tables()
 
     def save_q_tables(self):
         """如果使用 MARL，保存 Q 表"""
-        if self.algorithm == "marl" and self.marl_system:
+        if self.scheduling_algorithm_name == "marl" and self.marl_system:
             logger.info("Scheduler attempting to save MARL Q-tables...")
             self.marl_system.save_q_tables()
 
@@ -257,169 +295,200 @@ class ChargingScheduler:
         为 MARL 创建动态动作映射。
         Index 0 is 'idle', subsequent indices map to potential user IDs.
         """
-        # 从配置中获取 MARL 参数
-        marl_config = self.config.get("scheduler", {}).get("marl_config", {})
-        candidate_params = marl_config.get('candidate_selection_params', {})
-        
-        action_space_size = marl_config.get("action_space_size", 6) # Default to 6
-        max_potential_users = action_space_size - 1 # Number of users to map
-
-        # --- 获取可配置的候选用户选择参数 ---
-        MAX_DISTANCE_SQ = marl_config.get("marl_candidate_max_dist_sq", 0.15**2) # Example: (0.15 degrees)^2
-        W_SOC = marl_config.get("marl_priority_w_soc", 0.5) # Weight for SOC in priority scoring
-        W_DIST = marl_config.get("marl_priority_w_dist", 0.4) # Weight for distance
-        W_URGENCY = marl_config.get("marl_priority_w_urgency", 0.1) # Weight for urgency
-
-        base_soc_trigger = candidate_params.get('base_soc_threshold', 40)
-        profile_soc_adjustments = candidate_params.get('profile_soc_adjustments', {})
-        dist_conversion_factor = candidate_params.get('distance_unit_conversion_factor', 111.0) # km per degree
-
-        action_map = {0: 'idle'} # Action 0 is always idle
-        chargers = state.get('chargers', [])
-        users = state.get('users', [])
-        charger = next((c for c in chargers if c.get('charger_id') == charger_id), None)
-
-        if not charger or charger.get('status') == 'failure':
-            # logger.debug(f"Charger {charger_id} not found or failed, only idle action.")
-            return action_map, action_space_size # Only 'idle' is possible
-
-        potential_users = []
-        charger_pos = charger.get('position', {}) # Default to empty dict if missing
-
-        for user in users:
-            user_id = user.get('user_id')
-            soc = user.get('soc', 100)
-            status = user.get('status', 'unknown')
-            user_profile = user.get('user_profile', 'flexible')
-            needs_charge_flag = user.get('needs_charge_decision', False)
-
-            if not user_id: continue
-
-            # --- 筛选逻辑: 寻找主动寻求充电的用户 ---
-            is_actively_seeking = False
-            
-            charge_threshold = base_soc_trigger # Start with base
-            charge_threshold += profile_soc_adjustments.get(user_profile, 0)
-            # Ensure threshold is reasonable, e.g. not negative if adjustments are large
-            charge_threshold = max(5, charge_threshold) # Minimum practical threshold
-
-            is_low_soc = soc < charge_threshold
-
-            # 满足以下条件之一视为寻求充电:
-            # 1. 用户明确标记需要决策
-            if needs_charge_flag and status not in ['charging', 'waiting']:
-                 is_actively_seeking = True
-            # 2. 用户空闲或随机旅行，且电量低于阈值
-            elif status in ['idle', 'traveling'] and user.get('target_charger') is None and is_low_soc:
-                 is_actively_seeking = True
-
-            if not is_actively_seeking:
-                continue # 跳过不寻求充电的用户
-            # --- 结束筛选 ---
-
-            user_pos = user.get('current_position',{})
-            # 检查坐标有效性
-            if isinstance(user_pos.get('lat'), (int, float)) and isinstance(user_pos.get('lng'), (int, float)) and \
-               isinstance(charger_pos.get('lat'), (int, float)) and isinstance(charger_pos.get('lng'), (int, float)):
-
-                dist_sq = (user_pos['lat'] - charger_pos['lat'])**2 + (user_pos['lng'] - charger_pos['lng'])**2
-
-                if dist_sq < MAX_DISTANCE_SQ:
-                    distance = math.sqrt(dist_sq) * dist_conversion_factor # Use configured conversion factor
-                    # 计算紧迫度 (0 to 1, higher is more urgent)
-                    urgency = max(0, (charge_threshold - soc)) / charge_threshold if charge_threshold > 0 else 0
-
-                    # --- 计算优先级分数 ---
-                    normalized_distance = min(1.0, math.sqrt(dist_sq) / math.sqrt(MAX_DISTANCE_SQ)) if MAX_DISTANCE_SQ > 0 else 0
-                    priority_score = (
-                        W_SOC * (1.0 - soc / 100.0) +      # 低 SOC 贡献正分
-                        W_DIST * (1.0 - normalized_distance) + # 近距离贡献正分
-                        W_URGENCY * urgency                 # 紧迫度贡献正分
-                    )
-                    # --- 结束评分 ---
-
-                    potential_users.append({
-                            'id': user_id,
-                            'priority': priority_score
-                    })
-                    # logger.debug(f"User {user_id} potential for {charger_id}. Priority: {priority_score:.3f}")
-            # else: logger.warning(f"Invalid coordinates for distance calc: User {user_id} or Charger {charger_id}")
-
-        # 按优先级排序 (高优先级在前)
-        potential_users.sort(key=lambda u: -u['priority'])
-        # logger.debug(f"Found {len(potential_users)} potential users for {charger_id}.")
-
-        # 映射优先级最高的用户到动作索引
-        assigned_users_count = 0
-        for i, user_info in enumerate(potential_users):
-             if assigned_users_count < max_potential_users:
-                  action_map[i + 1] = user_info['id']
-                  assigned_users_count += 1
-             else:
-                  break # Stop once we've filled the action space slots
-
-        # logger.debug(f"Final action map for {charger_id}: {action_map}")
-        return action_map, action_space_size
+        action_maps, _ = self._build_marl_action_maps(state, [charger_id])
+        action_space_size = self.config.get("scheduler", {}).get("marl_config", {}).get("action_space_size", 6)
+        return action_maps.get(charger_id, {}).get("map", {0: 'idle'}), action_space_size
 
+    def _build_marl_action_maps(self, state, charger_ids=None):
+        """批量构建 MARL 动作映射 (见 algorithms.marl.build_action_maps)"""
+        from algorithms.marl import build_action_maps
+        return build_action_maps(state, self.config.get("scheduler", {}).get("marl_config", {}), charger_ids)
 
     def _convert_marl_actions_to_decisions(self, agent_actions, state, charger_action_maps):
         """
         将 MARL 智能体选择的动作 {charger_id: action_index}
         转换为充电分配决策 {user_id: charger_id}。
         """
+        from algorithms.marl import convert_actions_to_decisions
+        return convert_actions_to_decisions(agent_actions, state, charger_action_maps)
+
+
+class ShardedScheduler:
+    """
+    按区域分片的调度包装器。
+
+    充电桩按 region 标签 (shard_by="region") 或地图网格 (shard_by="grid") 划分到分片，
+    每个用户只归入一个分片 (所在或最近的分片包围盒)。为了让边界用户也能看到相邻区域，
+    其他分片中距本分片包围盒 overlap_margin_km 以内的充电桩作为 "邻接充电桩" 一并下发。
+    各分片在线程池中独立运行所选算法，每个分片使用自己的算法实例 (按分片键懒加载并跨步保留)，
+    运行模式、协调器统计、MPC 预热计划等算法状态不会在并发的分片之间互相覆盖；
+    同一充电桩收到多个分片的分配时，保留其所属分片的分配，
+    邻接分配只在充电桩剩余排队容量 (queue_capacity) 允许时保留，其余用户留待下一步重新调度。
+    """
+
+    def __init__(self, scheduler, params=None):
+        self.scheduler = scheduler
+        self.params = params if params is not None else {}
+        self.shard_by = self.params.get("shard_by", "grid")
+        self.grid_rows = max(1, self.params.get("grid_rows", 2))
+        self.grid_cols = max(1, self.params.get("grid_cols", 2))
+        self.overlap_margin_km = self.params.get("overlap_margin_km", 1.0)
+        self.max_workers = self.params.get("max_workers", 4)
+        self.min_users_for_sharding = self.params.get("min_users_for_sharding", 2000)
+        self.degrees_to_km = utils_config.get('simulation_constants', {}).get('DEGREES_TO_KM_APPROX_FACTOR', 111.0)
+        self._executor = None
+        self._shard_registries = {}
+
+    def should_shard(self, state, grid_preferences=None):
+        """用户规模较小时分片没有收益，直接整体调度"""
+        return len(state.get("users", [])) >= self.min_users_for_sharding
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        for registry in self._shard_registries.values():
+            registry.shutdown()
+        self._shard_registries = {}
+
+    def _shard_registry(self, shard_key):
+        """分片自己的算法注册表 (在调度线程上创建，线程池中只读取)"""
+        registry = self._shard_registries.get(shard_key)
+        if registry is None:
+            registry = self._shard_registries[shard_key] = AlgorithmRegistry(self.scheduler.config)
+        return registry
+
+    def build_shards(self, state):
+        """返回 [{'key', 'users', 'chargers', 'own_charger_ids'}]，空分片会被丢弃"""
+        chargers = [c for c in state.get("chargers", []) if isinstance(c, dict) and "charger_id" in c]
+        users = [u for u in state.get("users", []) if isinstance(u, dict) and "user_id" in u]
+        if not chargers:
+            return []
+
+        charger_pos = positions_to_array(chargers)
+        shard_keys = self._charger_shard_keys(chargers, charger_pos)
+        keys = list(dict.fromkeys(shard_keys))
+        key_index = {k: i for i, k in enumerate(keys)}
+        charger_shard = np.array([key_index[k] for k in shard_keys])
+
+        # 每个分片的包围盒 (度): lat_min, lat_max, lng_min, lng_max
+        boxes = np.full((len(keys), 4), np.nan)
+        for i in range(len(keys)):
+            pts = charger_pos[(charger_shard == i) & ~np.isnan(charger_pos[:, 0])]
+            if len(pts):
+                boxes[i] = (pts[:, 0].min(), pts[:, 0].max(), pts[:, 1].min(), pts[:, 1].max())
+
+        shards = [{"key": k, "users": [], "chargers": [], "own_charger_ids": set()} for k in keys]
+        user_box_dist = self._box_distances(positions_to_array(users, "current_position"), boxes)
+        for user, distances in zip(users, user_box_dist):
+            home = int(np.argmin(distances)) if np.isfinite(distances).any() else 0
+            shards[home]["users"].append(user)
+
+        charger_box_dist = self._box_distances(charger_pos, boxes)
+        for charger, own_shard, distances in zip(chargers, charger_shard, charger_box_dist):
+            shards[own_shard]["own_charger_ids"].add(charger["charger_id"])
+            for shard_idx in np.flatnonzero((distances <= self.overlap_margin_km) | (np.arange(len(keys)) == own_shard)):
+                shards[shard_idx]["chargers"].append(charger)
+        return [shard for shard in shards if shard["users"] and shard["chargers"]]
+
+    def _box_distances(self, points, boxes):
+        """点到每个包围盒的距离 (km)，盒内为 0，无效坐标为 inf"""
+        dlat = np.maximum(0, np.maximum(boxes[None, :, 0] - points[:, None, 0], points[:, None, 0] - boxes[None, :, 1]))
+        dlng = np.maximum(0, np.maximum(boxes[None, :, 2] - points[:, None, 1], points[:, None, 1] - boxes[None, :, 3]))
+        distances = np.hypot(dlat, dlng) * self.degrees_to_km
+        distances[np.isnan(distances)] = np.inf
+        return distances
+
+    def _charger_shard_keys(self, chargers, charger_pos):
+        if self.shard_by == "region":
+            return [c.get("region", "unknown") for c in chargers]
+        valid = ~np.isnan(charger_pos[:, 0])
+        if not valid.any():
+            return ["grid_0_0"] * len(chargers)
+        lat_min, lat_max = charger_pos[valid, 0].min(), charger_pos[valid, 0].max()
+        lng_min, lng_max = charger_pos[valid, 1].min(), charger_pos[valid, 1].max()
+        rows = np.clip(np.nan_to_num((charger_pos[:, 0] - lat_min) / max(lat_max - lat_min, 1e-9) * self.grid_rows).astype(int), 0, self.grid_rows - 1)
+        cols = np.clip(np.nan_to_num((charger_pos[:, 1] - lng_min) / max(lng_max - lng_min, 1e-9) * self.grid_cols).astype(int), 0, self.grid_cols - 1)
+        return [f"grid_{r}_{c}" for r, c in zip(rows, cols)]
+
+    def make_scheduling_decision(self, current_state, manual_decisions=None, grid_preferences=None, deadline=None):
+        start = time.perf_counter()
+        shards = self.build_shards(current_state)
+        if len(shards) <= 1:
+            return self.scheduler._make_single_scheduling_decision(current_state, manual_decisions, grid_preferences, deadline)
+
+        total_chargers = sum(len(s["own_charger_ids"]) for s in shards)
+        fleet_limit_mw = (grid_preferences or {}).get("max_ev_fleet_load_mw")
+        registries = {shard["key"]: self._shard_registry(shard["key"]) for shard in shards}
+
+        def run_shard(shard):
+            shard_state = dict(current_state)
+            shard_state["users"] = shard["users"]
+            shard_state["chargers"] = shard["chargers"]
+            shard_state["shard_key"] = shard["key"]
+            shard_preferences = grid_preferences
+            if fleet_limit_mw is not None and total_chargers:
+                # 车队负载上限按分片拥有的充电桩数分摊，避免每个分片都用满整体上限
+                shard_preferences = dict(grid_preferences)
+                shard_preferences["max_ev_fleet_load_mw"] = fleet_limit_mw * len(shard["own_charger_ids"]) / total_chargers
+            # 手动决策在合并后统一覆盖，不下发到分片
+            # 各分片共享同一个 deadline
+            return self.scheduler._make_single_scheduling_decision(shard_state, None, shard_preferences, deadline,
+                                                                   registries[shard["key"]])
+
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="sched-shard")
+        results = list(self._executor.map(run_shard, shards))
+
+        decisions, metadata, dropped = self._reconcile(shards, results, current_state)
+
+        if manual_decisions and isinstance(manual_decisions, dict):
+            user_ids = {u.get('user_id') for u in current_state.get('users', []) if isinstance(u, dict)}
+            charger_ids = {c.get('charger_id') for c in current_state.get('chargers', []) if isinstance(c, dict)}
+            decisions.update({u: c for u, c in manual_decisions.items() if u in user_ids and c in charger_ids})
+
+        metadata["sharding"] = {
+            "shard_by": self.shard_by,
+            "shards": len(shards),
+            "max_shard_users": max(len(s["users"]) for s in shards),
+            "neighbour_charger_slots": sum(len(s["chargers"]) - len(s["own_charger_ids"]) for s in shards),
+            "cross_shard_dropped": dropped,
+            "elapsed_ms": round((time.perf_counter() - start) * 1000, 2),
+        }
+        logger.info(f"SCHEDULER (sharded): {len(decisions)} assignments from {len(shards)} shards, {dropped} cross-shard assignments dropped.")
+        return decisions, metadata
+
+    def _reconcile(self, shards, results, state):
+        """合并各分片决策；邻接充电桩上的分配受该桩剩余 queue_capacity 限制"""
+        chargers_by_id = {c.get("charger_id"): c for c in state.get("chargers", []) if isinstance(c, dict)}
+        users_by_id = {u.get("user_id"): u for u in state.get("users", []) if isinstance(u, dict)}
+        metadata = {"algorithm_used": None, "candidate_user_count": 0, "deferred_users": []}
         decisions = {}
-        assigned_users = set() # 跟踪已分配用户，防止重复
-
-        if not isinstance(agent_actions, dict):
-             logger.error(f"_convert_marl_actions_to_decisions received invalid agent_actions type: {type(agent_actions)}")
-             return {}
-
-        logger.debug(f"Converting MARL actions: {agent_actions}")
-
-        # 遍历每个充电站智能体选择的动作
-        for charger_id, action_index in agent_actions.items():
-            # Action 0 总是表示'idle'(不分配)
-            if action_index == 0:
-                # logger.debug(f"Charger {charger_id} chose 'idle' (action 0)")
-                continue
-
-            # --- 使用预生成的动作映射 ---
-            map_data = charger_action_maps.get(charger_id)
-            if not map_data:
-                logger.warning(f"No pre-generated action map found for charger {charger_id}. Cannot convert action {action_index}. Skipping.")
-                continue
-            action_map = map_data.get("map")
-            if not action_map:
-                logger.warning(f"Invalid action map data for charger {charger_id}. Skipping.")
-                continue
-
-            # 在提供的映射中查找对应于所选 action_index 的 user_id
-            user_id_to_assign = action_map.get(action_index)
-
-            if user_id_to_assign and user_id_to_assign != 'idle':
-                # 检查这个用户是否已经被另一个充电站分配
-                if user_id_to_assign not in assigned_users:
-                    # 验证用户是否仍然存在于状态中 (可选但更健壮)
-                    user_exists = any(u.get('user_id') == user_id_to_assign for u in state.get('users', []))
-                    if user_exists:
-                        decisions[user_id_to_assign] = charger_id
-                        assigned_users.add(user_id_to_assign)
-                        logger.debug(f"MARL decision: Assign user {user_id_to_assign} to charger {charger_id} (from action index {action_index})")
-                    else:
-                         logger.warning(f"MARL action {action_index} mapped to user {user_id_to_assign} but user not found in current state. Skipping.")
+        neighbour_proposals = {}
+        owner_counts = defaultdict(int)
+        for shard, (shard_decisions, shard_metadata) in zip(shards, results):
+            metadata["algorithm_used"] = metadata["algorithm_used"] or shard_metadata.get("algorithm_used")
+            metadata["candidate_user_count"] += shard_metadata.get("candidate_user_count", 0) or 0
+            metadata["deferred_users"].extend(shard_metadata.get("deferred_users", []))
+            # 功率设定值只采用充电桩所属分片给出的值
+            for charger_id, power_kw in shard_metadata.get("power_setpoints_kw", {}).items():
+                if charger_id in shard["own_charger_ids"]:
+                    metadata.setdefault("power_setpoints_kw", {})[charger_id] = power_kw
+            for user_id, charger_id in shard_decisions.items():
+                if charger_id in shard["own_charger_ids"]:
+                    decisions[user_id] = charger_id
+                    owner_counts[charger_id] += 1
                 else:
-                    # 冲突: 用户已被分配。记录日志。
-                    logger.warning(f"MARL conflict: User {user_id_to_assign} was already assigned. Charger {charger_id} also selected this user (action index {action_index}). Ignoring second assignment.")
-            else:
-                # 所选动作索引可能不对应任何用户
-                logger.debug(f"Charger {charger_id} chose action index {action_index}, but no valid user found in its action map: {action_map}")
-
-        # --- 可选的应急分配逻辑 ---
-        # (如果需要，可以从原 app.py 复制粘贴应急分配逻辑到这里)
-        # if not decisions and active_count > 20: ...
-
-        if not decisions:
-            logger.warning("MARL action conversion resulted in zero assignments.")
-        else:
-            logger.info(f"Converted MARL actions to {len(decisions)} assignments.")
-        return decisions
\ No newline at end of file
+                    neighbour_proposals.setdefault(charger_id, []).append(user_id)
+
+        dropped = 0
+        for charger_id, user_ids in neighbour_proposals.items():
+            charger = chargers_by_id.get(charger_id, {})
+            load = len(charger.get("queue", [])) + (1 if charger.get("status") == "occupied" else 0)
+            free_slots = max(0, charger.get("queue_capacity", 5) - load - owner_counts[charger_id])
+            charger_pos = charger.get("position", {})
+            user_ids.sort(key=lambda uid: calculate_distance(users_by_id.get(uid, {}).get("current_position", {}), charger_pos))
+            for user_id in user_ids[:free_slots]:
+                decisions[user_id] = charger_id
+            dropped += max(0, len(user_ids) - free_slots)
+        return decisions, metadata, dropped
@@ -0,0 +1,179 @@
+# ev_charging_project/simulation/service_metrics.py
+"""
+服务水平指标 (Service-level metrics)
+
+基于会话事件时间戳 (到达 / 开始充电 / 充电结束) 统计排队等待时间分布。
+分位数使用对数分桶的流式草图 (DDSketch 思路)：每次更新 O(1)，
+查询只需遍历少量桶，可以在每个仿真步随时读取 P50/P95/P99。
+"""
+
+import logging
+import math
+from collections import defaultdict, deque
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_QUANTILES = (0.5, 0.95, 0.99)
+
+
+class StreamingQuantileSketch:
+    """对数分桶的流式分位数草图，保证相对误差不超过 relative_accuracy。"""
+
+    def __init__(self, relative_accuracy=0.01, min_positive_value=1e-3):
+        if not 0 < relative_accuracy < 1:
+            logger.warning(f"Invalid relative_accuracy {relative_accuracy}, falling back to 0.01.")
+            relative_accuracy = 0.01
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self.gamma)
+        self.min_positive_value = min_positive_value
+        self.reset()
+
+    def reset(self):
+        self.buckets = defaultdict(int)
+        self.zero_count = 0
+        self.count = 0
+        self.total = 0.0
+        self.min_value = None
+        self.max_value = None
+
+    def add(self, value, count=1):
+        """加入一个观测值 (负值按 0 处理)。"""
+        if value is None or count <= 0:
+            return
+        value = max(0.0, float(value))
+        if value < self.min_positive_value:
+            self.zero_count += count
+        else:
+            self.buckets[math.ceil(math.log(value) / self._log_gamma)] += count
+        self.count += count
+        self.total += value * count
+        self.min_value = value if self.min_value is None else min(self.min_value, value)
+        self.max_value = value if self.max_value is None else max(self.max_value, value)
+
+    def merge(self, other):
+        """合并另一个参数相同的草图 (用于分片/多环境汇总)。"""
+        if other.gamma != self.gamma:
+            raise ValueError("Cannot merge sketches with different relative accuracy.")
+        for key, bucket_count in other.buckets.items():
+            self.buckets[key] += bucket_count
+        self.zero_count += other.zero_count
+        self.count += other.count
+        self.total += other.total
+        for value in (other.min_value, other.max_value):
+            if value is not None:
+                self.min_value = value if self.min_value is None else min(self.min_value, value)
+                self.max_value = value if self.max_value is None else max(self.max_value, value)
+
+    def quantile(self, q):
+        """返回分位数 q (0-1) 的估计值，无数据时返回 None。"""
+        if self.count == 0:
+            return None
+        q = min(1.0, max(0.0, q))
+        rank = q * (self.count - 1)
+        if rank < self.zero_count:
+            return 0.0
+        cumulative = self.zero_count
+        for key in sorted(self.buckets):
+            cumulative += self.buckets[key]
+            if cumulative > rank:
+                estimate = 2 * self.gamma ** key / (self.gamma + 1)
+                return min(max(estimate, self.min_value), self.max_value)
+        return self.max_value
+
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+
+class ServiceLevelTracker:
+    """记录每个充电会话的 arrive/start/finish 事件，并维护等待时间和队列长度的分位数。"""
+
+    def __init__(self, params=None):
+        self.params = params if params is not None else {}
+        self.max_events = self.params.get('event_log_max_events', 10000)
+        self.relative_accuracy = self.params.get('quantile_relative_accuracy', 0.01)
+        self.quantiles = tuple(self.params.get('reported_quantiles', DEFAULT_QUANTILES))
+        self.reset()
+
+    def reset(self):
+        self.events = deque(maxlen=self.max_events)
+        self._open_sessions = {}  # user_id -> {'charger_id', 'arrival_time', 'start_time'}
+        self.wait_minutes = StreamingQuantileSketch(self.relative_accuracy)
+        self.charging_minutes = StreamingQuantileSketch(self.relative_accuracy)
+        self.queue_length = StreamingQuantileSketch(self.relative_accuracy)
+        self.completed_sessions = 0
+
+    def _log_event(self, event, user_id, charger_id, timestamp, **extra):
+        entry = {
+            "event": event,
+            "user_id": user_id,
+            "charger_id": charger_id,
+            "timestamp": timestamp.isoformat() if hasattr(timestamp, 'isoformat') else timestamp,
+        }
+        entry.update(extra)
+        self.events.append(entry)
+
+    def record_arrival(self, user_id, charger_id, arrival_time):
+        """用户到达充电桩并进入队列。"""
+        self._open_sessions[user_id] = {"charger_id": charger_id, "arrival_time": arrival_time, "start_time": None}
+        self._log_event("arrive", user_id, charger_id, arrival_time)
+
+    def record_start(self, user_id, charger_id, start_time, arrival_time=None):
+        """开始充电，返回本次等待时间 (分钟)。"""
+        session = self._open_sessions.get(user_id)
+        if session is None or session.get("charger_id") != charger_id:
+            # 未经过队列直接开始的会话 (例如预约直连)，以传入的到达时间为准
+            session = {"charger_id": charger_id, "arrival_time": arrival_time or start_time}
+            self._open_sessions[user_id] = session
+        session["start_time"] = start_time
+
+        wait_minutes = 0.0
+        arrival = session.get("arrival_time")
+        if arrival is not None and hasattr(arrival, 'timestamp'):
+            wait_minutes = max(0.0, (start_time - arrival).total_seconds() / 60)
+        self.wait_minutes.add(wait_minutes)
+        self._log_event("start", user_id, charger_id, start_time, wait_minutes=round(wait_minutes, 2))
+        return wait_minutes
+
+    def has_started(self, user_id, charger_id):
+        """该用户在该充电桩的会话是否已记录开始事件。"""
+        session = self._open_sessions.get(user_id)
+        return session is not None and session.get("charger_id") == charger_id and session.get("start_time") is not None
+
+    def record_finish(self, user_id, charger_id, end_time):
+        """充电结束，关闭会话。"""
+        session = self._open_sessions.pop(user_id, None)
+        start_time = session.get("start_time") if session else None
+        if start_time is not None:
+            self.charging_minutes.add((end_time - start_time).total_seconds() / 60)
+        self.completed_sessions += 1
+        self._log_event("finish", user_id, charger_id, end_time)
+
+    def observe_queue_lengths(self, queue_lengths):
+        """每个仿真步记录一次各运行中充电桩的队列长度。"""
+        for length in queue_lengths:
+            self.queue_length.add(length)
+
+    def _quantile_dict(self, sketch):
+        result = {f"p{int(round(q * 100))}": sketch.quantile(q) for q in self.quantiles}
+        result["mean"] = sketch.mean()
+        result["max"] = sketch.max_value
+        result["count"] = sketch.count
+        return result
+
+    def summary(self):
+        """返回当前服务水平摘要 (可在任意时刻调用)。"""
+        return {
+            "wait_time_minutes": self._quantile_dict(self.wait_minutes),
+            "charging_time_minutes": self._quantile_dict(self.charging_minutes),
+            "queue_length": self._quantile_dict(self.queue_length),
+            "open_sessions": len(self._open_sessions),
+            "waiting_sessions": sum(1 for s in self._open_sessions.values() if s.get("start_time") is None),
+            "completed_sessions": self.completed_sessions,
+        }
+
+    def get_event_log(self, limit=None):
+        """返回最近的事件记录 (最多 limit 条)。"""
+        if limit is None:
+            return list(self.events)
+        return list(self.events)[-limit:]
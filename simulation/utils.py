@@ -3,6 +3,8 @@ import random
 import logging
 import json
 
+import numpy as np
+
 logger = logging.getLogger(__name__)
 
 # Load configuration
@@ -44,6 +46,28 @@ def calculate_distance(pos1, pos2):
     distance_km = distance_degrees * degrees_to_km_factor
     return distance_km
 
+def positions_to_array(items, key='position'):
+    """把 [{key: {'lat', 'lng'}}] 转换为 (n, 2) 坐标数组，无效位置填 NaN"""
+    coords = np.full((len(items), 2), np.nan)
+    for i, item in enumerate(items):
+        pos = item.get(key) if isinstance(item, dict) else None
+        if not isinstance(pos, dict):
+            continue
+        lat, lng = pos.get('lat'), pos.get('lng')
+        if isinstance(lat, (int, float)) and isinstance(lng, (int, float)):
+            coords[i, 0] = lat
+            coords[i, 1] = lng
+    return coords
+
+def calculate_distance_matrix(coords_a, coords_b):
+    """calculate_distance 的批量版本: 返回 (len(a), len(b)) 距离矩阵 (km)，无效位置为 inf"""
+    a = np.asarray(coords_a, dtype=float).reshape(-1, 2)
+    b = np.asarray(coords_b, dtype=float).reshape(-1, 2)
+    degrees_to_km_factor = config.get('simulation_constants', {}).get('DEGREES_TO_KM_APPROX_FACTOR', 111.0)
+    distance_km = np.hypot(a[:, 0, None] - b[None, :, 0], a[:, 1, None] - b[None, :, 1]) * degrees_to_km_factor
+    distance_km[np.isnan(distance_km)] = np.inf
+    return distance_km
+
 def get_random_location(map_bounds):
     """在定义的地图边界内生成一个随机位置"""
     default_bounds = config.get('environment', {}).get('map_bounds_defaults', {
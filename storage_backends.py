@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+运营商分析存储后端
+
+OperatorDataStorage 的事务性数据 (告警、工单、站点配置、最新状态、财务汇总) 始终保存在 SQLite 中；
+充电会话和实时快照的历史分析 (站点性能、需求模式、扩容建议) 通过 AnalyticsBackend 接口执行:
+
+- SQLiteAnalyticsBackend: 直接查询运营商数据库 (默认，无额外依赖)；
+- DuckDBAnalyticsBackend: 后台写线程提交到 SQLite 后把同一批行追加到嵌入式列式数据库 (DuckDB)，
+  分析查询在列式数据上做向量化扫描，适合跨月的长时间段聚合。需要安装 duckdb，未安装时回退到 SQLite。
+  DuckDB 中记录已同步的 SQLite 行 id (高水位)，每次打开时导入高水位之后的新行，
+  分析库未挂载期间写入的数据 (例如用 sqlite 后端运行过一段时间) 会在下次打开时补齐。
+
+所有后端的查询方法返回列名、类型与 SQLite 查询一致的 DataFrame。
+"""
+
+import logging
+import threading
+from typing import Dict, List, Optional, Tuple
+
+import pandas as pd
+
+try:
+    import duckdb
+    HAS_DUCKDB = True
+except ImportError:
+    HAS_DUCKDB = False
+
+logger = logging.getLogger(__name__)
+
+ANALYTICS_BACKENDS = ("sqlite", "duckdb")
+DEFAULT_DUCKDB_PATH = "operator_analytics.duckdb"
+
+# 与 data_storage 中 INSERT_SESSION_SQL / INSERT_REALTIME_SQL 的参数顺序一致
+SESSION_COLUMNS = ("session_id", "charger_id", "station_id", "user_id", "start_time", "end_time",
+                   "duration_minutes", "energy_kwh", "cost", "revenue", "start_soc", "end_soc",
+                   "price_per_kwh", "service_fee")
+REALTIME_COLUMNS = ("timestamp", "charger_id", "station_id", "status", "power_output",
+                    "queue_length", "current_user", "utilization_rate")
+SYNCED_TABLES = ("charging_sessions", "realtime_data")
+
+
+class AnalyticsBackend:
+    """会话与实时快照历史的分析后端接口；since 为 'YYYY-MM-DD[ HH:MM:SS]' 形式的起始时间"""
+
+    name = "base"
+
+    def append_sessions(self, rows: List[Tuple]):
+        """追加 (或按 session_id 覆盖) 已写入 SQLite 的充电会话，行的列顺序为 SESSION_COLUMNS"""
+
+    def append_snapshots(self, rows: List[Tuple]):
+        """追加已写入 SQLite 的实时快照，行的列顺序为 REALTIME_COLUMNS"""
+
+    def mark_synced(self, table: str, last_id: int):
+        """记录 SQLite 表中 id <= last_id 的行都已追加到分析后端"""
+
+    def demand_counts(self, station_id: str, since: str) -> pd.DataFrame:
+        """按 (日期, 小时) 统计的会话数: date, weekday (0=周日), hour, sessions"""
+        raise NotImplementedError
+
+    def session_stats(self, station_id: str, since: str) -> pd.DataFrame:
+        """站点会话的基础统计 (单行)"""
+        raise NotImplementedError
+
+    def hourly_distribution(self, station_id: str, since: str) -> pd.DataFrame:
+        """按小时的会话数和电量: hour, sessions, energy"""
+        raise NotImplementedError
+
+    def station_load(self, since: str) -> pd.DataFrame:
+        """各站点的负载: station_id, avg_utilization, avg_queue, charger_count, failure_rate (%)"""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class SQLiteAnalyticsBackend(AnalyticsBackend):
+    """直接在运营商 SQLite 数据库上查询"""
+
+    name = "sqlite"
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    def demand_counts(self, station_id, since):
+        with self.storage._db() as conn:
+            return pd.read_sql_query("""
+                SELECT
+                    strftime('%Y-%m-%d', start_time) as date,
+                    strftime('%w', start_time) as weekday, -- 0=Sunday, 1=Monday, ..., 6=Saturday
+                    strftime('%H', start_time) as hour,
+                    COUNT(*) as sessions
+                FROM charging_sessions
+                WHERE station_id = ? AND start_time >= ?
+                GROUP BY date, hour
+            """, conn, params=[station_id, since])
+
+    def session_stats(self, station_id, since):
+        with self.storage._db() as conn:
+            return pd.read_sql_query("""
+                SELECT
+                    COUNT(DISTINCT DATE(start_time)) as operating_days,
+                    COUNT(*) as total_sessions,
+                    SUM(energy_kwh) as total_energy,
+                    SUM(revenue) as total_revenue,
+                    AVG(duration_minutes) as avg_session_duration,
+                    AVG(energy_kwh) as avg_energy_per_session,
+                    AVG(price_per_kwh) as avg_price
+                FROM charging_sessions
+                WHERE station_id = ? AND start_time >= ?
+            """, conn, params=[station_id, since])
+
+    def hourly_distribution(self, station_id, since):
+        with self.storage._db() as conn:
+            return pd.read_sql_query("""
+                SELECT
+                    strftime('%H', start_time) as hour,
+                    COUNT(*) as sessions,
+                    SUM(energy_kwh) as energy
+                FROM charging_sessions
+                WHERE station_id = ? AND start_time >= ?
+                GROUP BY hour
+                ORDER BY hour
+            """, conn, params=[station_id, since])
+
+    def station_load(self, since):
+        with self.storage._db() as conn:
+            # 按层级路由: 已汇总的时间段读小时/15 分钟汇总表，其余读原始数据
+            source_sql, source_params, _ = self.storage._realtime_source(conn, since, resolution_minutes=60)
+            return pd.read_sql_query(f"""
+                SELECT
+                    station_id,
+                    SUM(sum_utilization) * 1.0 / SUM(samples) as avg_utilization,
+                    SUM(sum_queue) * 1.0 / SUM(samples) as avg_queue,
+                    COUNT(DISTINCT charger_id) as charger_count,
+                    SUM(failure_samples) * 100.0 / SUM(samples) as failure_rate
+                FROM ({source_sql})
+                GROUP BY station_id
+            """, conn, params=source_params)
+
+
+class DuckDBAnalyticsBackend(AnalyticsBackend):
+    """
+    嵌入式列式分析库。会话按 session_id 覆盖写入，实时快照只追加 (不受 SQLite 侧保留策略影响，保留完整历史)。
+    DuckDB 连接不是线程安全的，后台写线程的追加与查询共用一把锁。
+    sync_state 表保存每个 SQLite 表已同步的最大 id；SQLite 中按 session_id 原地更新的会话不改变 id，
+    分析库未挂载期间对旧会话的更新不会被补导入。
+    """
+
+    name = "duckdb"
+
+    def __init__(self, path: str = DEFAULT_DUCKDB_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = duckdb.connect(path)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS charging_sessions (
+                session_id VARCHAR PRIMARY KEY,
+                charger_id VARCHAR,
+                station_id VARCHAR,
+                user_id VARCHAR,
+                start_time TIMESTAMP,
+                end_time TIMESTAMP,
+                duration_minutes DOUBLE,
+                energy_kwh DOUBLE,
+                cost DOUBLE,
+                revenue DOUBLE,
+                start_soc DOUBLE,
+                end_soc DOUBLE,
+                price_per_kwh DOUBLE,
+                service_fee DOUBLE
+            )
+        """)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS realtime_data (
+                timestamp TIMESTAMP,
+                charger_id VARCHAR,
+                station_id VARCHAR,
+                status VARCHAR,
+                power_output DOUBLE,
+                queue_length INTEGER,
+                current_user VARCHAR,
+                utilization_rate DOUBLE
+            )
+        """)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS sync_state (
+                table_name VARCHAR PRIMARY KEY,
+                last_id BIGINT
+            )
+        """)
+
+    def is_empty(self) -> bool:
+        with self._lock:
+            return not any(
+                self._conn.execute(f"SELECT EXISTS (SELECT 1 FROM {table})").fetchone()[0]
+                for table in SYNCED_TABLES
+            )
+
+    def high_water_marks(self) -> Dict[str, int]:
+        """各 SQLite 表已同步的最大 id；没有记录的表不出现在结果中"""
+        with self._lock:
+            return dict(self._conn.execute("SELECT table_name, last_id FROM sync_state").fetchall())
+
+    def mark_synced(self, table, last_id):
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO sync_state VALUES (?, ?)", [table, int(last_id)])
+
+    def sync_from_sqlite(self, sqlite_conn, chunk_size: int = 200_000):
+        """
+        从运营商 SQLite 数据库分块导入高水位之后的会话和实时快照。
+        旧版本创建的分析库没有高水位记录: 非空时视为已与 SQLite 同步 (旧版本打开时全量导入并持续追加)
+        """
+        marks = self.high_water_marks()
+        legacy = not marks and not self.is_empty()
+        for table, columns in (("charging_sessions", SESSION_COLUMNS), ("realtime_data", REALTIME_COLUMNS)):
+            if legacy:
+                last_id = sqlite_conn.execute(f"SELECT COALESCE(MAX(id), 0) FROM {table}").fetchone()[0]
+                self.mark_synced(table, last_id)
+                logger.info(f"DuckDB 分析库没有同步记录，{table} 的高水位设为当前最大 id {last_id}")
+                continue
+            last_id = marks.get(table, 0)
+            total = 0
+            query = f"SELECT id, {', '.join(columns)} FROM {table} WHERE id > ? ORDER BY id"
+            for chunk in pd.read_sql_query(query, sqlite_conn, params=[last_id], chunksize=chunk_size):
+                if chunk.empty:
+                    continue
+                self._append_frame(table, chunk.drop(columns="id"), dedupe=table == "charging_sessions")
+                last_id = int(chunk["id"].iloc[-1])
+                self.mark_synced(table, last_id)
+                total += len(chunk)
+            logger.info(f"DuckDB 分析库已导入 {table} {total} 行 (高水位 {last_id})")
+
+    @staticmethod
+    def _to_timestamps(series):
+        # SQLite 中的时间既有 datetime 写入的 'YYYY-MM-DD HH:MM:SS' 也有 isoformat 的 'T' 分隔形式
+        return pd.to_datetime(series, format="ISO8601", errors="coerce")
+
+    def _append_frame(self, table, df, dedupe=False):
+        if df.empty:
+            return
+        df = df.copy()
+        if dedupe:
+            df = df.drop_duplicates("session_id", keep="last")
+        for column in ("start_time", "end_time", "timestamp"):
+            if column in df.columns:
+                df[column] = self._to_timestamps(df[column])
+        columns = ", ".join(df.columns)
+        verb = "INSERT OR REPLACE INTO" if dedupe else "INSERT INTO"
+        with self._lock:
+            self._conn.register("_append_batch", df)
+            try:
+                self._conn.execute(f"{verb} {table} ({columns}) SELECT {columns} FROM _append_batch")
+            finally:
+                self._conn.unregister("_append_batch")
+
+    def append_sessions(self, rows):
+        self._append_frame("charging_sessions", pd.DataFrame(rows, columns=SESSION_COLUMNS), dedupe=True)
+
+    def append_snapshots(self, rows):
+        self._append_frame("realtime_data", pd.DataFrame(rows, columns=REALTIME_COLUMNS))
+
+    def _query(self, sql, params):
+        with self._lock:
+            return self._conn.execute(sql, params).df()
+
+    def demand_counts(self, station_id, since):
+        return self._query("""
+            SELECT
+                strftime(start_time, '%Y-%m-%d') as date,
+                strftime(start_time, '%w') as weekday,
+                strftime(start_time, '%H') as hour,
+                COUNT(*) as sessions
+            FROM charging_sessions
+            WHERE station_id = ? AND start_time >= CAST(? AS TIMESTAMP)
+            GROUP BY ALL
+        """, [station_id, since])
+
+    def session_stats(self, station_id, since):
+        return self._query("""
+            SELECT
+                COUNT(DISTINCT CAST(start_time AS DATE)) as operating_days,
+                COUNT(*) as total_sessions,
+                SUM(energy_kwh) as total_energy,
+                SUM(revenue) as total_revenue,
+                AVG(duration_minutes) as avg_session_duration,
+                AVG(energy_kwh) as avg_energy_per_session,
+                AVG(price_per_kwh) as avg_price
+            FROM charging_sessions
+            WHERE station_id = ? AND start_time >= CAST(? AS TIMESTAMP)
+        """, [station_id, since])
+
+    def hourly_distribution(self, station_id, since):
+        return self._query("""
+            SELECT
+                strftime(start_time, '%H') as hour,
+                COUNT(*) as sessions,
+                SUM(energy_kwh) as energy
+            FROM charging_sessions
+            WHERE station_id = ? AND start_time >= CAST(? AS TIMESTAMP)
+            GROUP BY hour
+            ORDER BY hour
+        """, [station_id, since])
+
+    def station_load(self, since):
+        return self._query("""
+            SELECT
+                station_id,
+                SUM(utilization_rate) * 1.0 / COUNT(*) as avg_utilization,
+                SUM(queue_length) * 1.0 / COUNT(*) as avg_queue,
+                COUNT(DISTINCT charger_id) as charger_count,
+                SUM(CASE WHEN status = 'failure' THEN 1 ELSE 0 END) * 100.0 / COUNT(*) as failure_rate
+            FROM realtime_data
+            WHERE timestamp >= CAST(? AS TIMESTAMP)
+            GROUP BY station_id
+        """, [since])
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+def create_analytics_backend(name: str, storage, path: Optional[str] = None) -> AnalyticsBackend:
+    """按名称创建分析后端；duckdb 未安装或打开失败时回退到 SQLite"""
+    if name not in ANALYTICS_BACKENDS:
+        logger.warning(f"未知的分析后端 '{name}'，使用 sqlite")
+    elif name == "duckdb":
+        if not HAS_DUCKDB:
+            logger.warning("未安装 duckdb，分析查询回退到 SQLite")
+        else:
+            try:
+                backend = DuckDBAnalyticsBackend(path or DEFAULT_DUCKDB_PATH)
+                with storage._db() as conn:
+                    backend.sync_from_sqlite(conn)
+                return backend
+            except Exception as e:
+                logger.error(f"打开 DuckDB 分析库失败，分析查询回退到 SQLite: {e}")
+    return SQLiteAnalyticsBackend(storage)
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+存储查询执行器 - 在线程池上执行运营商数据查询，通过 Qt 信号把结果送回 GUI 线程
+
+面板按 "通道" (channel，例如 "financial_summary") 提交查询:
+- 同一通道提交新查询时，尚未开始的旧查询被取消，已在执行的旧查询结果到达后被丢弃 (筛选条件改变时不会显示过期结果)；
+- 结果按 (通道, 参数) 缓存 ttl_s 秒 (LRU，最多 max_entries 条)，相同参数的重复查询直接返回缓存；
+  失败和空结果 (None、空 DataFrame/列表/字典，存储层出错时也返回空结果) 不缓存，写入新数据后由面板调用 invalidate；
+  invalidate 之前提交、之后才完成的查询结果照常回调，但不写入缓存 (查询可能读到了提交前的数据)；
+- 回调 (on_result / on_error) 总是在 GUI 线程上调用，可以直接更新控件。
+"""
+
+import logging
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Optional
+
+from PyQt6.QtCore import QObject, QTimer, pyqtSignal
+
+logger = logging.getLogger(__name__)
+
+
+class StorageQueryExecutor(QObject):
+    """线程池 + future，完成后经由跨线程信号 (排队连接) 回到 GUI 线程"""
+
+    resultReady = pyqtSignal(str, object)   # channel, result
+    queryFailed = pyqtSignal(str, str)      # channel, error message
+    _finished = pyqtSignal(str, int, object, object, object)  # channel, generation, key, result, error
+
+    def __init__(self, max_workers: int = 2, ttl_s: float = 30.0, max_entries: int = 64, parent=None):
+        super().__init__(parent)
+        self.ttl_s = ttl_s
+        self.max_entries = max(1, max_entries)
+        self._pool = ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix="storage-query")
+        self._cache = OrderedDict()   # (channel, args, kwargs) -> (完成时间, 结果)
+        self._pending = {}            # channel -> (generation, key, future, on_result, on_error)
+        self._generation = 0
+        self._invalidated = {}        # channel (None 表示全部) -> invalidate 时的 generation
+        self._finished.connect(self._onFinished)
+
+    def submit(self, channel: str, fn: Callable, *args, on_result: Optional[Callable] = None,
+               on_error: Optional[Callable] = None, use_cache: bool = True, **kwargs):
+        """异步执行 fn(*args, **kwargs)；同一通道上之前未完成的查询被取代"""
+        key = (channel, args, tuple(sorted(kwargs.items())))
+        pending = self._pending.get(channel)
+        if pending is not None and pending[1] == key:
+            # 相同的查询正在执行，只更新回调
+            self._pending[channel] = pending[:3] + (on_result, on_error)
+            return
+        self.cancel(channel)
+
+        self._generation += 1
+        generation = self._generation
+        if use_cache:
+            cached = self._cache.get(key)
+            if cached is not None and time.monotonic() - cached[0] <= self.ttl_s:
+                self._cache.move_to_end(key)
+                future = Future()
+                future.set_result(cached[1])
+                self._pending[channel] = (generation, key, future, on_result, on_error)
+                # 保持异步语义: 回调总是在下一轮事件循环中调用，期间仍可被新的查询取代
+                QTimer.singleShot(0, lambda: self._onFinished(channel, generation, key, cached[1], None, from_cache=True))
+                return
+
+        future = self._pool.submit(fn, *args, **kwargs)
+        self._pending[channel] = (generation, key, future, on_result, on_error)
+        future.add_done_callback(lambda f: self._emitFinished(channel, generation, key, f))
+
+    def cancel(self, channel: str):
+        """取消通道上未完成的查询 (已开始执行的查询无法中断，其结果会被丢弃)"""
+        pending = self._pending.pop(channel, None)
+        if pending is not None:
+            pending[2].cancel()
+
+    def invalidate(self, channel: Optional[str] = None):
+        """清除某个通道 (或全部) 的缓存结果，例如写入新数据之后"""
+        self._invalidated[channel] = self._generation
+        if channel is None:
+            self._cache.clear()
+            return
+        for key in [k for k in self._cache if k[0] == channel]:
+            del self._cache[key]
+
+    def isBusy(self, channel: str) -> bool:
+        return channel in self._pending
+
+    def shutdown(self):
+        for channel in list(self._pending):
+            self.cancel(channel)
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+    def _emitFinished(self, channel, generation, key, future):
+        # 在线程池线程上调用；信号以排队连接送到 GUI 线程
+        if future.cancelled():
+            return
+        error = future.exception()
+        self._finished.emit(channel, generation, key, None if error else future.result(), error)
+
+    @staticmethod
+    def _isCacheable(result) -> bool:
+        if result is None:
+            return False
+        if hasattr(result, "empty"):
+            return not result.empty
+        if isinstance(result, (list, tuple, dict, set)):
+            return len(result) > 0
+        return True
+
+    def _onFinished(self, channel, generation, key, result, error, from_cache=False):
+        pending = self._pending.get(channel)
+        if pending is None or pending[0] != generation:
+            logger.debug(f"丢弃已被取代的查询结果: {channel}")
+            return
+        del self._pending[channel]
+        _, _, _, on_result, on_error = pending
+        if error is not None:
+            logger.error(f"存储查询失败 ({channel}): {error}")
+            self.queryFailed.emit(channel, str(error))
+            if on_error is not None:
+                on_error(error)
+            return
+        stale = generation <= max(self._invalidated.get(channel, 0), self._invalidated.get(None, 0))
+        if not from_cache and not stale and self._isCacheable(result):
+            self._cache[key] = (time.monotonic(), result)
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+        self.resultReady.emit(channel, result)
+        if on_result is not None:
+            on_result(result)
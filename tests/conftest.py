@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+"""测试公共设置: 把项目根目录加入 sys.path，并提供 config.json 的独立副本"""
+
+import copy
+import json
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+with open(os.path.join(ROOT, "config.json"), encoding="utf-8") as f:
+    _CONFIG = json.load(f)
+
+
+@pytest.fixture
+def config():
+    """每个测试一份可修改的配置副本"""
+    return copy.deepcopy(_CONFIG)
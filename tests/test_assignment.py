@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pytest
+
+from algorithms import assignment, rule_based
+from algorithms.assignment import solve_assignment, solve_auction, unassigned_with_capacity
+
+
+def _prefer_first(rows, col, slot):
+    # 所有用户都更想去 0 号充电桩
+    return np.full(len(rows), 2.0 if col == 0 else 1.0)
+
+
+def _score_table(table):
+    # table[row][col] 为与排队位无关的得分
+    table = np.asarray(table, dtype=float)
+    return lambda rows, col, slot: table[rows, col]
+
+
+@pytest.mark.skipif(not assignment.HAS_SCIPY, reason="scipy not installed")
+def test_min_cost_beats_greedy_and_falls_back_to_it():
+    # 用户 0 略偏好 0 号桩，但用户 1 只能去 0 号桩: 贪心只能分配一人，最小费用匹配两人都分到
+    candidates = [np.array([0, 1]), np.array([0])]
+    capacity = np.array([1, 1])
+    score = _score_table([[1.0, 0.9], [1.0, -np.inf]])
+
+    matched, stats = solve_assignment(candidates, capacity, score)
+    assert matched == {0: 1, 1: 0}
+    assert stats["optimal_users"] == 2 and stats["greedy_users"] == 0
+
+    # 分量超过稠密矩阵上限时按行顺序贪心
+    matched, stats = solve_assignment(candidates, capacity, score, {"max_dense_cells": 1})
+    assert matched == {0: 0}
+    assert stats["optimal_users"] == 0 and stats["greedy_users"] == 2
+
+    matched, stats = solve_assignment(candidates, capacity, score, {"time_budget_ms": -1})
+    assert matched == {0: 0}
+    assert stats["greedy_users"] == 2
+
+
+@pytest.mark.skipif(not assignment.HAS_SCIPY, reason="scipy not installed")
+def test_min_cost_respects_capacity_slots_and_components():
+    # 两个互不相连的分量: 用户 0-2 竞争 0 号桩 (2 个排队位)，用户 3-4 竞争 1、2 号桩
+    candidates = [np.array([0]), np.array([0]), np.array([0]), np.array([1, 2]), np.array([1, 2])]
+    capacity = np.array([2, 1, 0])
+    slot_penalty = np.array([0.0, 0.5])
+
+    def score(rows, col, slot):
+        return np.asarray(rows, dtype=float) * 0.1 - slot_penalty[slot]
+
+    matched, stats = solve_assignment(candidates, capacity, score)
+    assert stats["components"] == 2
+    # 得分高的用户占满 0 号桩的两个排队位；2 号桩没有容量
+    assert matched == {1: 0, 2: 0, 4: 1}
+    assert unassigned_with_capacity(candidates, capacity, matched) == []
+
+
+def test_auction_stopped_early_leaves_pending_users():
+    candidates = [np.array([0, 1])] * 3
+    capacity = np.array([1, 1])
+
+    matched, stats = solve_auction(candidates, capacity, _prefer_first, {"max_auction_rounds": 1})
+    assert matched == {0: 0}
+    assert stats["stopped_early"]
+    assert unassigned_with_capacity(candidates, capacity, matched) == [1, 2]
+
+    matched, stats = solve_auction(candidates, capacity, _prefer_first)
+    assert matched == {0: 0, 1: 1}
+    assert not stats["stopped_early"]
+    assert unassigned_with_capacity(candidates, capacity, matched) == []
+
+
+def test_rule_based_auction_reports_deferred_users(config):
+    rule_config = config["algorithms"]["rule_based"]
+    rule_config["assignment_mode"] = "auction"
+    rule_config["assignment_params"] = {"max_auction_rounds": 1}
+    rule_config["max_queue"] = {"peak": 1, "valley": 1, "shoulder": 1}
+    chargers = [
+        {"charger_id": f"c{i}", "status": "available", "type": "fast", "max_power": 60, "queue": [],
+         "position": {"lat": 30.5 + i * 0.01, "lng": 114.0}}
+        for i in range(2)
+    ]
+    users = [
+        {"user_id": f"u{i}", "soc": 10, "status": "idle", "needs_charge_decision": True,
+         "current_position": {"lat": 30.5, "lng": 114.0}}
+        for i in range(3)
+    ]
+    state = {"timestamp": "2026-10-19T10:00:00", "chargers": chargers, "users": users, "grid_status": {}}
+
+    decisions, metadata = rule_based.schedule(state, config)
+
+    assert len(decisions) == 1
+    assert metadata["assignment_stats"]["stopped_early"]
+    assert sorted(metadata["deferred_users"]) == sorted(set(["u0", "u1", "u2"]) - set(decisions))
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+import copy
+import os
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+from algorithms.coordinated_mas import create_algorithm
+from simulation.environment import ChargingEnvironment
+
+
+def _user(user_id, soc=10):
+    return {"user_id": user_id, "soc": soc, "status": "idle", "needs_charge_decision": True,
+            "current_position": {"lat": 30.5, "lng": 114.0}}
+
+
+def test_no_chargers_returns_empty_decisions(config):
+    mas = create_algorithm(config)
+    state = {"chargers": [], "users": [_user("u1")], "timestamp": "2026-10-19T10:00:00", "grid_status": {}}
+
+    decisions, metadata = mas.decide(state, {"grid_preferences": {"max_ev_fleet_load_mw": 1.0}})
+
+    assert decisions == {}
+    assert "power_setpoints_kw" not in metadata
+
+
+def test_parallel_agents_match_sequential(config):
+    config["environment"]["user_count"] = 300
+    parallel_config = copy.deepcopy(config)
+    parallel_config["algorithms"]["coordinated_mas"]["parallel_agents"] = True
+    env = ChargingEnvironment(config)
+    sequential, parallel = create_algorithm(config), create_algorithm(parallel_config)
+    try:
+        for _ in range(3):
+            state = env.get_current_state()
+            for user in state["users"][::4]:
+                user["needs_charge_decision"] = True
+            decisions, metadata = sequential.decide(state, {})
+            assert parallel.decide(state, {})[0] == decisions
+            assert set(metadata["agent_timings_ms"]) == {"user", "profit", "grid"}
+            env.step(decisions)
+    finally:
+        parallel.shutdown()
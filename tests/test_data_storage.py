@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+import sqlite3
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import data_storage
+from data_storage import OperatorDataStorage
+from storage_backends import DuckDBAnalyticsBackend, SQLiteAnalyticsBackend
+
+NOW = datetime(2026, 10, 19, 10, 0)
+
+
+def _snapshot(storage, minutes, chargers=3):
+    rows = [{"charger_id": f"c{j}", "location": "station_0", "status": "occupied", "queue": [],
+             "utilization_rate": 0.5, "current_power": 30.0} for j in range(chargers)]
+    storage.save_realtime_snapshot(rows, NOW + timedelta(minutes=minutes))
+
+
+def _session(session_id, minutes, energy=20.0):
+    start = NOW + timedelta(minutes=minutes)
+    return {"session_id": session_id, "charger_id": "c0", "station_id": "station_0", "user_id": "u0",
+            "start_time": start, "end_time": start + timedelta(minutes=30), "duration_minutes": 30,
+            "energy_kwh": energy, "cost": energy * 0.5, "revenue": energy, "start_soc": 20, "end_soc": 60,
+            "price_per_kwh": 1.0, "service_fee": 0.0}
+
+
+def _count(storage, table):
+    with storage._db() as conn:
+        return conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+
+
+def _duckdb_count(storage, table):
+    return int(storage.analytics._query(f"SELECT COUNT(*) AS n FROM {table}", [])["n"][0])
+
+
+def test_duckdb_imports_rows_written_while_detached(tmp_path):
+    pytest.importorskip("duckdb")
+    db, duck = str(tmp_path / "operator.db"), str(tmp_path / "analytics.duckdb")
+
+    storage = OperatorDataStorage(db, async_writes=False, analytics_backend="duckdb", analytics_path=duck)
+    _snapshot(storage, 0)
+    storage.save_charging_session(_session("s0", 0))
+    storage.close()
+
+    # 用 sqlite 后端运行一段时间，DuckDB 分析库没有收到这些行
+    storage = OperatorDataStorage(db, async_writes=False)
+    _snapshot(storage, 5)
+    storage.save_charging_session(_session("s1", 5))
+    storage.close()
+
+    storage = OperatorDataStorage(db, async_writes=False, analytics_backend="duckdb", analytics_path=duck)
+    assert storage.analytics.name == "duckdb"
+    assert _duckdb_count(storage, "realtime_data") == 6
+    assert _duckdb_count(storage, "charging_sessions") == 2
+    _snapshot(storage, 10)
+    storage.close()
+
+    # 没有遗漏时重新打开不重复导入
+    storage = OperatorDataStorage(db, async_writes=False, analytics_backend="duckdb", analytics_path=duck)
+    assert _duckdb_count(storage, "realtime_data") == 9
+    with storage._db() as conn:
+        max_id = conn.execute("SELECT MAX(id) FROM realtime_data").fetchone()[0]
+    assert storage.analytics.high_water_marks()["realtime_data"] == max_id
+    storage.close()
+
+
+def test_commit_listener_runs_after_the_batch_is_visible(tmp_path):
+    storage = OperatorDataStorage(str(tmp_path / "operator.db"))
+    seen = []
+
+    def on_commit(tables):
+        # 在写线程上调用: 此时其他连接已能读到这一批
+        with sqlite3.connect(storage.db_path) as conn:
+            seen.append((tables, conn.execute("SELECT COUNT(*) FROM realtime_data").fetchone()[0]))
+
+    storage.add_commit_listener(on_commit)
+    _snapshot(storage, 0)
+    storage.flush()
+    storage.save_charging_session(_session("s0", 0))
+    storage.flush()
+    storage.remove_commit_listener(on_commit)
+    _snapshot(storage, 5)
+    storage.close()
+
+    assert seen == [({"realtime_data"}, 3), ({"charging_sessions"}, 3)]
+
+
+def test_close_writes_queued_rows_in_order(tmp_path):
+    db = str(tmp_path / "operator.db")
+    storage = OperatorDataStorage(db, batch_size=7, retention={"compaction_interval_s": None})
+    for minute in range(20):
+        _snapshot(storage, minute)
+    storage.save_charging_sessions([_session("s0", 0, energy=10.0)])
+    storage.save_charging_sessions([_session("s0", 0, energy=25.0)])
+    storage.close()
+
+    storage = OperatorDataStorage(db, async_writes=False)
+    assert _count(storage, "realtime_data") == 60
+    with storage._db() as conn:
+        # 同一会话的两次写入按入队顺序提交，后写的覆盖先写的
+        assert conn.execute("SELECT energy_kwh FROM charging_sessions").fetchall() == [(25.0,)]
+        latest = conn.execute("SELECT MAX(timestamp) FROM charger_latest_status").fetchone()[0]
+    assert latest.startswith("2026-10-19 10:19")
+    storage.close()
+
+
+def test_failing_rows_are_dropped_without_losing_the_batch(tmp_path):
+    storage = OperatorDataStorage(str(tmp_path / "operator.db"), retention={"compaction_interval_s": None})
+    storage.save_charging_sessions([_session("s0", 0), dict(_session("bad", 5), session_id=None), _session("s1", 10)])
+    _snapshot(storage, 0)
+    storage.flush()
+    with storage._db() as conn:
+        assert [r[0] for r in conn.execute("SELECT session_id FROM charging_sessions ORDER BY id")] == ["s0", "s1"]
+    assert _count(storage, "realtime_data") == 3
+    storage.close()
+
+
+def test_migrations_upgrade_an_old_schema(tmp_path, monkeypatch):
+    db = str(tmp_path / "operator.db")
+    # 迁移 3 时的数据库: 降采样进度按时间戳记录在 rollup_state 中
+    monkeypatch.setattr(data_storage, "MIGRATIONS", data_storage.MIGRATIONS[:3])
+    storage = OperatorDataStorage(db, async_writes=False)
+    assert storage.schema_version() == 3
+    for minute in (0, 30, 60, 90):
+        _snapshot(storage, minute)
+    storage.save_charging_sessions([_session("s0", 0), _session("s1", 70, energy=5.0)])
+    with storage._db() as conn:
+        conn.execute("INSERT INTO rollup_state (tier, rolled_until) VALUES ('hourly', '2026-10-19 11:00:00')")
+    storage.close()
+
+    monkeypatch.undo()
+    storage = OperatorDataStorage(db, async_writes=False)
+    assert storage.schema_version() == data_storage.MIGRATIONS[-1][0]
+    with storage._db() as conn:
+        # 早于旧水位的 6 行视为已汇总
+        assert conn.execute("SELECT rolled_id FROM rollup_progress WHERE tier = 'hourly'").fetchone()[0] == 6
+        assert conn.execute("SELECT name FROM sqlite_master WHERE name = 'rollup_state'").fetchone() is None
+    summary = storage.get_financial_summary("2026-10-19", "2026-10-19")
+    assert list(summary.sessions_count) == [1, 1]
+    assert list(summary.total_energy) == [20.0, 5.0]
+    storage.close()
+
+
+def test_compaction_is_idempotent_and_merges_late_rows(tmp_path):
+    storage = OperatorDataStorage(str(tmp_path / "operator.db"), async_writes=False,
+                                  retention={"raw_days": None, "compaction_interval_s": None})
+
+    def rollup(table):
+        with storage._db() as conn:
+            return conn.execute(f"SELECT bucket_start, charger_id, samples FROM {table} ORDER BY 1, 2").fetchall()
+
+    for minute in range(0, 120, 10):
+        _snapshot(storage, minute)
+    storage.compact_realtime_data()
+    hourly, quarter = rollup("realtime_rollup_hourly"), rollup("realtime_rollup_15min")
+    assert sum(r[2] for r in hourly) == sum(r[2] for r in quarter) == 36
+
+    assert storage.compact_realtime_data()["rolled_hourly"] == 0
+    assert rollup("realtime_rollup_hourly") == hourly and rollup("realtime_rollup_15min") == quarter
+
+    # 仿真时间回退: 新写入的旧时间戳数据合并进已有的时间桶
+    for minute in (5, 15):
+        _snapshot(storage, minute)
+    storage.compact_realtime_data()
+    hourly = rollup("realtime_rollup_hourly")
+    assert hourly[0] == ("2026-10-19 10:00:00", "c0", 8)
+    assert sum(r[2] for r in hourly) == sum(r[2] for r in rollup("realtime_rollup_15min")) == 42
+    storage.close()
+
+
+def test_resaving_a_session_updates_the_financial_rollup(tmp_path):
+    storage = OperatorDataStorage(str(tmp_path / "operator.db"), async_writes=False)
+    storage.save_charging_session(_session("s0", 0, energy=10.0))
+    storage.save_charging_session(_session("s1", 10, energy=4.0))
+    storage.save_charging_session(_session("s0", 0, energy=30.0))
+    summary = storage.get_financial_summary("2026-10-19", "2026-10-19")
+    assert list(summary.sessions_count) == [2]
+    assert list(summary.total_energy) == [34.0]
+
+    # 会话改到另一个小时: 旧小时的汇总行被清除
+    storage.save_charging_session(_session("s0", 120, energy=30.0))
+    storage.save_charging_session(_session("s1", 120, energy=4.0))
+    summary = storage.get_financial_summary("2026-10-19", "2026-10-19")
+    assert list(summary.datetime_hour) == ["2026-10-19 12:00:00"]
+    assert list(summary.sessions_count) == [2]
+    storage.close()
+
+
+def test_sqlite_and_duckdb_backends_return_the_same_frames(tmp_path):
+    pytest.importorskip("duckdb")
+    storage = OperatorDataStorage(str(tmp_path / "operator.db"), async_writes=False,
+                                  retention={"raw_days": None, "compaction_interval_s": None})
+    rng = np.random.default_rng(0)
+    sessions = []
+    for i in range(200):
+        session = _session(f"s{i}", int(rng.integers(0, 60 * 24 * 10)), energy=float(rng.uniform(5, 40)))
+        session.update(station_id=f"station_{i % 3}", price_per_kwh=[0.8, 1.2, None][i % 3])
+        sessions.append(session)
+    storage.save_charging_sessions(sessions)
+    for step in range(300):
+        statuses = rng.choice(["available", "occupied", "failure"], size=6)
+        storage.save_realtime_snapshot([
+            {"charger_id": f"c{j}", "location": f"station_{j % 3}", "status": statuses[j],
+             "queue": [0] * int(rng.integers(0, 4)), "utilization_rate": float(rng.random()), "current_power": 30.0}
+            for j in range(6)
+        ], NOW + timedelta(minutes=20 * step))
+    # 一部分快照已汇总: SQLite 后端的负载查询走 汇总表 + 未汇总原始数据
+    storage.compact_realtime_data()
+
+    sqlite_backend = SQLiteAnalyticsBackend(storage)
+    duck = DuckDBAnalyticsBackend(str(tmp_path / "analytics.duckdb"))
+    with storage._db() as conn:
+        duck.sync_from_sqlite(conn)
+    since = "2026-10-21"
+
+    def same(left, right, keys):
+        left = left.sort_values(keys).reset_index(drop=True)
+        right = right.sort_values(keys).reset_index(drop=True)
+        pd.testing.assert_frame_equal(left, right, check_dtype=False)
+
+    same(sqlite_backend.demand_counts("station_1", since), duck.demand_counts("station_1", since), ["date", "hour"])
+    same(sqlite_backend.session_stats("station_1", since), duck.session_stats("station_1", since), ["total_sessions"])
+    same(sqlite_backend.hourly_distribution("station_1", since), duck.hourly_distribution("station_1", since), ["hour"])
+    same(sqlite_backend.station_load(since), duck.station_load(since), ["station_id"])
+    duck.close()
+    storage.close()
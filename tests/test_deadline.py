@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+import time
+
+from algorithms.deadline import Deadline, anytime_order
+
+
+def test_unlimited_deadline_never_stops():
+    deadline = Deadline(None)
+    assert not deadline.limited
+    assert deadline.remaining_ms() is None
+    assert not deadline.should_stop(10 ** 6)
+    assert not Deadline(0).limited
+
+
+def test_expired_deadline_still_processes_min_batch():
+    deadline = Deadline(1, min_batch=3)
+    time.sleep(0.005)
+    assert deadline.expired()
+    assert deadline.remaining_ms() == 0.0
+    assert not deadline.should_stop(2)
+    assert deadline.should_stop(3)
+    # 一旦耗尽保持耗尽
+    deadline.expires_at += 3600
+    assert deadline.expired()
+
+
+def test_anytime_order_puts_deferred_then_flagged_then_low_soc_first():
+    users = [
+        {"user_id": "a", "soc": 10},
+        {"user_id": "b", "soc": 50, "needs_charge_decision": True},
+        {"user_id": "c", "soc": 80},
+        {"user_id": "d", "soc": 5},
+        {"user_id": "e", "soc": 10},
+    ]
+    order = [u["user_id"] for u in anytime_order(users, deferred_ids={"c"})]
+    assert order == ["c", "b", "d", "a", "e"]
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+from simulation.decision_cache import DecisionCache
+
+
+def _state(users, queues=None, failed=()):
+    queues = queues or {}
+    chargers = [{"charger_id": cid, "status": "failure" if cid in failed else "available",
+                 "queue": queues.get(cid, []), "queue_capacity": 2} for cid in ("c0", "c1")]
+    return {"timestamp": "2026-10-19T10:00:00", "chargers": chargers, "users": users}
+
+
+def _user(user_id, soc=30, lat=30.5, status="idle"):
+    return {"user_id": user_id, "soc": soc, "status": status, "current_position": {"lat": lat, "lng": 114.0}}
+
+
+def test_hit_after_store_and_miss_when_signature_changes():
+    cache = DecisionCache({"enabled": True})
+    state = _state([_user("u0"), _user("u1"), _user("u2", status="charging")])
+    key = cache.context_key(state, "rule_based")
+
+    reused, misses, miss_keys = cache.lookup(state, key)
+    assert reused == {} and [u["user_id"] for u in misses] == ["u0", "u1", "u2"]
+    # 正在充电的用户原样交给算法，不计入命中率
+    assert set(miss_keys) == {"u0", "u1"}
+    cache.store(miss_keys, {"u0": "c0"})
+
+    reused, misses, _ = cache.lookup(state, key)
+    assert reused == {"u0": "c0"}
+    # u1 上次没有分配 (None)，命中后直接跳过
+    assert [u["user_id"] for u in misses] == ["u2"]
+    assert cache.stats()["hits"] == 2 and cache.stats()["misses"] == 2
+
+    # SOC 跨档、位置跨网格都使签名失效
+    for changed in (_user("u0", soc=10), _user("u0", lat=30.6)):
+        reused, misses, _ = cache.lookup(_state([changed]), key)
+        assert reused == {} and [u["user_id"] for u in misses] == ["u0"]
+
+
+def test_invalidated_by_charger_availability_and_lru():
+    cache = DecisionCache({"enabled": True, "max_entries": 2})
+    state = _state([_user("u0"), _user("u1")])
+    key = cache.context_key(state, "rule_based")
+    _, _, miss_keys = cache.lookup(state, key)
+    cache.store(miss_keys, {"u0": "c0", "u1": "c0"}, skip_user_ids={"u1"})
+    assert cache.stats()["entries"] == 1
+
+    # 充电桩故障或排队已满改变上下文键
+    assert cache.context_key(_state([], failed={"c0"}), "rule_based") != key
+    assert cache.context_key(_state([], queues={"c1": ["x", "y"]}), "rule_based") != key
+    assert cache.context_key(state, "coordinated_mas") != key
+
+    # 同一上下文下，复用的分配占用排队位: 排队满时交回给算法
+    state = _state([_user("u0")], queues={"c0": ["x"]})
+    reused, _, _ = cache.lookup(state, key)
+    assert reused == {"u0": "c0"}
+    view = DecisionCache.algorithm_view(state, [], reused)
+    assert view["chargers"][0]["queue"] == ["x", "u0"]
+    reused, misses, _ = cache.lookup(_state([_user("u0")], queues={"c0": ["x", "y"]}), key)
+    assert reused == {} and [u["user_id"] for u in misses] == ["u0"]
+
+    for user_id in ("u1", "u2"):
+        _, _, miss_keys = cache.lookup(_state([_user(user_id)]), key)
+        cache.store(miss_keys, {user_id: "c1"})
+    assert cache.stats()["entries"] == 2 and cache.stats()["evictions"] == 1
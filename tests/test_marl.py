@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+import pickle
+
+import numpy as np
+import pytest
+
+from algorithms import marl
+
+
+def _random_state(seed, chargers=200, users=1500):
+    rng = np.random.default_rng(seed)
+
+    def position():
+        return {"lat": 30.5 + rng.uniform(0, 0.2), "lng": 114.0 + rng.uniform(0, 0.2)}
+
+    return {
+        "users": [{"user_id": f"u{i}", "soc": float(rng.uniform(5, 60)), "status": "idle", "current_position": position()}
+                  for i in range(users)],
+        "chargers": [{"charger_id": f"c{i}", "status": "available", "position": position()} for i in range(chargers)],
+    }
+
+
+@pytest.mark.skipif(not marl.HAS_SCIPY, reason="scipy not installed")
+@pytest.mark.parametrize("max_dist_sq", [0.01 ** 2, 0.02 ** 2, 0.15 ** 2])
+def test_action_maps_kdtree_matches_dense(monkeypatch, max_dist_sq):
+    state = _random_state(7)
+    marl_config = {"marl_candidate_max_dist_sq": max_dist_sq}
+    kdtree_maps, seeking = marl.build_action_maps(state, marl_config)
+    monkeypatch.setattr(marl, "HAS_SCIPY", False)
+    dense_maps, _ = marl.build_action_maps(state, marl_config)
+
+    assert seeking > 0
+    assert kdtree_maps == dense_maps
+    assert any(len(m["map"]) > 1 for m in kdtree_maps.values())
+
+
+def test_state_encoder_round_trip():
+    encoder = marl.StateEncoder({"max_queue_state_representation": 4, "hour_discretization_factor": 3})
+    codes = np.arange(encoder.num_states)
+    vectors = encoder.decode(codes)
+    np.testing.assert_array_equal(encoder.encode(vectors), codes)
+    assert (vectors.max(axis=0) == encoder.radices - 1).all()
+    # 越界特征截断到合法范围
+    assert encoder.encode([[9, 99, -1, 0, 0, 0]])[0] == encoder.encode([[2, 4, 0, 0, 0, 0]])[0]
+    legacy_key = str(sorted({"status": 1, "queue": 2, "hour_discrete": 5, "grid_load_cat": 1,
+                             "renew_cat": 2, "nearby_demand_cat": 0}.items()))
+    assert encoder.encode_state_key(legacy_key) == encoder.encode([[1, 2, 5, 1, 2, 0]])[0]
+
+
+def _system(q_table_path, num_chargers=2):
+    return marl.MARLSystem(num_chargers, 4, 0.1, 0.9, 0.0, q_table_path, {"training_params": {"seed": 0}})
+
+
+def test_q_array_save_load_round_trip(tmp_path):
+    path = str(tmp_path / "q" / "marl_q_tables.pkl")
+    system = _system(path)
+    rows = system.register_agents(["charger_7", "charger_3", "charger_9"])
+    system.q_values[rows] = np.random.default_rng(0).normal(size=(3,) + system.q_values.shape[1:])
+    system.save_q_tables()
+
+    loaded = _system(path, num_chargers=1)
+    assert loaded.agent_ids == ["charger_7", "charger_3", "charger_9"]
+    np.testing.assert_array_equal(loaded.q_values[:3], system.q_values[:3])
+
+
+def test_legacy_pickle_is_converted(tmp_path):
+    path = str(tmp_path / "marl_q_tables.pkl")
+    state_key = str(sorted({"status": 0, "queue": 1, "hour_discrete": 2, "grid_load_cat": 0,
+                            "renew_cat": 1, "nearby_demand_cat": 2}.items()))
+    with open(path, "wb") as f:
+        pickle.dump({"charger_1": {state_key: [0.1, 0.2, 0.3, 0.4], "bad key": [1, 2, 3, 4]}}, f)
+
+    system = _system(path)
+    code = system.state_encoder.encode_state_key(state_key)
+    np.testing.assert_allclose(system.q_values[system.agent_index["charger_1"], code], [0.1, 0.2, 0.3, 0.4])
+    assert np.count_nonzero(system.q_values) == 4
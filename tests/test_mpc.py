@@ -0,0 +1,84 @@
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytest
+
+from algorithms.mpc import MPCScheduler, _water_fill
+from simulation.charger_model import _charging_kernel, soc_taper_factor
+
+NOW = datetime(2025, 1, 6, 10, 0)
+
+
+def _session_state(socs):
+    chargers, users = [], []
+    for i, soc in enumerate(socs):
+        chargers.append({
+            "charger_id": f"c{i}", "status": "occupied", "current_user": f"u{i}", "type": "normal",
+            "max_power": 60, "location": "station_0", "charging_start_time": NOW - timedelta(minutes=15),
+        })
+        users.append({
+            "user_id": f"u{i}", "soc": soc, "target_soc": 95, "battery_capacity": 200,
+            "max_charging_power": 60, "charging_efficiency": 0.9,
+        })
+    return {"timestamp": NOW.isoformat(), "chargers": chargers, "users": users, "grid_status": {}}
+
+
+@pytest.mark.parametrize("socs, fleet_limit_mw", [([60], 0.02), ([30, 60, 85], 0.05), ([55, 90], None)])
+def test_kernel_delivers_planned_energy(config, socs, fleet_limit_mw):
+    scheduler = MPCScheduler(config)
+    state = _session_state(socs)
+    setpoints = scheduler.plan_power(state, fleet_limit_mw)
+    planned_kw = scheduler.last_stats["planned_ev_load_kw"]
+
+    chargers = {c["charger_id"]: dict(c, power_cap_kw=setpoints[c["charger_id"]]) for c in state["chargers"]}
+    users = {u["user_id"]: u for u in state["users"]}
+    results = _charging_kernel(chargers, users, scheduler.dt_hours, config)
+
+    delivered_kwh = sum(from_grid for _, from_grid, _ in results.values())
+    assert delivered_kwh == pytest.approx(planned_kw * scheduler.dt_hours, abs=0.01)
+    if fleet_limit_mw is not None:
+        assert planned_kw == pytest.approx(fleet_limit_mw * 1000, abs=0.01)
+
+
+def test_setpoints_are_pre_taper(config):
+    scheduler = MPCScheduler(config)
+    setpoints = scheduler.plan_power(_session_state([85]), None)
+    # 计划值是电网侧功率，下发值按充电桩模型的口径除以 SOC 衰减
+    planned_kw = scheduler.last_stats["planned_ev_load_kw"]
+    assert 0 < planned_kw < 60 * float(soc_taper_factor(85))
+    assert setpoints["c0"] == pytest.approx(planned_kw / float(soc_taper_factor(85)), abs=0.01)
+
+
+def test_water_fill_is_feasible_and_levels_load():
+    rng = np.random.default_rng(5)
+    for _ in range(200):
+        level = rng.uniform(0, 100, 12)
+        cap = np.where(rng.random(12) < 0.2, 0.0, rng.uniform(0, 60, 12))
+        target = rng.uniform(0, 1.2) * cap.sum()
+        p = _water_fill(level, cap, target)
+        assert (p >= -1e-9).all() and (p <= cap + 1e-9).all()
+        assert p.sum() == pytest.approx(min(target, cap.sum()), abs=1e-6)
+        # 最优性: 未到上限的时段总负载相同 (水位)，且不高于任何有余量时段
+        filled = level + p
+        partial = (p > 1e-9) & (p < cap - 1e-9)
+        if partial.any():
+            nu = filled[partial][0]
+            np.testing.assert_allclose(filled[partial], nu, atol=1e-6)
+            assert (filled[(p < cap - 1e-9)] >= nu - 1e-6).all()
+
+
+@pytest.mark.parametrize("fleet_limit_mw", [0.03, 0.08, None])
+def test_plan_respects_power_energy_and_fleet_limits(config, fleet_limit_mw):
+    scheduler = MPCScheduler(config)
+    state = _session_state([20, 45, 70, 88])
+    scheduler.plan_power(state, fleet_limit_mw)
+    _, plans = scheduler._previous_plans[state.get("shard_key")]
+    plan = np.array(list(plans.values()))
+    sessions = {s["charger_id"]: s for s in scheduler._active_sessions(state, NOW)}
+
+    assert (plan >= -1e-9).all()
+    for charger_id, row in plans.items():
+        assert (row <= sessions[charger_id]["p_max"] + 1e-6).all()
+        assert row.sum() * scheduler.dt_hours <= sessions[charger_id]["energy_kwh"] + 1e-6
+    if fleet_limit_mw is not None:
+        assert (plan.sum(axis=0) <= fleet_limit_mw * 1000 + 1e-6).all()
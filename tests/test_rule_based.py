@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+import os
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+from algorithms import rule_based
+from algorithms.rule_based import _ChargerFeatureCache
+from simulation.environment import ChargingEnvironment
+
+
+def _chargers():
+    return [{"charger_id": f"c{i}", "type": "fast", "max_power": 60, "price_multiplier": 1.0,
+             "position": {"lat": 30.5, "lng": 114.0 + i * 0.01}} for i in range(3)]
+
+
+def test_feature_cache_refreshes_only_dirty_chargers():
+    cache = _ChargerFeatureCache()
+    chargers = _chargers()
+    cache.refresh(chargers, {"full": True, "step": 0, "chargers": []})
+
+    chargers[0]["price_multiplier"] = 1.4
+    chargers[1]["price_multiplier"] = 0.8
+    features = cache.refresh(chargers, {"full": False, "step": 1, "chargers": ["c1"]})
+    assert list(features.price_multiplier) == [1.0, 0.8, 1.0]
+    assert cache.full_rebuilds == 1
+
+    # 漏掉一步的增量: 整体重建
+    features = cache.refresh(chargers, {"full": False, "step": 3, "chargers": []})
+    assert list(features.price_multiplier) == [1.4, 0.8, 1.0]
+    assert cache.full_rebuilds == 2
+
+
+def test_environment_reports_price_changes_between_steps(config):
+    config["environment"]["user_count"] = 50
+    env = ChargingEnvironment(config)
+    env.step({})
+    charger_id = next(iter(env.chargers))
+    env.chargers[charger_id]["price_multiplier"] = 2.0
+    env.step({})
+    assert charger_id in env.get_current_state()["dirty"]["chargers"]
+
+
+def test_cached_features_match_per_call_features(config):
+    config["environment"]["user_count"] = 200
+    env = ChargingEnvironment(config)
+    algorithm = rule_based.create_algorithm(config)
+    for step in range(12):
+        if step == 5:
+            # 步与步之间修改定价 (不经过 environment.step)
+            repriced = list(env.chargers)[::3]
+            for charger_id in repriced:
+                env.chargers[charger_id]["price_multiplier"] = 3.0
+            env.mark_chargers_dirty(repriced)
+        state = env.get_current_state()
+        cached, _ = algorithm.decide(state)
+        expected, _ = rule_based.schedule(state, config)
+        assert cached == expected
+        assert list(algorithm.feature_cache.features.price_multiplier) == [c.get("price_multiplier", 1.0) for c in state["chargers"]]
+        env.step(cached)
+    assert algorithm.feature_cache.full_rebuilds == 1
@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+"""
+rule_based 批量评分 (_BatchedScorer) 与原先逐个 用户-充电桩 计算的标量评分函数对照。
+下面三个 _calculate_*_score 是向量化之前 rule_based.py 中的实现，原样保留作参考答案。
+"""
+
+import random
+from datetime import datetime
+
+import numpy as np
+import pytest
+
+from algorithms import rule_based
+from algorithms.rule_based import _BatchedScorer
+from simulation.utils import calculate_distance
+
+
+# --- 参考实现 (原 rule_based.py 标量评分函数) ---
+def _calculate_user_satisfaction_score(user, charger, distance, current_queue_len, params):
+    """Calculates user satisfaction score [-1, 1] using parameters from config."""
+    
+    # 1. Distance factor
+    dist_tiers = params.get('distance_tiers', [[2, 0.5, -0.1], [5, 0.3, -0.1], [10, 0.0, -0.05]])
+    # Make the base penalty less severe
+    dist_base_penalty = params.get('dist_base_penalty', -0.15) # Reduced from -0.25
+    distance_score = dist_base_penalty # Start with base penalty for long distances
+    for tier_max_dist, base_score, per_km_penalty in dist_tiers:
+        if distance < tier_max_dist:
+            distance_score = base_score - (distance - (dist_tiers[[i[0] for i in dist_tiers].index(tier_max_dist)-1][0] if [i[0] for i in dist_tiers].index(tier_max_dist) > 0 else 0) ) * per_km_penalty
+            break
+    else: # Executed if loop doesn't break (distance > last tier_max_dist)
+        last_tier_dist = dist_tiers[-1][0] if dist_tiers else 10
+        # Make the long-distance penalty factor less harsh
+        default_dist_factor = params.get('default_dist_factor', -0.015) # Reduced from -0.025
+        distance_score = max(-0.5, dist_base_penalty - (distance - last_tier_dist) * default_dist_factor)
+
+    # 2. Wait time factor
+    wait_time_tiers = params.get('wait_time_tiers', [[0, 0.5], [2, 0.3], [5, 0.1], [8, -0.1]])
+    default_wait_score = params.get('default_wait_score', -0.3)
+    wait_score = default_wait_score
+    for max_queue, score_val in wait_time_tiers:
+        if current_queue_len <= max_queue:
+            wait_score = score_val
+            break
+            
+    # 3. Power matching factor
+    charger_power = charger.get("max_power", 50)
+    user_type = user.get("user_type", "private")
+    user_soc = user.get("soc", 50)
+    urgency = max(0, (params.get('power_expected_base_soc_threshold', 40) - user_soc) / params.get('power_expected_base_soc_threshold', 40)) if user_soc < params.get('power_expected_base_soc_threshold', 40) else 0
+    
+    power_expected_base = params.get('power_expected_base', 20)
+    power_expected_urgency_factor = params.get('power_expected_urgency_factor', 30)
+    expected_power = power_expected_base + urgency * power_expected_urgency_factor
+    
+    profile_factors = params.get('power_expected_profile_factors', {})
+    expected_power *= profile_factors.get(user_type, 1.0)
+        
+    power_ratio = charger_power / expected_power if expected_power > 0 else 1.0
+    power_score_tiers = params.get('power_score_tiers', [[1.5, 0.4], [1.0, 0.3], [0.7, 0.1], [0.5, -0.1]])
+    default_power_score = params.get('default_power_score', -0.2)
+    power_score = default_power_score
+    for min_ratio, score_val in power_score_tiers:
+        if power_ratio >= min_ratio:
+            power_score = score_val
+            break
+
+    # 4. Price factor
+    price_multiplier = charger.get("price_multiplier", 1.0) # Lower is better for user
+    price_score_mult = params.get('price_score_multiplier', 0.5)
+    price_score_max_abs = params.get('price_score_max_abs', 0.3)
+    price_score = max(-price_score_max_abs, min(price_score_max_abs, (1.0 - price_multiplier) * price_score_mult))
+
+    # 5. Tiered Urgency/Risk Adjustment (previously Emergency SOC adjustment)
+    # This factor boosts the importance of distance and wait time for users with low SOC.
+    urgency_factor = 1.0
+    # Add a new tier for "at-risk" users (e.g., SOC < 40%)
+    urgency_soc_thresholds = params.get('emergency_soc_thresholds', [15, 25, 40]) # Added 40%
+    urgency_factors = params.get('emergency_factors', [1.6, 1.3, 1.1])          # Added 1.1 factor
+
+    if user_soc < urgency_soc_thresholds[0]: 
+        urgency_factor = urgency_factors[0] # Critical
+    elif user_soc < urgency_soc_thresholds[1]: 
+        urgency_factor = urgency_factors[1] # Emergency
+    elif user_soc < urgency_soc_thresholds[2]:
+        urgency_factor = urgency_factors[2] # At-risk
+
+    # Combine components
+    component_weights = params.get('component_weights', {"distance": 0.4, "wait_time": 0.3, "power": 0.15, "price": 0.15})
+    # Apply the urgency factor to time-sensitive components
+    satisfaction = (
+        distance_score * component_weights.get('distance', 0.4) * urgency_factor +
+        wait_score * component_weights.get('wait_time', 0.3) * urgency_factor +
+        power_score * component_weights.get('power', 0.15) +
+        price_score * component_weights.get('price', 0.15)
+    )
+    
+    # Final adjustments
+    # The config keys here might need updating to reflect the new "urgency" logic vs "emergency"
+    if urgency_factor > 1.0 and satisfaction < params.get('emergency_satisfaction_min_score_adjustment', -0.5):
+        satisfaction = max(params.get('emergency_satisfaction_min_score_adjustment', -0.5), satisfaction * params.get('emergency_satisfaction_adjustment_factor', 0.8))
+    
+    return max(-1.0, min(1.0, satisfaction))
+
+
+def _calculate_operator_profit_score(user, charger, state, params):
+    grid_status = state.get("grid_status", {})
+    current_price = grid_status.get("current_price", 0.85) # Base electricity price
+    user_soc = user.get("soc", 50)
+    
+    charge_needed_factor = (100 - user_soc) / 50.0 # Scale: more need = higher factor
+    charger_type = charger.get("type", "normal")
+    charger_price_multiplier = charger.get("price_multiplier", 1.0) # From charger's own settings
+    queue_length = len(charger.get("queue", []))
+
+    effective_price = current_price * charger_price_multiplier
+    score = effective_price # Base score
+
+    if charger_type == "fast": score *= params.get('fast_charger_multiplier', 1.15)
+    elif charger_type == "superfast": score *= params.get('superfast_charger_multiplier', 1.30)
+
+    score -= queue_length * params.get('queue_penalty_per_person', 0.15)
+    score *= (1 + charge_needed_factor * params.get('charge_needed_score_factor', 0.05))
+
+    norm_min = params.get('normalization_min_assumed_score', 0.5)
+    norm_max = params.get('normalization_max_assumed_score', 2.0)
+    normalized_score = (score - norm_min) / (norm_max - norm_min) if (norm_max - norm_min) != 0 else 0.5
+    final_score = 2 * normalized_score - 1
+    
+    return max(-1.0, min(1.0, final_score))
+
+
+def _calculate_grid_friendliness_score(charger, state, params):
+    grid_status = state.get("grid_status", {})
+    hour = datetime.fromisoformat(state.get('timestamp', '')).hour if state.get('timestamp') else datetime.now().hour
+    grid_load_percentage = grid_status.get("grid_load_percentage", 50)
+    renewable_ratio = grid_status.get("renewable_ratio", 0) / 100.0 if grid_status.get("renewable_ratio") is not None else 0.0
+    peak_hours = grid_status.get("peak_hours", []) # Consider sourcing from main config or grid_status
+    valley_hours = grid_status.get("valley_hours", [])
+    charger_max_power = charger.get("max_power", 50)
+
+    # 1. Load score
+    load_tiers = params.get('load_score_tiers', [[30, 0.8, 0.0], [50, 0.5, -0.015], [70, 0.2, -0.01], [85, 0.0, -0.015]])
+    default_load_factor = params.get('default_load_factor', -0.01)
+    default_load_base_penalty = params.get('default_load_base_penalty', -0.225)
+    max_load_penalty = params.get('max_load_score_penalty', -0.5)
+    
+    load_score = default_load_base_penalty
+    for i, (threshold, base_score, factor) in enumerate(load_tiers):
+        if grid_load_percentage < threshold:
+            prev_threshold = load_tiers[i-1][0] if i > 0 else 0
+            load_score = base_score - (grid_load_percentage - prev_threshold) * factor
+            break
+    else: # Executed if grid_load_percentage >= last threshold
+        last_threshold = load_tiers[-1][0] if load_tiers else 85
+        load_score = max(max_load_penalty, default_load_base_penalty - (grid_load_percentage - last_threshold) * default_load_factor)
+
+    # 2. Renewable score
+    renewable_score = params.get('renewable_score_multiplier', 0.8) * renewable_ratio
+
+    # 3. Time score
+    time_scores = params.get('time_scores', {"peak": -0.3, "valley": 0.6, "shoulder": 0.2})
+    if hour in peak_hours: time_score = time_scores.get('peak', -0.3)
+    elif hour in valley_hours: time_score = time_scores.get('valley', 0.6)
+    else: time_score = time_scores.get('shoulder', 0.2)
+
+    # 4. Power penalty
+    power_penalty = 0
+    power_penalty_thresholds = params.get('power_penalty_thresholds', [150, 50])
+    power_penalties = params.get('power_penalties', [0.1, 0.05])
+    if charger_max_power > power_penalty_thresholds[0]: power_penalty = power_penalties[0]
+    elif charger_max_power > power_penalty_thresholds[1]: power_penalty = power_penalties[1]
+    
+    raw_score = load_score + renewable_score + time_score - power_penalty
+    
+    # Adjustments and clamping
+    if raw_score < 0: raw_score *= params.get('negative_score_adjustment_factor', 0.8)
+    else: raw_score = min(1.0, raw_score * params.get('positive_score_adjustment_factor', 1.1))
+        
+    final_score = max(params.get('final_score_min_clamp', -0.9), min(params.get('final_score_max_clamp', 1.0), raw_score))
+    return final_score
+
+
+# --- 对照测试 ---
+def _random_users(rng, count):
+    return [{
+        "user_id": f"u{i}", "soc": rng.uniform(3, 90),
+        "user_type": rng.choice(["private", "taxi", "ride_hailing", "logistics"]),
+        "current_position": {"lat": 30.5 + rng.uniform(-0.15, 0.15), "lng": 114.3 + rng.uniform(-0.15, 0.15)},
+    } for i in range(count)]
+
+
+def _random_chargers(rng, count):
+    return [{
+        "charger_id": f"c{i}", "type": rng.choice(["normal", "fast", "superfast"]),
+        "max_power": rng.choice([7, 22, 60, 120, 180, 350]), "price_multiplier": rng.uniform(0.7, 1.5),
+        "queue": [f"q{k}" for k in range(rng.randint(0, 4))],
+        "position": {"lat": 30.5 + rng.uniform(-0.15, 0.15), "lng": 114.3 + rng.uniform(-0.15, 0.15)},
+    } for i in range(count)]
+
+
+@pytest.mark.parametrize("hour, grid_load, renewable", [(3, 25, 40), (10, 55, 10), (19, 92, 0), (14, 72, None)])
+def test_batched_scores_match_scalar_reference(config, hour, grid_load, renewable):
+    rng = random.Random(hour)
+    users, chargers = _random_users(rng, 25), _random_chargers(rng, 30)
+    grid_status = {"grid_load_percentage": grid_load, "renewable_ratio": renewable, "current_price": 0.9,
+                   "peak_hours": [18, 19, 20, 21], "valley_hours": [0, 1, 2, 3, 4, 5]}
+    state = {"timestamp": datetime(2025, 1, 6, hour).isoformat(), "grid_status": grid_status}
+    weights = {"user_satisfaction": 0.4, "operator_profit": 0.3, "grid_friendliness": 0.3}
+    params = config["algorithms"]["rule_based"]["score_params"]
+    user_params, profit_params, grid_params = params["user_satisfaction"], params["operator_profit"], params["grid_friendliness"]
+
+    scorer = _BatchedScorer(users, chargers, grid_status, hour, weights, user_params, profit_params, grid_params)
+    rows = np.arange(len(users))
+    for col, charger in enumerate(chargers):
+        for load in (0, 1, 3, 6, 9):
+            batched = scorer.combined_scores(rows, col, np.full(len(users), load))
+            expected = [
+                _calculate_user_satisfaction_score(user, charger, scorer.distances[row, col], load, user_params) * weights["user_satisfaction"]
+                + _calculate_operator_profit_score(user, charger, state, profit_params) * weights["operator_profit"]
+                + _calculate_grid_friendliness_score(charger, state, grid_params) * weights["grid_friendliness"]
+                for row, user in enumerate(users)
+            ]
+            np.testing.assert_allclose(batched, expected, atol=1e-9)
+
+
+def _scalar_greedy(users, chargers, state, config):
+    """向量化之前的贪心分配: SOC 低的用户先选，在最近的 candidate_limit 个未满充电桩中取得分最高者"""
+    rule_config = config["algorithms"]["rule_based"]
+    params = rule_config["score_params"]
+    weights = dict(config["scheduler"]["optimization_weights"])
+    total_w = sum(weights.values())
+    weights = {k: v / total_w for k, v in weights.items()}
+    max_queue = rule_config["max_queue"]["shoulder"]
+    loads = {c["charger_id"]: len(c["queue"]) for c in chargers}
+    decisions = {}
+    for user in sorted(users, key=lambda u: u["soc"]):
+        nearby = sorted((c for c in chargers if loads[c["charger_id"]] < max_queue),
+                        key=lambda c: calculate_distance(user["current_position"], c["position"]))
+        best_id, best_score = None, -np.inf
+        for charger in nearby[:rule_config["candidate_limit"]]:
+            load = loads[charger["charger_id"]]
+            distance = calculate_distance(user["current_position"], charger["position"])
+            score = (_calculate_user_satisfaction_score(user, charger, distance, load, params["user_satisfaction"]) * weights["user_satisfaction"]
+                     + _calculate_operator_profit_score(user, charger, state, params["operator_profit"]) * weights["operator_profit"]
+                     + _calculate_grid_friendliness_score(charger, state, params["grid_friendliness"]) * weights["grid_friendliness"]
+                     + rule_config["critical_need_bonus"]["bonus_value"] - load * rule_config["queue_penalty"])
+            if score > best_score:
+                best_id, best_score = charger["charger_id"], score
+        if best_id is not None:
+            decisions[user["user_id"]] = best_id
+            loads[best_id] += 1
+    return decisions
+
+
+@pytest.mark.parametrize("seed", [1, 2, 3])
+def test_greedy_schedule_matches_scalar_reference(config, seed):
+    rng = random.Random(seed)
+    config["algorithms"]["rule_based"]["max_queue"]["shoulder"] = 4
+    users = _random_users(rng, 120)
+    for user in users:
+        user.update(soc=rng.uniform(3, 35), status="idle")
+    chargers = [dict(c, status="available") for c in _random_chargers(rng, 40)]
+    grid_status = {"grid_load_percentage": 60, "renewable_ratio": 20, "current_price": 0.9, "peak_hours": [], "valley_hours": []}
+    state = {"timestamp": datetime(2025, 1, 6, 14).isoformat(), "grid_status": grid_status, "users": users, "chargers": chargers}
+
+    decisions, metadata = rule_based.schedule(state, config)
+
+    assert metadata["assignment_mode"] == "greedy"
+    assert metadata["candidate_user_count"] == len(users)
+    # 排队容量不够所有用户，后面的用户只能选剩下的充电桩
+    assert len(decisions) < len(users)
+    assert decisions == _scalar_greedy(users, chargers, state, config)
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+import os
+from datetime import timedelta
+
+import numpy as np
+import pytest
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+from simulation.environment import ChargingEnvironment
+from simulation.service_metrics import StreamingQuantileSketch
+
+
+def test_session_finished_within_one_step_records_start(config):
+    config["environment"]["user_count"] = 20
+    env = ChargingEnvironment(config)
+    user_id, charger_id = next(iter(env.users)), next(iter(env.chargers))
+    start = env.current_time - timedelta(minutes=10)
+    env.users[user_id]["arrival_time_at_charger"] = start - timedelta(minutes=5)
+    session = {"user_id": user_id, "charger_id": charger_id, "start_time": start.isoformat(),
+               "end_time": env.current_time.isoformat(), "duration_minutes": 10.0}
+
+    env._update_service_levels([session])
+
+    summary = env.service_tracker.summary()
+    assert summary["completed_sessions"] == 1
+    assert summary["charging_time_minutes"]["count"] == 1
+    assert summary["charging_time_minutes"]["max"] == 10.0
+    assert summary["wait_time_minutes"]["max"] == 5.0
+    assert not env.service_tracker.has_started(user_id, charger_id)
+
+
+@pytest.mark.parametrize("accuracy", [0.01, 0.05])
+def test_sketch_quantiles_within_relative_accuracy(accuracy):
+    rng = np.random.default_rng(3)
+    values = np.concatenate([rng.lognormal(2.0, 1.2, 20000), np.zeros(500)])
+    halves = StreamingQuantileSketch(accuracy), StreamingQuantileSketch(accuracy)
+    for i, value in enumerate(values):
+        halves[i % 2].add(value)
+    sketch = halves[0]
+    sketch.merge(halves[1])
+
+    ordered = np.sort(values)
+    assert sketch.count == len(values)
+    assert sketch.quantile(0.0) == 0.0
+    assert sketch.quantile(1.0) == pytest.approx(ordered[-1])
+    for q in (0.05, 0.25, 0.5, 0.9, 0.95, 0.99):
+        # 草图返回排名 floor(q*(n-1)) 的观测值所在桶的代表值
+        exact = ordered[int(q * (len(values) - 1))]
+        assert abs(sketch.quantile(q) - exact) <= accuracy * exact + 1e-12
@@ -36,6 +36,8 @@ from PyQt6.QtGui import (
 from PyQt6.QtCore import QPointF
 import math
 
+from simulation.queue_estimator import QueueTimeEstimator
+
 logger = logging.getLogger(__name__)
 
 @dataclass
@@ -1236,6 +1238,7 @@ class UserControlPanel(QWidget):
         self.current_step = 0
         self.max_step = 0
         self.simulation_data = {}
+        self.queue_estimates = None # 仿真发布的排队等待估计 (QueueTimeEstimator 快照)
         self.is_paused = False
         # 初始化仿真时间为当日零点
         from datetime import datetime
@@ -1413,6 +1416,7 @@ class UserControlPanel(QWidget):
         self.current_step = step
         self.max_step = max_step
         self.simulation_data = simulation_data
+        self.queue_estimates = QueueTimeEstimator.from_snapshot(simulation_data.get('queue_estimates'))
         
         # 提取仿真时间信息
         timestamp_str = simulation_data.get('timestamp')
@@ -1616,7 +1620,7 @@ class UserControlPanel(QWidget):
                 available_chargers=1 if charger.get('status') == 'available' else 0,
                 total_chargers=1,
                 queue_length=len(charger.get('queue', [])),
-                wait_time_minutes=self._calculate_wait_time(charger),
+                wait_time_minutes=self._calculate_wait_time(charger, eta_minutes),
                 max_power=charger.get('max_power', 60),
                 current_price=round(predicted_price, 2),
                 rating=round(personalized_rating, 1),
@@ -2013,8 +2017,12 @@ class UserControlPanel(QWidget):
         self.chargingDecisionMade.emit(user_id, station_id, charging_params)
         logger.info(f"已转发充电决策信号到主窗口")
     
-    def _calculate_wait_time(self, charger):
-        """计算等待时间（分钟）"""
+    def _calculate_wait_time(self, charger, arrival_in_minutes=0):
+        """计算等待时间（分钟）；优先使用仿真发布的排队估计 (到达时的预计等待)"""
+        if self.queue_estimates is not None:
+            expected = self.queue_estimates.expected_wait(charger.get('charger_id'), arrival_in_minutes)
+            if expected is not None:
+                return int(round(expected))
         try:
             queue = charger.get('queue', [])
             if not queue: